@@ -6,11 +6,13 @@
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
 
-from ._util import midpoint_root, robinson_foulds
+from ._util import midpoint_root, robinson_foulds, robinson_foulds_reference
+from ._rooting import mad_root, min_variance_root
 from ._fasttree import fasttree
 from ._raxml import raxml, raxml_rapid_bootstrap
 from ._iqtree import iqtree, iqtree_ultrafast_bootstrap
-from ._filter import filter_table, filter_tree
+from ._filter import (filter_table, filter_tree, filter_tree_batch,
+                      filter_tree_collection)
 from ._version import get_versions
 from ._align_to_tree_mafft_fasttree import align_to_tree_mafft_fasttree
 from ._align_to_tree_mafft_iqtree import align_to_tree_mafft_iqtree
@@ -22,4 +24,6 @@ del get_versions
 __all__ = ["midpoint_root", "fasttree", "align_to_tree_mafft_fasttree",
            "raxml", "raxml_rapid_bootstrap", "iqtree", "filter_table",
            "iqtree_ultrafast_bootstrap", "align_to_tree_mafft_iqtree",
-           "align_to_tree_mafft_raxml", "robinson_foulds", 'filter_tree']
+           "align_to_tree_mafft_raxml", "robinson_foulds", 'filter_tree',
+           "robinson_foulds_reference", "filter_tree_batch", "mad_root",
+           "min_variance_root", "filter_tree_collection"]
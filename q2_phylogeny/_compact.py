@@ -0,0 +1,374 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016-2023, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import contextlib
+import gc
+import io
+import os
+
+import numpy as np
+import skbio
+
+from q2_phylogeny._newick import _read_newick, _write_newick, _split_newick
+
+# the arrays a CompactTree is saved as, the name table being saved as its
+# UTF-8 text with the offsets of each name in it
+_SAVED_ARRAYS = ('parents', 'lengths', 'name_ids', 'n_children',
+                 'child_offsets', 'children', 'last_descendants', 'postorder')
+_COLLECTION_ARRAYS = ('parents', 'lengths', 'name_ids', 'tree_offsets')
+_NAME_TEXT = 'name_text'
+_NAME_OFFSETS = 'name_offsets'
+
+
+def _pointer_jump(pointers, values):
+    """ Sum values along chains of pointers, in O(log(chain length)) passes
+
+    Returns, for every i, the sum of values over i, pointers[i],
+    pointers[pointers[i]], ... up to the first negative pointer.
+    """
+    sums = values.copy()
+    pointers = pointers.copy()
+    active = np.flatnonzero(pointers >= 0)
+    while active.size:
+        targets = pointers[active]
+        sums[active] += sums[targets]
+        pointers[active] = pointers[targets]
+        active = active[pointers[active] >= 0]
+    return sums
+
+
+@contextlib.contextmanager
+def _gc_paused():
+    """ Pause the cyclic garbage collector while many objects are created
+
+    Every TreeNode is tracked by the collector, which would otherwise rescan
+    the growing tree each time enough new nodes have been allocated.
+    """
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+class CompactTree:
+    """ A tree stored as a struct of arrays, with nodes numbered in preorder
+
+    ``parents`` holds the position of each node's parent (-1 for the root),
+    ``lengths`` its branch length as float64 (NaN where it has none) and
+    ``name_ids`` the position of its name in ``names`` (-1 where it has
+    none), so each distinct name is stored once. The children of node i are
+    ``children[child_offsets[i]:child_offsets[i + 1]]``, in order, its
+    subtree runs from i to ``last_descendants[i]``, and ``postorder`` lists
+    the nodes in postorder; preorder is the identity.
+    """
+
+    def __init__(self, parents, lengths, name_ids, names):
+        self.parents = np.asarray(parents, dtype=np.int64)
+        self.lengths = np.asarray(lengths, dtype=np.float64)
+        self.name_ids = np.asarray(name_ids, dtype=np.int64)
+        # a list is kept as it is, so trees can share one name table
+        self.names = names if isinstance(names, list) else list(names)
+        n_nodes = len(self.parents)
+        if not n_nodes or self.parents[0] != -1 or \
+                np.any(self.parents[1:] >= np.arange(1, n_nodes)) or \
+                np.any(self.parents[1:] < 0):
+            raise ValueError('Nodes must be given in preorder, with the '
+                             'root first.')
+
+        self.n_children = np.bincount(self.parents[1:], minlength=n_nodes)
+        self.child_offsets = np.zeros(n_nodes + 1, dtype=np.int64)
+        np.cumsum(self.n_children, out=self.child_offsets[1:])
+        # a stable sort keeps each node's children in preorder, which is
+        # their order in the tree
+        self.children = np.argsort(self.parents[1:], kind='stable') + 1
+
+        # in preorder, a node's subtree runs from it to its last descendant,
+        # and its postorder position follows from its depth and subtree size
+        depths = _pointer_jump(self.parents,
+                               (self.parents >= 0).astype(np.int64))
+        internal = self.n_children > 0
+        last_child = np.full(n_nodes, -1, dtype=np.int64)
+        last_child[internal] = \
+            self.children[self.child_offsets[1:][internal] - 1]
+        positions = np.arange(n_nodes, dtype=np.int64)
+        self.last_descendants = _pointer_jump(
+            last_child, np.where(last_child >= 0, 0, positions))
+        self.postorder = np.empty(n_nodes, dtype=np.int64)
+        self.postorder[self.last_descendants - depths] = positions
+        self._tip_positions = None
+
+    def __len__(self):
+        return len(self.parents)
+
+    def __str__(self):
+        fh = io.StringIO()
+        self.write(fh)
+        return fh.getvalue()
+
+    @classmethod
+    def from_arrays(cls, names, lengths, parents):
+        """ A tree from per-node names, lengths and parent positions
+
+        Nodes are given in preorder. Missing names and lengths are None.
+        """
+        table = {}
+        name_ids = np.fromiter(
+            (-1 if name is None else table.setdefault(name, len(table))
+             for name in names), dtype=np.int64, count=len(names))
+        lengths = np.fromiter(
+            (np.nan if length is None else length for length in lengths),
+            dtype=np.float64, count=len(lengths))
+        return cls(parents, lengths, name_ids, table)
+
+    @classmethod
+    def from_treenode(cls, tree):
+        """ A tree with the same nodes as a skbio.TreeNode, in one pass
+        """
+        names = []
+        lengths = []
+        parents = []
+        stack = [(tree, -1)]
+        while stack:
+            node, parent = stack.pop()
+            position = len(parents)
+            names.append(node.name)
+            lengths.append(node.length)
+            parents.append(parent)
+            stack.extend((child, position)
+                         for child in reversed(node.children))
+        return cls.from_arrays(names, lengths, parents)
+
+    @classmethod
+    def from_newick(cls, text):
+        """ A tree read from Newick text or bytes, without creating TreeNodes
+        """
+        return cls(*_read_newick(text))
+
+    @classmethod
+    def load(cls, directory, mmap_mode='r'):
+        """ A tree saved in directory by ``CompactTree.save``
+
+        The arrays are memory-mapped rather than read, and are not
+        recomputed, so only the name table is decoded.
+        """
+        tree = cls.__new__(cls)
+        for name in _SAVED_ARRAYS:
+            setattr(tree, name, _load_array(directory, name, mmap_mode))
+        tree.names = _load_names(directory)
+        tree._tip_positions = None
+        return tree
+
+    def save(self, directory):
+        """ Save the tree in directory as one .npy file per array
+        """
+        for name in _SAVED_ARRAYS:
+            _save_array(directory, name, getattr(self, name))
+        _save_names(directory, self.names)
+
+    def to_treenode(self, cls=skbio.TreeNode):
+        """ A skbio.TreeNode with the same nodes, built bottom up
+
+        Building from the tips up avoids the cache invalidation that
+        ``TreeNode.append`` repeats up to the root for every node added.
+        """
+        names = self.node_names()
+        lengths = self.length_list()
+        parents = self.parents.tolist()
+        built = {}
+        with _gc_paused():
+            for i in range(len(parents) - 1, -1, -1):
+                node = cls(name=names[i], length=lengths[i])
+                node.extend(built.pop(i, [])[::-1])
+                if parents[i] < 0:
+                    return node
+                built.setdefault(parents[i], []).append(node)
+
+    def write(self, fh):
+        """ Write the tree to fh in Newick format, as skbio would
+        """
+        _write_newick(fh, self)
+
+    def node_names(self):
+        """ The name of every node, None where it has none
+        """
+        table = np.array(self.names + [None], dtype=object)
+        return table[self.name_ids].tolist()
+
+    def length_list(self):
+        """ The branch length of every node, None where it has none
+        """
+        return [None if length != length else length
+                for length in self.lengths.tolist()]
+
+    def children_lists(self):
+        """ The children of every node, as a list of lists
+        """
+        children = self.children.tolist()
+        offsets = self.child_offsets.tolist()
+        return [children[offsets[i]:offsets[i + 1]]
+                for i in range(len(offsets) - 1)]
+
+    def tips(self):
+        """ Positions of the tips, in preorder (which is also postorder)
+        """
+        return np.flatnonzero(self.n_children == 0)
+
+    def tip_names(self):
+        """ Names of the tips, in preorder
+        """
+        table = np.array(self.names + [None], dtype=object)
+        return table[self.name_ids[self.tips()]].tolist()
+
+    def tip_positions(self):
+        """ Position of each tip by name
+        """
+        if self._tip_positions is None:
+            self._tip_positions = dict(zip(self.tip_names(),
+                                           self.tips().tolist()))
+        return self._tip_positions
+
+    def branch_lengths(self):
+        """ Branch lengths with missing lengths counted as zero
+        """
+        return np.nan_to_num(self.lengths, nan=0.0)
+
+
+class CompactTreeCollection:
+    """ Many trees stored as one struct of arrays over a shared name table
+
+    The nodes of every tree are stored one tree after another, each tree in
+    preorder, and those of tree i are at ``tree_offsets[i]`` up to
+    ``tree_offsets[i + 1]``. ``parents`` holds each node's parent position
+    within its own tree (-1 for its root), ``lengths`` its branch length (NaN
+    where it has none), and ``name_ids`` the position of its name in
+    ``names``, which is shared by all of the trees, so a tip name found in
+    every bootstrap replicate is stored once.
+    """
+
+    def __init__(self, parents, lengths, name_ids, tree_offsets, names):
+        self.parents = np.asarray(parents, dtype=np.int64)
+        self.lengths = np.asarray(lengths, dtype=np.float64)
+        self.name_ids = np.asarray(name_ids, dtype=np.int64)
+        self.tree_offsets = np.asarray(tree_offsets, dtype=np.int64)
+        self.names = names if isinstance(names, list) else list(names)
+
+    def __len__(self):
+        return len(self.tree_offsets) - 1
+
+    def __getitem__(self, i):
+        if not -len(self) <= i < len(self):
+            raise IndexError('Tree index out of range: %d' % i)
+        i %= len(self)
+        start, stop = self.tree_offsets[i:i + 2].tolist()
+        return CompactTree(self.parents[start:stop],
+                           self.lengths[start:stop],
+                           self.name_ids[start:stop], self.names)
+
+    def __iter__(self):
+        """ Each tree in turn, as a CompactTree over the shared name table
+        """
+        for i in range(len(self)):
+            yield self[i]
+
+    @classmethod
+    def from_trees(cls, trees):
+        """ A collection of the given CompactTrees or skbio.TreeNodes
+
+        Trees are taken from the iterable one at a time, and the names of each
+        are interned into the shared table as it is added.
+        """
+        table = {}
+        parents = []
+        lengths = []
+        name_ids = []
+        tree_offsets = [0]
+        for tree in trees:
+            tree = _as_compact(tree)
+            # the tree's name ids, and -1 for none, in the shared table
+            ids = np.fromiter(
+                (table.setdefault(name, len(table)) for name in tree.names),
+                dtype=np.int64, count=len(tree.names))
+            parents.append(tree.parents)
+            lengths.append(tree.lengths)
+            name_ids.append(np.append(ids, -1)[tree.name_ids])
+            tree_offsets.append(tree_offsets[-1] + len(tree))
+        if not parents:
+            raise ValueError('A tree collection must hold at least one tree.')
+        return cls(np.concatenate(parents), np.concatenate(lengths),
+                   np.concatenate(name_ids), tree_offsets, list(table))
+
+    @classmethod
+    def from_newick(cls, fh):
+        """ A collection read from a file (or str) of several Newick trees
+
+        The trees are read one at a time, as RAxML and IQ-TREE write their
+        bootstrap replicates, one per line.
+        """
+        if isinstance(fh, str):
+            fh = io.StringIO(fh)
+        return cls.from_trees(CompactTree.from_newick(text)
+                              for text in _split_newick(fh))
+
+    @classmethod
+    def load(cls, directory, mmap_mode='r'):
+        """ A collection saved in directory by ``CompactTreeCollection.save``
+
+        The arrays are memory-mapped, and each tree is only indexed when it
+        is taken from the collection.
+        """
+        arrays = [_load_array(directory, name, mmap_mode)
+                  for name in _COLLECTION_ARRAYS]
+        return cls(*arrays, _load_names(directory))
+
+    def save(self, directory):
+        """ Save the collection in directory as one .npy file per array
+        """
+        for name in _COLLECTION_ARRAYS:
+            _save_array(directory, name, getattr(self, name))
+        _save_names(directory, self.names)
+
+    def write(self, fh):
+        """ Write the trees to fh in Newick format, one per line
+        """
+        for tree in self:
+            tree.write(fh)
+
+
+def _load_array(directory, name, mmap_mode):
+    return np.load(os.path.join(directory, name + '.npy'),
+                   mmap_mode=mmap_mode, allow_pickle=False)
+
+
+def _save_array(directory, name, array):
+    np.save(os.path.join(directory, name + '.npy'), np.asarray(array))
+
+
+def _load_names(directory):
+    text = _load_array(directory, _NAME_TEXT, None).tobytes().decode('utf-8')
+    offsets = _load_array(directory, _NAME_OFFSETS, None).tolist()
+    return [text[a:b] for a, b in zip(offsets[:-1], offsets[1:])]
+
+
+def _save_names(directory, names):
+    offsets = np.zeros(len(names) + 1, dtype=np.int64)
+    np.cumsum(np.fromiter(map(len, names), dtype=np.int64, count=len(names)),
+              out=offsets[1:])
+    _save_array(directory, _NAME_TEXT,
+                np.frombuffer(''.join(names).encode('utf-8'), dtype=np.uint8))
+    _save_array(directory, _NAME_OFFSETS, offsets)
+
+
+def _as_compact(tree):
+    """ tree as a CompactTree, converting it if it is a skbio.TreeNode
+    """
+    if isinstance(tree, skbio.TreeNode):
+        return CompactTree.from_treenode(tree)
+    return tree
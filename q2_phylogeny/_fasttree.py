@@ -7,32 +7,15 @@
 # ----------------------------------------------------------------------------
 
 import os
-import subprocess
 
 from q2_types.feature_data import AlignedDNAFASTAFormat
 from q2_types.tree import NewickFormat
 
+from q2_phylogeny._runner import run_command
+from q2_phylogeny._tuning import _tuned_threads
 
-def run_command(cmd, output_fp, verbose=True, env=None):
-    if verbose:
-        print("Running external command line application. This may print "
-              "messages to stdout and/or stderr.")
-        print("The command being run is below. This command cannot "
-              "be manually re-run as it will depend on temporary files that "
-              "no longer exist.")
-        print("\nCommand:", end=' ')
-        print(" ".join(cmd), end='\n\n')
-
-    with open(output_fp, 'w') as output_f:
-        subprocess.run(cmd, stdout=output_f, check=True, env=env)
-
-
-def fasttree(alignment: AlignedDNAFASTAFormat,
-             n_threads: int = 1) -> NewickFormat:
-    result = NewickFormat()
-    aligned_fp = str(alignment)
-    tree_fp = str(result)
 
+def _fasttree_command(aligned_fp, n_threads):
     env = None
     if n_threads == 1:
         cmd = ['FastTree']
@@ -45,5 +28,24 @@ def fasttree(alignment: AlignedDNAFASTAFormat,
         cmd = ['FastTreeMP']
 
     cmd.extend(['-quote', '-nt', aligned_fp])
-    run_command(cmd, tree_fp, env=env)
+    return cmd, env
+
+
+def _fasttree_pilot(aligned_fp, n_threads, temp_dir):
+    cmd, env = _fasttree_command(aligned_fp, n_threads)
+    return cmd, os.path.join(temp_dir, 'tree.nwk'), env
+
+
+def fasttree(alignment: AlignedDNAFASTAFormat,
+             n_threads: int = 1, timeout: int = None,
+             tune_threads: bool = False) -> NewickFormat:
+    result = NewickFormat()
+    aligned_fp = str(alignment)
+    tree_fp = str(result)
+
+    if tune_threads:
+        n_threads = _tuned_threads('FastTree', aligned_fp, n_threads,
+                                   _fasttree_pilot)
+    cmd, env = _fasttree_command(aligned_fp, n_threads)
+    run_command(cmd, tree_fp, env=env, timeout=timeout)
     return result
@@ -6,16 +6,95 @@
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
 
+from typing import Dict, List
+
 import biom
+import h5py
 import numpy as np
 import qiime2
 import skbio
+from scipy.sparse import csr_matrix
+from q2_types.feature_table import BIOMV210Format
+
+from q2_phylogeny._compact import (CompactTree, CompactTreeCollection,
+                                   _as_compact)
+
+
+def _read_ids(ids):
+    if ids.size > 0:
+        return np.asarray(ids.asstr()[:], dtype=object)
+    return ids[:]
+
+
+def _has_metadata(h5grp):
+    return any(len(h5grp[axis][group])
+               for axis in ('observation', 'sample')
+               for group in ('metadata', 'group-metadata'))
+
+
+def _filter_biom_observations(path, ids_to_keep):
+    """ Read only the observations of a BIOM v2.1 file that are in ids_to_keep
+
+    The observation ids and row offsets are read first, then only the CSR
+    rows of the kept observations, one slice per run of adjacent rows, so the
+    full matrix is never loaded. Tables with observation or sample metadata
+    are read in full and filtered in memory.
+    """
+    with h5py.File(str(path), 'r') as h5grp:
+        if _has_metadata(h5grp):
+            table = biom.Table.from_hdf5(h5grp)
+            ids_to_keep = set(ids_to_keep) & \
+                set(table.ids(axis='observation'))
+            table.filter(ids_to_keep, axis='observation', inplace=True)
+            return table
+
+        observation_ids = _read_ids(h5grp['observation/ids'])
+        sample_ids = _read_ids(h5grp['sample/ids'])
+        keep = np.flatnonzero(np.isin(observation_ids, list(ids_to_keep)))
+
+        matrix = h5grp['observation/matrix']
+        offsets = matrix['indptr'][:]
+        starts = offsets[keep]
+        stops = offsets[keep + 1]
+        indptr = np.zeros(len(keep) + 1, dtype=offsets.dtype)
+        np.cumsum(stops - starts, out=indptr[1:])
+
+        run_breaks = np.flatnonzero(np.diff(keep) != 1) + 1
+        run_starts = starts[np.r_[0, run_breaks]] if len(keep) else []
+        run_stops = stops[np.r_[run_breaks - 1, -1]] if len(keep) else []
+        data = np.empty(indptr[-1], dtype=matrix['data'].dtype)
+        indices = np.empty(indptr[-1], dtype=matrix['indices'].dtype)
+        position = 0
+        for start, stop in zip(run_starts, run_stops):
+            if stop == start:
+                continue
+            source = np.s_[start:stop]
+            dest = np.s_[position:position + stop - start]
+            matrix['data'].read_direct(data, source, dest)
+            matrix['indices'].read_direct(indices, source, dest)
+            position += stop - start
+
+        table_type = h5grp.attrs['type']
+        if isinstance(table_type, bytes):
+            table_type = table_type.decode('ascii')
+        table_id = h5grp.attrs['id']
+        if isinstance(table_id, bytes):
+            table_id = table_id.decode('ascii')
 
+    matrix = csr_matrix((data, indices, indptr),
+                        shape=(len(keep), len(sample_ids)))
+    return biom.Table(matrix, observation_ids[keep], sample_ids,
+                      type=table_type or None, table_id=table_id)
 
-def filter_table(table: biom.Table, tree: skbio.TreeNode) -> biom.Table:
+
+def filter_table(table: BIOMV210Format,
+                 tree: CompactTree) -> biom.Table:
     """ Filter table to remove feature ids that are not tip ids in tree
     """
-    tip_ids = set([t.name for t in tree.tips()])
+    tip_ids = set(_as_compact(tree).tip_names())
+    if not isinstance(table, biom.Table):
+        # only the rows of the kept features are read from the file
+        return _filter_biom_observations(table, tip_ids)
     feature_ids = set(table.ids(axis='observation'))
     # ids_to_keep can only include ids that are in table
     ids_to_keep = tip_ids & feature_ids
@@ -23,15 +102,100 @@ def filter_table(table: biom.Table, tree: skbio.TreeNode) -> biom.Table:
     return table
 
 
-def filter_tree(tree: skbio.TreeNode,
-                table: biom.Table = None,
-                metadata: qiime2.Metadata = None,
-                where: str = None,
-                ) -> skbio.TreeNode:
+def _merge_lengths(child, node):
+    """ Length of a branch merged with its single-child parent's branch
+
+    Follows ``skbio.TreeNode.prune``, including its handling of missing
+    lengths.
     """
-    Prunes a phylogenetic tree to match the input ids
+    if child is None or node is None:
+        return child or node
+    return child + node
+
+
+def _induced_subtree(tree, names):
+    """ The subtree of a CompactTree spanning the tips named in names
+
+    This produces the same tree as ``tree.shear(names)`` followed by
+    ``prune()``, including the order of children and the merged branch
+    lengths, without copying the input tree. Only the kept tips and their
+    ancestors are visited: they are marked by climbing from each kept tip,
+    then visited in preorder to route each kept node past any ancestors left
+    with a single kept child. The surviving nodes are gathered from the
+    input arrays, and share its name table.
     """
-    # Checks the input metadata
+    parents = tree.parents
+    tips = tree.tip_positions()
+
+    # number of kept children of every kept node
+    kept_children = {}
+    for name in set(names):
+        i = tips[name]
+        kept_children[i] = 0
+        while i:
+            parent = int(parents[i])
+            seen = parent in kept_children
+            kept_children[parent] = kept_children.get(parent, 0) + 1
+            if seen:
+                break
+            i = parent
+    if not kept_children:
+        raise ValueError('None of the ids to keep are tips in the tree.')
+    kept = sorted(kept_children)
+    kept_parents = parents[kept].tolist()
+    kept_lengths = [None if length != length else length
+                    for length in tree.lengths[kept].tolist()]
+
+    # preorder: nodes with a single kept child are collapsed, their children
+    # taking the summed length and moving to the end of the nearest surviving
+    # ancestor's children, as TreeNode.prune does
+    out_parent = {}
+    lengths = {0: kept_lengths[0]}
+    children = {}
+    moved_children = {}
+    for i, parent, length in zip(kept[1:], kept_parents[1:],
+                                 kept_lengths[1:]):
+        if parent and kept_children[parent] == 1:
+            out_parent[i] = out_parent[parent]
+            lengths[i] = _merge_lengths(length, lengths[parent])
+            siblings = moved_children
+        else:
+            out_parent[i] = parent
+            lengths[i] = length
+            siblings = children
+        if kept_children[i] != 1:
+            siblings.setdefault(out_parent[i], []).append(i)
+
+    # a root left with one child adopts it, as in TreeNode.prune
+    start = 0
+    root_children = children.get(0, []) + moved_children.get(0, [])
+    if len(root_children) == 1:
+        start = root_children[0]
+
+    nodes = []
+    new_parents = []
+    stack = [(start, -1)]
+    while stack:
+        i, parent = stack.pop()
+        nodes.append(i)
+        new_parents.append(parent)
+        position = len(nodes) - 1
+        node_children = children.get(i, []) + moved_children.get(i, [])
+        stack.extend((c, position) for c in reversed(node_children))
+    new_lengths = [lengths[i] for i in nodes]
+    new_lengths = np.array([np.nan if length is None else length
+                            for length in new_lengths], dtype=np.float64)
+    return CompactTree(new_parents, new_lengths, tree.name_ids[nodes],
+                       tree.names)
+
+
+def _check_ids_to_keep(tips, ids_to_keep):
+    if not set(tips).issuperset(set(ids_to_keep)):
+        raise ValueError('The ids for filtering must be a subset of '
+                         'the tips in the tree.')
+
+
+def _check_filter_refs(table, metadata, where):
     if ((table is None) & (metadata is None)):
         raise ValueError('A feature table, sequences or metadata must be '
                          'provided for filtering.')
@@ -43,20 +207,80 @@ def filter_tree(tree: skbio.TreeNode,
     if (where is not None) & (metadata is None):
         raise ValueError("Metadata must be provided if 'where' is specified")
 
+
+def filter_tree(tree: CompactTree,
+                table: biom.Table = None,
+                metadata: qiime2.Metadata = None,
+                where: str = None,
+                ) -> CompactTree:
+    """
+    Prunes a phylogenetic tree to match the input ids
+    """
+    # Checks the input metadata
+    _check_filter_refs(table, metadata, where)
+
     # Gets the list of IDs to keep
     if table is not None:
         ids_to_keep = table.ids(axis='observation')
     if metadata is not None:
         ids_to_keep = metadata.get_ids(where)
 
-    # Gets the list of tips
-    tip_ids = set([t.name for t in tree.tips()])
+    # every tree of a collection is filtered as it is read
+    if isinstance(tree, CompactTreeCollection):
+        return CompactTreeCollection.from_trees(
+            _filtered_tree(compact, ids_to_keep) for compact in tree)
+
+    filtered = _filtered_tree(_as_compact(tree), ids_to_keep)
+    if isinstance(tree, skbio.TreeNode):
+        return filtered.to_treenode(tree.__class__)
+    return filtered
 
+
+def _filtered_tree(tree, ids_to_keep):
     # Checks for an intersection between ids
-    if not set(tip_ids).issuperset(set(ids_to_keep)):
-        raise ValueError('The ids for filtering must be a subset of '
-                         'the tips in the tree.')
-    sub_tree = tree.shear(ids_to_keep)
-    sub_tree.prune()
+    _check_ids_to_keep(tree.tip_positions(), ids_to_keep)
+    return _induced_subtree(tree, ids_to_keep)
+
+
+def filter_tree_collection(trees: CompactTreeCollection,
+                           table: biom.Table = None,
+                           metadata: qiime2.Metadata = None,
+                           where: str = None,
+                           ) -> CompactTreeCollection:
+    """
+    Prunes every tree of a collection to match the input ids
+    """
+    return filter_tree(trees, table, metadata, where)
+
+
+def filter_tree_batch(tree: CompactTree,
+                      tables: Dict[str, biom.Table] = None,
+                      metadata: qiime2.Metadata = None,
+                      where: List[str] = None,
+                      ) -> Dict[str, CompactTree]:
+    """
+    Prunes a phylogenetic tree to each of several sets of input ids
+    """
+    _check_filter_refs(tables, metadata, where)
+    if metadata is not None and where is None:
+        raise ValueError("'where' must be provided if metadata is specified")
+
+    # Gets the lists of IDs to keep
+    if tables is not None:
+        subsets = {key: table.ids(axis='observation')
+                   for key, table in tables.items()}
+    else:
+        subsets = {'subset_%d' % d: metadata.get_ids(clause)
+                   for d, clause in enumerate(where, 1)}
 
-    return sub_tree
+    # the tree is converted and indexed once, and every subset is extracted
+    # from the same arrays
+    compact = _as_compact(tree)
+    for ids_to_keep in subsets.values():
+        _check_ids_to_keep(compact.tip_positions(), ids_to_keep)
+    filtered = {key: _induced_subtree(compact, ids_to_keep)
+                for key, ids_to_keep in subsets.items()}
+    if isinstance(tree, skbio.TreeNode):
+        filtered = {key: subtree.to_treenode(tree.__class__)
+                    for key, subtree in filtered.items()}
+    return filtered
@@ -0,0 +1,138 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016-2023, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import numpy as np
+import qiime2.plugin.model as model
+from qiime2.plugin import ValidationError
+
+from q2_phylogeny._compact import CompactTree, CompactTreeCollection
+from q2_phylogeny._newick import _read_newick, _split_newick
+
+
+class NpyFormat(model.BinaryFileFormat):
+    """ A NumPy array saved with ``numpy.save``, without pickled objects
+    """
+
+    def _validate_(self, level):
+        try:
+            np.load(str(self), mmap_mode='r', allow_pickle=False)
+        except (ValueError, EOFError, OSError) as e:
+            raise ValidationError('Not a NumPy .npy file: %s' % e)
+
+
+class CompactTreeDirectoryFormat(model.DirectoryFormat):
+    """ A tree saved by ``CompactTree.save``, one .npy file per array
+
+    The topology and branch lengths are memory-mapped when the tree is
+    loaded, so a large tree is opened without being parsed.
+    """
+    parents = model.File('parents.npy', format=NpyFormat)
+    lengths = model.File('lengths.npy', format=NpyFormat)
+    name_ids = model.File('name_ids.npy', format=NpyFormat)
+    n_children = model.File('n_children.npy', format=NpyFormat)
+    child_offsets = model.File('child_offsets.npy', format=NpyFormat)
+    children = model.File('children.npy', format=NpyFormat)
+    last_descendants = model.File('last_descendants.npy', format=NpyFormat)
+    postorder = model.File('postorder.npy', format=NpyFormat)
+    name_text = model.File('name_text.npy', format=NpyFormat)
+    name_offsets = model.File('name_offsets.npy', format=NpyFormat)
+
+    def _validate_(self, level):
+        try:
+            tree = CompactTree.load(str(self))
+        except ValueError as e:
+            raise ValidationError('Could not load the tree: %s' % e)
+        n_nodes = len(tree.parents)
+        if not n_nodes or tree.parents[0] != -1:
+            raise ValidationError('The first node must be the root.')
+        for name, size in (('lengths', n_nodes), ('name_ids', n_nodes),
+                           ('n_children', n_nodes),
+                           ('child_offsets', n_nodes + 1),
+                           ('children', n_nodes - 1),
+                           ('last_descendants', n_nodes),
+                           ('postorder', n_nodes)):
+            if getattr(tree, name).shape != (size,):
+                raise ValidationError('%s has shape %r, expected (%d,).'
+                                      % (name, getattr(tree, name).shape,
+                                         size))
+        if tree.name_ids.size and tree.name_ids.max() >= len(tree.names):
+            raise ValidationError('A name id is outside the name table.')
+        if level == 'max':
+            # the saved arrays must be those the tree's parents give
+            try:
+                expected = CompactTree(tree.parents, tree.lengths,
+                                       tree.name_ids, tree.names)
+            except ValueError as e:
+                raise ValidationError(str(e))
+            for name in ('n_children', 'child_offsets', 'children',
+                         'last_descendants', 'postorder'):
+                if not np.array_equal(getattr(tree, name),
+                                      getattr(expected, name)):
+                    raise ValidationError('%s does not match the parents.'
+                                          % name)
+
+
+class MultiNewickFormat(model.TextFileFormat):
+    """ Several Newick trees in one file, such as a set of bootstrap trees
+    """
+
+    def _validate_(self, level):
+        n_trees = 0
+        with self.open() as fh:
+            for text in _split_newick(fh):
+                try:
+                    _read_newick(text)
+                except Exception as e:
+                    raise ValidationError('Tree %d is not valid Newick: %s'
+                                          % (n_trees + 1, e))
+                n_trees += 1
+                if level == 'min':
+                    break
+        if not n_trees:
+            raise ValidationError('The file holds no trees.')
+
+
+class TreeCollectionDirectoryFormat(model.DirectoryFormat):
+    """ Trees saved by ``CompactTreeCollection.save``, one .npy file per array
+    """
+    parents = model.File('parents.npy', format=NpyFormat)
+    lengths = model.File('lengths.npy', format=NpyFormat)
+    name_ids = model.File('name_ids.npy', format=NpyFormat)
+    tree_offsets = model.File('tree_offsets.npy', format=NpyFormat)
+    name_text = model.File('name_text.npy', format=NpyFormat)
+    name_offsets = model.File('name_offsets.npy', format=NpyFormat)
+
+    def _validate_(self, level):
+        try:
+            trees = CompactTreeCollection.load(str(self))
+        except ValueError as e:
+            raise ValidationError('Could not load the trees: %s' % e)
+        n_nodes = len(trees.parents)
+        for name in ('lengths', 'name_ids'):
+            if getattr(trees, name).shape != (n_nodes,):
+                raise ValidationError('%s has shape %r, expected (%d,).'
+                                      % (name, getattr(trees, name).shape,
+                                         n_nodes))
+        offsets = trees.tree_offsets
+        if len(offsets) < 2 or offsets[0] != 0 or offsets[-1] != n_nodes or \
+                np.any(np.diff(offsets) < 1):
+            raise ValidationError('The tree offsets must run from 0 to the '
+                                  'number of nodes, with at least one node '
+                                  'per tree.')
+        if trees.name_ids.size and trees.name_ids.max() >= len(trees.names):
+            raise ValidationError('A name id is outside the name table.')
+        if level == 'max':
+            # every node but a root has a parent earlier in its own tree
+            positions = np.arange(n_nodes) - np.repeat(offsets[:-1],
+                                                       np.diff(offsets))
+            roots = positions == 0
+            if np.any(trees.parents[roots] != -1) or \
+                    np.any(trees.parents[~roots] < 0) or \
+                    np.any(trees.parents[~roots] >= positions[~roots]):
+                raise ValidationError('Nodes must be given in preorder, '
+                                      'with the root of each tree first.')
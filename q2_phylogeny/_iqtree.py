@@ -6,12 +6,15 @@
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
 
+import functools
 import os
-import tempfile
+import shutil
 
 from q2_types.feature_data import AlignedDNAFASTAFormat
 from q2_types.tree import NewickFormat
-from q2_phylogeny._raxml import run_command
+from q2_phylogeny._runner import run_command
+from q2_phylogeny._tuning import _tuned_threads
+from q2_phylogeny._workdir import _work_dir
 
 _iqtree_defaults = {
     'seed': None,
@@ -40,6 +43,9 @@ _iqtree_defaults = {
     'n_ufboot_steps': None,
     'min_cor_ufboot': None,
     'ep_break_ufboot': None,
+    'timeout': None,
+    'tune_threads': False,
+    'checkpoint_dir': None,
 }
 
 
@@ -128,6 +134,64 @@ def _build_iqtree_command(
     return cmd
 
 
+def _checkpoint_args(cmd):
+    """ The arguments of an IQ-TREE command that decide its result, without
+    the alignment's path and the number of threads
+    """
+    args = list(cmd)
+    for option in ('-s', '-nt', '--threads-max'):
+        if option in args:
+            i = args.index(option)
+            del args[i:i + 2]
+    return args
+
+
+def _run_iqtree(cmd, alignment, result, timeout, checkpoint_dir):
+    """ Run an IQ-TREE command in its work directory, and move the tree it
+    writes to result
+
+    The command's -pre is the name of its prefix in the work directory.
+    IQ-TREE resumes from the checkpoint (.ckp.gz) of an earlier run with the
+    same prefix by itself, and the tree of an earlier run that finished is
+    used as it is.
+    """
+    with _work_dir(checkpoint_dir, alignment,
+                   args=_checkpoint_args(cmd)) as work_dir:
+        cmd = list(cmd)
+        i = cmd.index('-pre') + 1
+        run_prefix = cmd[i] = os.path.join(work_dir, cmd[i])
+        tree_tmp_fp = '%s.treefile' % run_prefix
+        if os.path.exists(tree_tmp_fp) and \
+                os.path.exists('%s.iqtree' % run_prefix):
+            print("Using the tree of the earlier run that finished, %s."
+                  % tree_tmp_fp)
+        else:
+            run_command(cmd, timeout=timeout)
+        shutil.move(tree_tmp_fp, str(result))
+
+
+def _iqtree_pilot(substitution_model, alignment_fp, n_threads, temp_dir):
+    # model selection is left out, as it would take up the whole pilot run
+    if substitution_model == 'MFP':
+        substitution_model = 'GTR+G'
+    cmd = _build_iqtree_command(alignment_fp,
+                                seed=1,
+                                n_cores=n_threads,
+                                substitution_model=substitution_model,
+                                run_prefix=os.path.join(temp_dir, 'pilot'),
+                                fast=True)
+    return cmd, None, None
+
+
+def _iqtree_threads(alignment, n_cores, n_cores_max, substitution_model):
+    max_threads = n_cores
+    if n_cores == 0 and n_cores_max:
+        max_threads = n_cores_max
+    pilot = functools.partial(_iqtree_pilot, substitution_model)
+    return _tuned_threads('IQ-TREE %s' % substitution_model, str(alignment),
+                          max_threads, pilot)
+
+
 def iqtree(
     alignment: AlignedDNAFASTAFormat,
     seed: int = _iqtree_defaults['seed'],
@@ -148,35 +212,37 @@ def iqtree(
     abayes: bool = _iqtree_defaults['abayes'],
     lbp: int = _iqtree_defaults['lbp'],
     safe: bool = _iqtree_defaults['safe'],
+    timeout: int = _iqtree_defaults['timeout'],
+    tune_threads: bool = _iqtree_defaults['tune_threads'],
+    checkpoint_dir: str = _iqtree_defaults['checkpoint_dir'],
             ) -> NewickFormat:
     result = NewickFormat()
 
-    with tempfile.TemporaryDirectory() as temp_dir:
-        run_prefix = os.path.join(temp_dir, 'q2iqtree')
-        cmd = _build_iqtree_command(alignment,
-                                    seed=seed,
-                                    n_cores=n_cores,
-                                    n_cores_max=n_cores_max,
-                                    n_runs=n_runs,
-                                    substitution_model=substitution_model,
-                                    run_prefix=run_prefix,
-                                    n_init_pars_trees=n_init_pars_trees,
-                                    n_top_init_trees=n_top_init_trees,
-                                    n_best_retain_trees=n_best_retain_trees,
-                                    n_iter=n_iter,
-                                    stop_iter=stop_iter,
-                                    perturb_nni_strength=perturb_nni_strength,
-                                    spr_radius=spr_radius,
-                                    allnni=allnni,
-                                    fast=fast,
-                                    alrt=alrt,
-                                    abayes=abayes,
-                                    lbp=lbp,
-                                    safe=safe)
-        run_command(cmd)
-
-        tree_tmp_fp = os.path.join(temp_dir, '%s.treefile' % run_prefix)
-        os.rename(tree_tmp_fp, str(result))
+    if tune_threads:
+        n_cores = _iqtree_threads(alignment, n_cores, n_cores_max,
+                                  substitution_model)
+
+    cmd = _build_iqtree_command(alignment,
+                                seed=seed,
+                                n_cores=n_cores,
+                                n_cores_max=n_cores_max,
+                                n_runs=n_runs,
+                                substitution_model=substitution_model,
+                                run_prefix='q2iqtree',
+                                n_init_pars_trees=n_init_pars_trees,
+                                n_top_init_trees=n_top_init_trees,
+                                n_best_retain_trees=n_best_retain_trees,
+                                n_iter=n_iter,
+                                stop_iter=stop_iter,
+                                perturb_nni_strength=perturb_nni_strength,
+                                spr_radius=spr_radius,
+                                allnni=allnni,
+                                fast=fast,
+                                alrt=alrt,
+                                abayes=abayes,
+                                lbp=lbp,
+                                safe=safe)
+    _run_iqtree(cmd, alignment, result, timeout, checkpoint_dir)
 
     return result
 
@@ -303,41 +369,44 @@ def iqtree_ultrafast_bootstrap(
     abayes: bool = _iqtree_defaults['abayes'],
     lbp: int = _iqtree_defaults['lbp'],
     bnni: bool = _iqtree_defaults['bnni'],
-    safe: bool = _iqtree_defaults['safe']
+    safe: bool = _iqtree_defaults['safe'],
+    timeout: int = _iqtree_defaults['timeout'],
+    tune_threads: bool = _iqtree_defaults['tune_threads'],
+    checkpoint_dir: str = _iqtree_defaults['checkpoint_dir']
                                 ) -> NewickFormat:
     # NOTE: the IQ-TREE commands `-n` (called as `n_iter` in the `iqtree`
     # method) and `-fast` are not compatable with ultrafast_bootstrap `-bb`.
     result = NewickFormat()
 
-    with tempfile.TemporaryDirectory() as temp_dir:
-        run_prefix = os.path.join(temp_dir, 'q2iqtreeufboot')
-        cmd = _build_iqtree_ufbs_command(
-                    alignment,
-                    seed=seed,
-                    n_cores=n_cores,
-                    n_cores_max=n_cores_max,
-                    n_runs=n_runs,
-                    substitution_model=substitution_model,
-                    bootstrap_replicates=bootstrap_replicates,
-                    run_prefix=run_prefix,
-                    n_init_pars_trees=n_init_pars_trees,
-                    n_top_init_trees=n_top_init_trees,
-                    n_best_retain_trees=n_best_retain_trees,
-                    stop_iter=stop_iter,
-                    perturb_nni_strength=perturb_nni_strength,
-                    spr_radius=spr_radius,
-                    n_max_ufboot_iter=n_max_ufboot_iter,
-                    n_ufboot_steps=n_ufboot_steps,
-                    min_cor_ufboot=min_cor_ufboot,
-                    ep_break_ufboot=ep_break_ufboot,
-                    allnni=allnni,
-                    alrt=alrt,
-                    abayes=abayes,
-                    lbp=lbp,
-                    bnni=bnni,
-                    safe=safe)
-        run_command(cmd)
-        tree_tmp_fp = os.path.join(temp_dir, '%s.treefile' % run_prefix)
-        os.rename(tree_tmp_fp, str(result))
+    if tune_threads:
+        n_cores = _iqtree_threads(alignment, n_cores, n_cores_max,
+                                  substitution_model)
+
+    cmd = _build_iqtree_ufbs_command(
+                alignment,
+                seed=seed,
+                n_cores=n_cores,
+                n_cores_max=n_cores_max,
+                n_runs=n_runs,
+                substitution_model=substitution_model,
+                bootstrap_replicates=bootstrap_replicates,
+                run_prefix='q2iqtreeufboot',
+                n_init_pars_trees=n_init_pars_trees,
+                n_top_init_trees=n_top_init_trees,
+                n_best_retain_trees=n_best_retain_trees,
+                stop_iter=stop_iter,
+                perturb_nni_strength=perturb_nni_strength,
+                spr_radius=spr_radius,
+                n_max_ufboot_iter=n_max_ufboot_iter,
+                n_ufboot_steps=n_ufboot_steps,
+                min_cor_ufboot=min_cor_ufboot,
+                ep_break_ufboot=ep_break_ufboot,
+                allnni=allnni,
+                alrt=alrt,
+                abayes=abayes,
+                lbp=lbp,
+                bnni=bnni,
+                safe=safe)
+    _run_iqtree(cmd, alignment, result, timeout, checkpoint_dir)
 
     return result
@@ -0,0 +1,314 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016-2023, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import re
+
+import numpy as np
+import pandas as pd
+from skbio.io import NewickFormatError
+
+# quoted labels, which are kept, and comments, which are removed
+_COMMENTS = re.compile(rb"('(?:[^']|'')*')|\[[^\]]*\]")
+_QUOTE_RUNS = re.compile(r"('+)")
+_STRUCTURE = np.zeros(256, dtype=bool)
+_STRUCTURE[list(b'(),;:')] = True
+_SPACE = np.zeros(256, dtype=bool)
+_SPACE[list(b' \t\n\r\f\v')] = True
+_QUOTE = ord("'")
+_OPERATORS = re.compile(r"[,:_;()\[\]]")
+# a quoted label or comment, either of which may run past the text read so
+# far, or a semicolon outside of both
+_TREE_ENDS = re.compile(r"'(?:[^']|'')*'?|\[[^\]]*\]?|;")
+_WRITE_CHUNK = 2 ** 16
+
+
+def _quoted_name(label):
+    """ A label with quotes read as skbio reads it
+
+    Each quote opens or closes a quoted part, except that a quote following
+    another is read as a quote, whether or not it is in a quoted part, so a
+    run of quotes gives half as many quotes. Underscores become spaces
+    unless the label ends with a quote that closes a quoted part.
+    """
+    parts = _QUOTE_RUNS.split(label)
+    name = ''.join(part if i % 2 == 0 else "'" * (len(part) // 2)
+                   for i, part in enumerate(parts))
+    # the last part is empty when the label ends with a run of quotes
+    if parts[-1] or len(parts) < 2 or not len(parts[-2]) % 2:
+        name = name.replace('_', ' ')
+    return name
+
+
+def _unbalanced():
+    return NewickFormatError("Could not parse file as newick."
+                             " `(Parenthesis)`, `'single-quotes'`,"
+                             " `[comments]` may be unbalanced, or tree may"
+                             " be missing its root.")
+
+
+def _label_texts(chars, starts, stops):
+    """ The text of chars[start:stop] for each label, as a list of str
+
+    The labels are gathered into one buffer, separated by NUL bytes, which is
+    decoded and split in one call each rather than once per label.
+    """
+    if not len(starts):
+        return []
+    if np.any(chars == 0):
+        text = chars.tobytes()
+        return [text[a:b].decode('utf-8')
+                for a, b in zip(starts.tolist(), stops.tolist())]
+    bounds = np.zeros(len(chars) + 1, dtype=np.int8)
+    bounds[starts] = 1
+    bounds[stops] -= 1
+    keep = np.cumsum(bounds, dtype=np.int8).astype(bool)
+    keep[stops] = True
+    buffer = np.append(chars, np.uint8(0))
+    buffer[stops] = 0
+    return buffer[keep].tobytes().decode('utf-8').split('\0')[:-1]
+
+
+def _read_names(chars, quotes, starts, stops):
+    """ The names given by each label, as skbio reads them
+    """
+    quote_positions = np.flatnonzero(quotes)
+    n_quotes = np.searchsorted(quote_positions, stops) - \
+        np.searchsorted(quote_positions, starts)
+    names = np.empty(len(starts), dtype=object)
+    if np.any(chars == 0):
+        # labels are split on NUL bytes below, so read them one by one
+        names[:] = [_quoted_name(label)
+                    for label in _label_texts(chars, starts, stops)]
+        return names
+
+    plain = n_quotes == 0
+    if plain.any():
+        text = '\0'.join(_label_texts(chars, starts[plain], stops[plain]))
+        names[plain] = text.replace('_', ' ').split('\0')
+
+    # labels that are one quoted string, as FastTree -quote writes them;
+    # labels of quotes alone are read as runs of escaped quotes
+    quoted = ~plain & (chars[starts] == _QUOTE) & \
+        (chars[np.maximum(stops - 1, 0)] == _QUOTE) & \
+        (stops - starts > n_quotes)
+    if quoted.any():
+        text = '\0'.join(_label_texts(chars, starts[quoted] + 1,
+                                      stops[quoted] - 1))
+        if "'" in text.replace("''", ""):
+            # some quoted strings are followed by more label
+            quoted[:] = False
+        else:
+            names[quoted] = text.replace("''", "'").split('\0')
+
+    mixed = ~plain & ~quoted
+    if mixed.any():
+        names[mixed] = [_quoted_name(label) for label in
+                        _label_texts(chars, starts[mixed], stops[mixed])]
+    return names
+
+
+def _split_newick(fh):
+    """ The text of each tree in a file of several Newick trees
+
+    The file is read a line at a time, and a tree is yielded as soon as its
+    semicolon has been read, so the whole file is never held in memory.
+    """
+    pieces = []
+    for line in fh:
+        pieces.append(line)
+        if ';' not in line:
+            continue
+        text = ''.join(pieces)
+        start = 0
+        for match in _TREE_ENDS.finditer(text):
+            if match.group() == ';':
+                yield text[start:match.end()]
+                start = match.end()
+        pieces = [text[start:]]
+    text = ''.join(pieces)
+    if text.strip():
+        # without its semicolon, reading this tree raises the error
+        yield text
+
+
+def _read_newick(text):
+    """ Parent positions, lengths, name ids and name table of a Newick tree
+
+    Nodes are numbered in preorder, which is the order in which they start in
+    the text: the root, then one node per ``(`` and per ``,``. The text is
+    scanned as an array of bytes, without recursion or an object per node.
+    The quoting state of every byte is the parity of the quotes before it,
+    which also holds across escaped ``''`` quotes, so the structural
+    characters are found in one pass. Each ``,`` and ``)`` is matched to the
+    ``(`` that opened its level by a stable sort of the characters by
+    nesting level. A ``(`` starts the first child of the node before it, a
+    ``,`` starts a sibling of the child its ``(`` started, and a ``)``
+    closes the parent of that child. Every label then belongs to the node of
+    the structural character before it.
+
+    Labels are read as ``skbio.io.read(..., format='newick')`` reads them:
+    underscores in unquoted labels become spaces, quoted labels (such as
+    those written by ``FastTree -quote``) are kept as they are with ``''``
+    unescaped, and empty labels are missing.
+    """
+    if isinstance(text, str):
+        text = text.encode('utf-8')
+    if b'[' in text:
+        text = _COMMENTS.sub(lambda match: match.group(1) or b'', text)
+    chars = np.frombuffer(text, dtype=np.uint8)
+    quotes = chars == _QUOTE
+    outside = ~quotes
+    outside &= (np.cumsum(quotes, dtype=np.uint8) & 1) == 0
+
+    structure = np.flatnonzero(_STRUCTURE[chars] & outside)
+    kinds = chars[structure]
+    ends = np.flatnonzero(kinds == ord(';'))
+    if not ends.size:
+        raise _unbalanced()
+    structure = structure[:ends[0] + 1]
+    kinds = kinds[:ends[0] + 1]
+    # everything after the semicolon is ignored
+    chars = chars[:structure[-1]]
+    quotes = quotes[:structure[-1]]
+    outside = outside[:structure[-1]]
+    if np.any((chars == ord('[')) & outside):
+        raise _unbalanced()
+
+    opens = kinds == ord('(')
+    closes = kinds == ord(')')
+    commas = kinds == ord(',')
+    colons = kinds == ord(':')
+    starts_node = opens | commas
+    depths = np.cumsum(opens.astype(np.int64) - closes)
+    if np.any(depths < 0) or depths[-1] != 0:
+        raise NewickFormatError("Could not parse file as newick."
+                                " Parenthesis are unbalanced.")
+    if np.any(commas & (depths == 0)):
+        raise NewickFormatError("Could not parse file as newick."
+                                " Contains unnested children.")
+
+    # the ( that opened the level of each (, and ) character: the last (
+    # before it among the characters at its level
+    nested = np.flatnonzero(starts_node | closes)
+    levels = depths[nested] + closes[nested]
+    order = nested[np.argsort(levels, kind='stable')]
+    last_open = np.where(opens[order], np.arange(len(order)), 0)
+    np.maximum.accumulate(last_open, out=last_open)
+    matching = np.zeros(len(kinds), dtype=np.int64)
+    matching[order] = order[last_open]
+
+    # node started by each character, counting the root as node 0
+    started = np.cumsum(starts_node)
+    n_nodes = int(started[-1]) + 1
+    parents = np.empty(n_nodes, dtype=np.int64)
+    parents[0] = -1
+    parents[1:] = started[matching[starts_node]] - 1
+    # the node each structural character belongs to; a colon belongs to the
+    # node of the character before it
+    owners = np.zeros(len(kinds), dtype=np.int64)
+    owners[starts_node] = started[starts_node]
+    owners[closes] = started[matching[closes]] - 1
+    previous = np.maximum.accumulate(
+        np.where(colons, -1, np.arange(len(kinds))))
+    owners[colons] = np.where(previous[colons] >= 0,
+                              owners[np.maximum(previous[colons], 0)], 0)
+
+    # the label before each structural character, without surrounding space
+    starts = np.concatenate([[0], structure[:-1] + 1])
+    stops = structure.copy()
+    space = _SPACE[chars] & outside
+    space_positions = np.flatnonzero(space)
+    if space_positions.size:
+        solid = np.flatnonzero(~space)
+        first = np.searchsorted(solid, starts)
+        last = np.searchsorted(solid, stops) - 1
+        present = first <= last
+        starts = solid[first[present]]
+        stops = solid[last[present]] + 1
+        if np.any(np.searchsorted(space_positions, stops) >
+                  np.searchsorted(space_positions, starts)):
+            raise NewickFormatError("Newick files cannot have unescaped"
+                                    " whitespace in their labels.")
+    else:
+        present = starts < stops
+        starts = starts[present]
+        stops = stops[present]
+    label_owners = np.concatenate([[0], owners[:-1]])[present]
+    is_length = np.concatenate([[False], colons[:-1]])[present]
+
+    lengths = np.full(n_nodes, np.nan)
+    length_labels = _label_texts(chars, starts[is_length], stops[is_length])
+    try:
+        lengths[label_owners[is_length]] = np.fromiter(
+            map(float, length_labels), dtype=np.float64,
+            count=len(length_labels))
+    except ValueError:
+        for label in length_labels:
+            try:
+                float(label)
+            except ValueError:
+                raise NewickFormatError("Could not read length as numeric "
+                                        "type: %s." % label)
+        raise
+
+    names = _read_names(chars, quotes, starts[~is_length], stops[~is_length])
+    # empty quoted labels are missing names
+    names[names == ''] = None
+    ids, table = pd.factorize(names)
+    name_ids = np.full(n_nodes, -1, dtype=np.int64)
+    name_ids[label_owners[~is_length]] = ids
+    return parents, lengths, name_ids, table.tolist()
+
+
+def _format_name(name):
+    """ A name as ``skbio.io.write(..., format='newick')`` writes it
+    """
+    if not name:
+        return ''
+    escaped = name.replace("'", "''")
+    if _OPERATORS.search(name):
+        return "'%s'" % escaped
+    return escaped.replace(" ", "_")
+
+
+def _write_newick(fh, tree):
+    """ Write a CompactTree to fh in Newick format
+
+    The output is the same as that of ``skbio.io.write`` for the equivalent
+    TreeNode. Every name in the tree's name table is formatted once. The
+    text of each node's start, in preorder, is then merged with that of each
+    internal node's end, which follows its last descendant, ends closing from
+    the deepest out, and the pieces are written without visiting the tree
+    node by node.
+    """
+    n_nodes = len(tree.parents)
+    names = np.array([_format_name(name) for name in tree.names] + [''],
+                     dtype=object)
+    lengths = ':' + np.array(list(map(repr, tree.lengths.tolist())),
+                             dtype=object)
+    lengths[np.isnan(tree.lengths)] = ''
+    labels = names[tree.name_ids] + lengths
+
+    internal = tree.n_children > 0
+    starts = np.where(internal, '(', labels)
+    # every node but a first child follows a comma
+    after_comma = np.ones(n_nodes, dtype=bool)
+    after_comma[0] = False
+    after_comma[1:] = tree.parents[1:] != np.arange(n_nodes - 1)
+    starts[after_comma] = ',' + starts[after_comma]
+    ends = ')' + labels[internal]
+
+    post = np.empty(n_nodes, dtype=np.int64)
+    post[tree.postorder] = np.arange(n_nodes)
+    order = np.lexsort((
+        np.concatenate([np.full(n_nodes, -1), post[internal]]),
+        np.concatenate([np.arange(n_nodes), tree.last_descendants[internal]])))
+    pieces = np.concatenate([starts, ends])[order].tolist()
+    for i in range(0, len(pieces), _WRITE_CHUNK):
+        fh.write(''.join(pieces[i:i + _WRITE_CHUNK]))
+    fh.write(';\n')
@@ -6,33 +6,35 @@
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
 
+import functools
+import glob
 import os
-import tempfile
+import re
+import shutil
+import signal
 import subprocess
 
-from random import randint
-
 from q2_types.feature_data import AlignedDNAFASTAFormat
 from q2_types.tree import NewickFormat
 from qiime2.plugin import get_available_cores
 
+from q2_phylogeny._runner import run_command, run_concurrently
+from q2_phylogeny._tuning import _tuned_threads
+from q2_phylogeny._workdir import _work_dir, _run_seed
+
 _raxml_versions = {
                    'Standard': '',
                    'SSE3': '-SSE3',
                    'AVX2': '-AVX2'
                    }
-
-
-def run_command(cmd, verbose=True):
-    if verbose:
-        print("Running external command line application. This may print "
-              "messages to stdout and/or stderr.")
-        print("The command being run is below. This command cannot "
-              "be manually re-run as it will depend on temporary files that "
-              "no longer exist.")
-        print("\nCommand:", end=' ')
-        print(" ".join(cmd), end='\n\n')
-    subprocess.run(cmd, check=True)
+# the versions raxml_version='auto' chooses from, fastest first, with the
+# /proc/cpuinfo flag each needs (SSE3 is listed as pni)
+_raxml_auto_versions = (('AVX2', 'avx2'), ('SSE3', 'pni'), ('Standard', None))
+# versions that have died with an illegal instruction in this process
+_raxml_illegal_versions = set()
+# the log-likelihood of the best tree of a search, as RAxML_info reports it
+_raxml_final_score = re.compile(
+    r'Final \S+ Score of best tree (-?\d+(?:\.\d*)?)')
 
 
 def _set_raxml_version(raxml_version='Standard', n_threads=1):
@@ -48,31 +50,253 @@ def _set_raxml_version(raxml_version='Standard', n_threads=1):
         return cmd
 
 
+@functools.lru_cache(maxsize=None)
+def _cpu_flags():
+    """ The CPU feature flags listed in /proc/cpuinfo, or none if it cannot
+    be read
+    """
+    try:
+        with open('/proc/cpuinfo') as fh:
+            for line in fh:
+                if line.startswith('flags'):
+                    return frozenset(line.split(':', 1)[1].split())
+    except OSError:
+        pass
+    return frozenset()
+
+
+@functools.lru_cache(maxsize=None)
+def _supported_raxml_versions(pthreads):
+    """ The RAxML versions that are installed and that this CPU supports,
+    fastest first
+    """
+    flags = _cpu_flags()
+    versions = []
+    for version, flag in _raxml_auto_versions:
+        binary = 'raxmlHPC%s%s' % ('-PTHREADS' if pthreads else '',
+                                   _raxml_versions[version])
+        if (flag is None or flag in flags) and shutil.which(binary):
+            versions.append(version)
+    return tuple(versions)
+
+
+def _raxml_versions_to_try(raxml_version, n_threads):
+    if raxml_version != 'auto':
+        return [raxml_version]
+    versions = [version for version in _supported_raxml_versions(n_threads > 1)
+                if version not in _raxml_illegal_versions]
+    # with nothing found, run the standard version so that the error is the
+    # one it gives
+    return versions or ['Standard']
+
+
+def _worker_threads(n_threads, n_workers):
+    """ The threads each of n_workers RAxML processes that run at the same
+    time is given, so that with n_threads=0 they share the cores rather than
+    each running a thread per core
+    """
+    if n_threads == 0:
+        return max(1, get_available_cores() // n_workers)
+    return n_threads
+
+
+def _run_raxml(args, raxml_version, n_threads, temp_dir, runname, timeout,
+               stop=None):
+    """ Run RAxML with args, choosing its version if raxml_version is 'auto'
+
+    An automatically chosen version that dies with an illegal instruction is
+    not chosen again in this process, and the run is repeated with the next
+    fastest version.
+    """
+    if n_threads == 0:
+        n_threads = get_available_cores()
+    versions = _raxml_versions_to_try(raxml_version, n_threads)
+    for i, version in enumerate(versions):
+        cmd = _set_raxml_version(raxml_version=version, n_threads=n_threads)
+        try:
+            return run_command(cmd + args, timeout=timeout, stop=stop)
+        except subprocess.CalledProcessError as e:
+            if e.returncode != -signal.SIGILL or i == len(versions) - 1:
+                raise
+            _raxml_illegal_versions.add(version)
+            print("%s stopped with an illegal instruction, so RAxML will be "
+                  "run again with the %s version." % (cmd[0], versions[i + 1]))
+            # RAxML will not overwrite the files of an earlier run
+            for fp in glob.glob(os.path.join(temp_dir, '*.' + runname)):
+                os.remove(fp)
+
+
+def _raxml_pilot(substitution_model, raxml_version, alignment_fp, n_threads,
+                 temp_dir):
+    version = _raxml_versions_to_try(raxml_version, n_threads)[0]
+    cmd = _set_raxml_version(raxml_version=version, n_threads=n_threads)
+    cmd += ['-m', str(substitution_model),
+            '-p', '1',
+            '-N', '1',
+            '-s', alignment_fp,
+            '-w', temp_dir,
+            '-n', 'pilot']
+    return cmd, None, None
+
+
+def _raxml_threads(alignment, n_threads, raxml_version, substitution_model):
+    pilot = functools.partial(_raxml_pilot, substitution_model,
+                              raxml_version)
+    return _tuned_threads('RAxML %s' % substitution_model, str(alignment),
+                          n_threads, pilot)
+
+
+def _final_likelihood(info_fp):
+    with open(info_fp) as fh:
+        scores = _raxml_final_score.findall(fh.read())
+    if not scores:
+        raise ValueError('No final likelihood was found in %s.' % info_fp)
+    return float(scores[-1])
+
+
+def _raxml_attempts(work_dir, runname):
+    """ The run names of the attempts at a run that were started in work_dir,
+    oldest first, and the run name for the next attempt
+    """
+    attempts = []
+    name = runname
+    while os.path.exists(os.path.join(work_dir, 'RAxML_info.%s' % name)):
+        attempts.append(name)
+        name = '%s.r%d' % (runname, len(attempts))
+    return attempts, name
+
+
+def _latest_checkpoint(work_dir, attempts):
+    """ The intermediate tree that attempts at a run wrote last with -j, or
+    None if they wrote none
+    """
+    checkpoints = []
+    for name in attempts:
+        pattern = re.compile(re.escape('RAxML_checkpoint.%s.' % name) +
+                             r'\d+$')
+        checkpoints.extend(os.path.join(work_dir, fn)
+                           for fn in os.listdir(work_dir)
+                           if pattern.match(fn))
+    if not checkpoints:
+        return None
+    return max(checkpoints, key=lambda fp: (os.path.getmtime(fp),
+                                            int(fp.rsplit('.', 1)[1])))
+
+
+def _n_trees(tree_fp):
+    try:
+        with open(tree_fp) as fh:
+            return sum(1 for line in fh if line.rstrip().endswith(';'))
+    except FileNotFoundError:
+        return 0
+
+
+def _resumable_raxml(args, runname, finished, raxml_version, n_threads,
+                     work_dir, timeout, stop=None, checkpoint=False):
+    """ Run RAxML with args as runname in work_dir, unless an earlier attempt
+    at the run finished, and return the run name of the attempt that did
+
+    Whether an attempt finished is given by finished(name). Each attempt
+    has its own run name, as RAxML will not overwrite the files of an
+    earlier run. With checkpoint, RAxML writes its intermediate trees (-j),
+    and an attempt starts from the last tree that earlier attempts wrote.
+    """
+    attempts, name = _raxml_attempts(work_dir, runname)
+    for attempt in attempts:
+        if finished(attempt):
+            return attempt
+    args = args + ['-w', work_dir, '-n', name]
+    if checkpoint:
+        args.append('-j')
+        latest = _latest_checkpoint(work_dir, attempts)
+        if latest is not None:
+            print("Resuming %s from %s." % (runname, latest))
+            args += ['-t', latest]
+    _run_raxml(args, raxml_version, n_threads, work_dir, name, timeout,
+               stop=stop)
+    return name
+
+
+def _concurrent_searches(alignment, seed, n_searches, n_search_workers,
+                         n_threads, raxml_version, substitution_model,
+                         work_dir, timeout, checkpoint=False):
+    """ Run each search as its own RAxML process, with seed seed + i, at
+    most n_search_workers at a time, and return the path of the tree with
+    the highest likelihood
+    """
+    n_threads = _worker_threads(n_threads, min(n_search_workers, n_searches))
+
+    def finished(name):
+        return os.path.exists(os.path.join(work_dir,
+                                           'RAxML_bestTree.%s' % name))
+
+    def search(i, stop):
+        args = ['-m', str(substitution_model),
+                '-p', str(seed + i),
+                '-N', '1',
+                '-s', str(alignment)]
+        return _resumable_raxml(args, 'q2.%d' % i, finished, raxml_version,
+                                n_threads, work_dir, timeout, stop=stop,
+                                checkpoint=checkpoint)
+
+    runnames = run_concurrently(
+        [functools.partial(search, i) for i in range(n_searches)],
+        n_search_workers)
+    likelihoods = [_final_likelihood(
+        os.path.join(work_dir, 'RAxML_info.%s' % runname))
+        for runname in runnames]
+    best = likelihoods.index(max(likelihoods))
+    print("The search with seed %d found the tree with the highest "
+          "likelihood, %f." % (seed + best, likelihoods[best]))
+    return os.path.join(work_dir, 'RAxML_bestTree.%s' % runnames[best])
+
+
 def raxml(alignment: AlignedDNAFASTAFormat,
           seed: int = None,
           n_searches: int = 1,
           n_threads: int = 1,
           raxml_version: str = 'Standard',
-          substitution_model: str = 'GTRGAMMA') -> NewickFormat:
+          substitution_model: str = 'GTRGAMMA',
+          timeout: int = None,
+          tune_threads: bool = False,
+          n_search_workers: int = 1,
+          checkpoint_dir: str = None) -> NewickFormat:
     result = NewickFormat()
 
-    cmd = _set_raxml_version(raxml_version=raxml_version, n_threads=n_threads)
-
-    if seed is None:
-        seed = randint(1000, 10000)
+    if tune_threads:
+        n_threads = _raxml_threads(alignment, n_threads, raxml_version,
+                                   substitution_model)
 
     runname = 'q2'
-    with tempfile.TemporaryDirectory() as temp_dir:
-        cmd += ['-m', str(substitution_model),
-                '-p', str(seed),
-                '-N', str(n_searches),
-                '-s', str(alignment),
-                '-w', temp_dir,
-                '-n', runname]
-        run_command(cmd)
+    with _work_dir(checkpoint_dir, alignment, action='raxml', seed=seed,
+                   n_searches=n_searches,
+                   substitution_model=substitution_model) as work_dir:
+        seed = _run_seed(work_dir, 'seed', seed)
+        if n_search_workers > 1 and n_searches > 1:
+            tree_tmp_fp = _concurrent_searches(
+                alignment, seed, n_searches, n_search_workers, n_threads,
+                raxml_version, substitution_model, work_dir, timeout,
+                checkpoint=checkpoint_dir is not None)
+        else:
+            args = ['-m', str(substitution_model),
+                    '-p', str(seed),
+                    '-N', str(n_searches),
+                    '-s', str(alignment)]
 
-        tree_tmp_fp = os.path.join(temp_dir, 'RAxML_bestTree.%s' % runname)
-        os.rename(tree_tmp_fp, str(result))
+            def finished(name):
+                return os.path.exists(os.path.join(
+                    work_dir, 'RAxML_bestTree.%s' % name))
+
+            # RAxML can only restart a single search from its last
+            # intermediate tree, so several searches in one run are run
+            # again from the start
+            runname = _resumable_raxml(
+                args, runname, finished, raxml_version, n_threads, work_dir,
+                timeout,
+                checkpoint=checkpoint_dir is not None and n_searches == 1)
+            tree_tmp_fp = os.path.join(work_dir,
+                                       'RAxML_bestTree.%s' % runname)
+        shutil.move(tree_tmp_fp, str(result))
 
     return result
 
@@ -91,31 +315,124 @@ def _build_rapid_bootstrap_command(alignment, seed, rapid_bootstrap_seed,
     return cmd
 
 
+def _sharded_rapid_bootstrap(alignment, seed, rapid_bootstrap_seed,
+                             bootstrap_replicates, n_bootstrap_shards,
+                             n_threads, raxml_version, substitution_model,
+                             work_dir, runname, timeout, checkpoint=False):
+    """ Run the bootstrap replicates in shards, each its own RAxML process,
+    at the same time as a search for the best tree, then map the support of
+    all replicates onto that tree, and return the path of the result
+
+    Shard k draws its replicates with rapid_bootstrap_seed + k, so that no
+    two shards draw the same replicates. A shard that an earlier attempt
+    finished is not run again.
+    """
+    n_shards = min(n_bootstrap_shards, bootstrap_replicates)
+    sizes = [bootstrap_replicates // n_shards +
+             (k < bootstrap_replicates % n_shards) for k in range(n_shards)]
+    # the shards and the search run at the same time
+    worker_threads = _worker_threads(n_threads, n_shards + 1)
+
+    def output_exists(prefix, name):
+        return os.path.exists(os.path.join(work_dir,
+                                           '%s.%s' % (prefix, name)))
+
+    def shard(k, stop):
+        def finished(name):
+            return _n_trees(os.path.join(
+                work_dir, 'RAxML_bootstrap.%s' % name)) == sizes[k]
+
+        args = ['-m', str(substitution_model),
+                '-p', str(seed + k),
+                '-x', str(rapid_bootstrap_seed + k),
+                '-N', str(sizes[k]),
+                '-s', str(alignment)]
+        return _resumable_raxml(args, '%s.%d' % (runname, k), finished,
+                                raxml_version, worker_threads, work_dir,
+                                timeout, stop=stop)
+
+    def search(stop):
+        args = ['-m', str(substitution_model),
+                '-p', str(seed),
+                '-s', str(alignment)]
+        return _resumable_raxml(args, '%s.search' % runname,
+                                functools.partial(output_exists,
+                                                  'RAxML_bestTree'),
+                                raxml_version, worker_threads, work_dir,
+                                timeout, stop=stop, checkpoint=checkpoint)
+
+    search_name, *shard_names = run_concurrently(
+        [search] + [functools.partial(shard, k) for k in range(n_shards)],
+        n_shards + 1)
+
+    bootstrap_fp = os.path.join(work_dir, 'bootstrap_trees.%s' % runname)
+    with open(bootstrap_fp, 'w') as out:
+        for name in shard_names:
+            with open(os.path.join(work_dir,
+                                   'RAxML_bootstrap.%s' % name)) as fh:
+                shutil.copyfileobj(fh, out)
+
+    args = ['-f', 'b',  # draw the support of the replicates on the tree
+            '-m', str(substitution_model),
+            '-t', os.path.join(work_dir, 'RAxML_bestTree.%s' % search_name),
+            '-z', bootstrap_fp]
+    name = _resumable_raxml(args, runname,
+                            functools.partial(output_exists,
+                                              'RAxML_bipartitions'),
+                            raxml_version, n_threads, work_dir, timeout)
+    return os.path.join(work_dir, 'RAxML_bipartitions.%s' % name)
+
+
 def raxml_rapid_bootstrap(alignment: AlignedDNAFASTAFormat,
                           seed: int = None, rapid_bootstrap_seed: int = None,
                           bootstrap_replicates: int = 100, n_threads: int = 1,
                           raxml_version: str = 'Standard',
-                          substitution_model: str = 'GTRGAMMA'
-                          ) -> NewickFormat:
+                          substitution_model: str = 'GTRGAMMA',
+                          timeout: int = None,
+                          tune_threads: bool = False,
+                          n_bootstrap_shards: int = 1,
+                          checkpoint_dir: str = None) -> NewickFormat:
     result = NewickFormat()
-    cmd = _set_raxml_version(raxml_version=raxml_version, n_threads=n_threads)
-
-    if seed is None:
-        seed = randint(1000, 10000)
 
-    if rapid_bootstrap_seed is None:
-        rapid_bootstrap_seed = randint(1000, 10000)
+    if tune_threads:
+        n_threads = _raxml_threads(alignment, n_threads, raxml_version,
+                                   substitution_model)
 
     runname = 'q2bootstrap'
-    with tempfile.TemporaryDirectory() as temp_dir:
-        cmd += _build_rapid_bootstrap_command(alignment, seed,
-                                              rapid_bootstrap_seed,
-                                              bootstrap_replicates,
-                                              substitution_model, temp_dir,
-                                              runname)
-        run_command(cmd)
-
-        tree_tmp_fp = os.path.join(temp_dir, 'RAxML_bipartitions.%s' % runname)
-        os.rename(tree_tmp_fp, str(result))
+    with _work_dir(checkpoint_dir, alignment,
+                   action='raxml_rapid_bootstrap', seed=seed,
+                   rapid_bootstrap_seed=rapid_bootstrap_seed,
+                   bootstrap_replicates=bootstrap_replicates,
+                   n_bootstrap_shards=n_bootstrap_shards,
+                   substitution_model=substitution_model) as work_dir:
+        seed = _run_seed(work_dir, 'seed', seed)
+        rapid_bootstrap_seed = _run_seed(work_dir, 'rapid_bootstrap_seed',
+                                         rapid_bootstrap_seed)
+        if n_bootstrap_shards > 1 and bootstrap_replicates > 1:
+            tree_tmp_fp = _sharded_rapid_bootstrap(
+                alignment, seed, rapid_bootstrap_seed, bootstrap_replicates,
+                n_bootstrap_shards, n_threads, raxml_version,
+                substitution_model, work_dir, runname, timeout,
+                checkpoint=checkpoint_dir is not None)
+        else:
+            # an earlier attempt that finished is used, and otherwise the
+            # whole run is made again, as RAxML cannot restart it part way
+            attempts, name = _raxml_attempts(work_dir, runname)
+            finished = [attempt for attempt in attempts
+                        if os.path.exists(os.path.join(
+                            work_dir, 'RAxML_bipartitions.%s' % attempt))]
+            if finished:
+                name = finished[0]
+            else:
+                args = _build_rapid_bootstrap_command(alignment, seed,
+                                                      rapid_bootstrap_seed,
+                                                      bootstrap_replicates,
+                                                      substitution_model,
+                                                      work_dir, name)
+                _run_raxml(args, raxml_version, n_threads, work_dir, name,
+                           timeout)
+            tree_tmp_fp = os.path.join(work_dir,
+                                       'RAxML_bipartitions.%s' % name)
+        shutil.move(tree_tmp_fp, str(result))
 
     return result
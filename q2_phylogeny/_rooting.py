@@ -0,0 +1,234 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016-2023, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import numpy as np
+
+from q2_phylogeny._compact import CompactTree, _pointer_jump
+from q2_phylogeny._util import _reroot, _unrooted_tree, _insert_root
+
+_EMPTY = (0, 0.0, 0.0)
+# the most pairs of tips whose distances MAD rooting holds at once
+_PAIR_BLOCK = 2 ** 18
+
+
+def _merge(a, b):
+    """ Tip count, mean and sum of squared deviations of two sets of tip
+    distances combined
+    """
+    n_a, mean_a, m2_a = a
+    n_b, mean_b, m2_b = b
+    if not n_a:
+        return b
+    if not n_b:
+        return a
+    n = n_a + n_b
+    delta = mean_b - mean_a
+    return (n, mean_a + delta * n_b / n,
+            m2_a + m2_b + delta * delta * n_a * n_b / n)
+
+
+def _branch_moments(lengths, parents, children):
+    """ Moments of the distances to the tips on either side of every branch
+
+    For each node v, returns the tip count, mean distance and sum of squared
+    deviations of the tips below v measured from v, and of the tips not below
+    v measured from v's parent. Both are found in O(n), the first in
+    postorder and the second in preorder, from each parent's moments and the
+    prefix and suffix merges of its children's.
+    """
+    n_nodes = len(parents)
+    down = [_EMPTY] * n_nodes
+    for v in range(n_nodes - 1, -1, -1):
+        if not children[v]:
+            down[v] = (1, 0.0, 0.0)
+            continue
+        moments = _EMPTY
+        for c in children[v]:
+            count, mean, m2 = down[c]
+            moments = _merge(moments, (count, mean + lengths[c], m2))
+        down[v] = moments
+
+    up = [_EMPTY] * n_nodes
+    for p in range(n_nodes):
+        node_children = children[p]
+        if not node_children:
+            continue
+        if p:
+            count, mean, m2 = up[p]
+            above = (count, mean + lengths[p], m2)
+        else:
+            above = _EMPTY
+        shifted = []
+        for c in node_children:
+            count, mean, m2 = down[c]
+            shifted.append((count, mean + lengths[c], m2))
+        suffix = [_EMPTY] * (len(shifted) + 1)
+        for i in range(len(shifted) - 1, -1, -1):
+            suffix[i] = _merge(shifted[i], suffix[i + 1])
+        prefix = above
+        for i, c in enumerate(node_children):
+            up[c] = _merge(prefix, suffix[i + 1])
+            prefix = _merge(prefix, shifted[i])
+    return down, up
+
+
+def _best_position(length, down, up):
+    """ Distance above a node on its branch that balances the mean root-to-tip
+    distances on either side, and the squared imbalance left there
+    """
+    imbalance = down[1] - up[1] - length
+    distance = min(max(-imbalance / 2.0, 0.0), length)
+    imbalance += 2.0 * distance
+    return distance, imbalance * imbalance
+
+
+def _root_on_branch(tree, children, node, distance):
+    names = tree.node_names()
+    lengths = tree.length_list()
+    parents = tree.parents.tolist()
+    if distance == 0.0 and children[node]:
+        return _unrooted_tree(names, lengths, parents, children, node)
+    # a tip is never made the root: the root goes on the tip's branch, or at
+    # its parent where the branch has no length
+    if distance == lengths[node] or (distance == 0.0 and not lengths[node]):
+        return _unrooted_tree(names, lengths, parents, children,
+                              parents[node])
+    return _insert_root(names, lengths, parents, children, node, distance)
+
+
+def _min_variance_rooted(tree):
+    """ A tree rooted where the variance of root-to-tip distances is smallest
+
+    On each branch the variance is a quadratic in the root position, smallest
+    where the mean distances to the tips on either side are balanced. The
+    branch moments give its minimum on every branch in O(n).
+    """
+    parents = tree.parents.tolist()
+    children = tree.children_lists()
+    branch_lengths = tree.branch_lengths().tolist()
+    down, up = _branch_moments(branch_lengths, parents, children)
+
+    best = None
+    for v in range(1, len(parents)):
+        if not up[v][0]:
+            continue
+        distance, imbalance2 = _best_position(branch_lengths[v], down[v],
+                                              up[v])
+        m, k = down[v][0], up[v][0]
+        n = m + k
+        variance = (down[v][2] + up[v][2] + m * k / n * imbalance2) / n
+        if best is None or variance < best[0]:
+            best = (variance, v, distance)
+    if best is None:
+        return None
+    _, v, distance = best
+    return _root_on_branch(tree, children, v, distance)
+
+
+def _pair_sums(tree, depths, tips):
+    """ Sums over the pairs of tips, with the tree rooted as it is
+
+    For tips b and c, with w = 1 / d(b, c) ** 2 and e = w * (2 d(b, root) -
+    d(b, c)), returns the sums of w and e over the pairs meeting at each
+    node, counting each pair once with either tip as b, the sums of w and e
+    over every other tip c for each tip b, and the sum of squared ancestor
+    deviations. Pairs at distance zero are left out, and the pairs are
+    taken in blocks of at most _PAIR_BLOCK.
+    """
+    n_nodes = len(depths)
+    meeting = np.zeros((n_nodes, 2))
+    tip_sums = np.zeros((n_nodes, 2))
+    deviation = 0.0
+    first = np.searchsorted(tips, np.arange(n_nodes))
+    end = np.searchsorted(tips, tree.last_descendants, side='right')
+    children = tree.children_lists()
+    for p in np.flatnonzero(tree.n_children > 1).tolist():
+        for c in children[p][:-1]:
+            cols = tips[end[c]:end[p]]
+            block = max(1, _PAIR_BLOCK // len(cols))
+            for start in range(first[c], end[c], block):
+                rows = tips[start:min(start + block, end[c])]
+                diff = depths[rows][:, None] - depths[cols][None, :]
+                distance = depths[rows][:, None] + depths[cols][None, :] - \
+                    2.0 * depths[p]
+                w = np.zeros_like(distance)
+                np.divide(1.0, distance * distance, out=w,
+                          where=distance > 0)
+                deviation += (w * diff * diff).sum()
+                for sign, axis, ends in ((1.0, 1, rows), (-1.0, 0, cols)):
+                    weighted = w * (sign * diff + 2.0 * depths[p])
+                    sums = (w.sum(axis=axis), weighted.sum(axis=axis))
+                    tip_sums[ends, 0] += sums[0]
+                    tip_sums[ends, 1] += sums[1]
+                    meeting[p, 0] += sums[0].sum()
+                    meeting[p, 1] += sums[1].sum()
+    return meeting, tip_sums, deviation
+
+
+def _mad_rooted(tree):
+    """ A tree rooted where the ancestor deviation of tip pairs is smallest
+
+    For a root r, tips b and c meet at the point a of the path between them
+    nearest to r, and deviate from a clock by ``(d(b, a) - d(c, a)) / d(b,
+    c)``, which is ``(d(b, r) - d(c, r)) / d(b, c)``. MAD roots the tree
+    where the sum of squared deviations over all pairs of tips is smallest.
+    As the root moves along the branch above node v, only the pairs with b
+    below v and c elsewhere change, and their sum is a quadratic in the
+    root's distance t above v, ``4 t (S1 + t S0)`` relative to v, where S0
+    is the sum of w = 1 / d(b, c) ** 2 over the pairs and S1 that of
+    ``w * (2 d(b, v) - d(b, c))``. Both follow from sums over the pairs
+    meeting at each node, and give the sum at every node from that at the
+    root, so every branch is optimized exactly. Every pair of tips is
+    visited once, so this takes time quadratic in the number of tips.
+    """
+    tips = tree.tips()
+    parents = tree.parents
+    branch_lengths = tree.branch_lengths()
+    branch_lengths[0] = 0.0
+    depths = _pointer_jump(parents, branch_lengths)
+    meeting, tip_sums, root_deviation = _pair_sums(tree, depths, tips)
+
+    # S0 and S1 for the pairs crossing each node's branch, from the pairs
+    # with b below it less those with c below it too
+    crossing = tip_sums - meeting
+    for v, p in reversed(list(enumerate(parents.tolist()))[1:]):
+        crossing[p] += crossing[v]
+    s0 = crossing[:, 0]
+    s1 = crossing[:, 1] - 2.0 * depths * s0
+    # the sum with the root at each node, from that at its parent
+    change = -4.0 * branch_lengths * (s1 + branch_lengths * s0)
+    change[0] = 0.0
+    at_node = root_deviation + _pointer_jump(parents, change)
+
+    candidates = np.flatnonzero(s0[1:] > 0) + 1
+    if not candidates.size:
+        return None
+    s0, s1 = s0[candidates], s1[candidates]
+    distances = np.clip(-s1 / (2.0 * s0), 0.0,
+                        branch_lengths[candidates])
+    deviations = at_node[candidates] + \
+        4.0 * distances * (s1 + distances * s0)
+    best = int(np.argmin(deviations))
+    return _root_on_branch(tree, tree.children_lists(),
+                           int(candidates[best]), float(distances[best]))
+
+
+def min_variance_root(tree: CompactTree) -> CompactTree:
+    """ Root tree where the variance of root-to-tip distances is smallest
+
+    A skbio.TreeNode is also accepted, in which case one is returned.
+    """
+    return _reroot(tree, _min_variance_rooted)
+
+
+def mad_root(tree: CompactTree) -> CompactTree:
+    """ Root tree where the ancestor deviation of tip pairs is smallest
+
+    A skbio.TreeNode is also accepted, in which case one is returned.
+    """
+    return _reroot(tree, _mad_rooted)
@@ -0,0 +1,242 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016-2023, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import collections
+import concurrent.futures
+import contextlib
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+# ru_maxrss is in kilobytes, except on macOS where it is in bytes
+_RSS_BYTES = 1 if sys.platform == 'darwin' else 1024
+
+# seconds a command is given to exit after SIGTERM before it is killed
+_TERMINATE_GRACE = 5.0
+# seconds between checks of whether a command should be stopped
+_STOP_POLL = 0.1
+
+# how an external command ran: wall_time and cpu_time (user plus system) are
+# in seconds, and max_rss is the command's peak resident set size in bytes
+RunRecord = collections.namedtuple(
+    'RunRecord', ['cmd', 'returncode', 'wall_time', 'cpu_time', 'max_rss',
+                  'log_fp'])
+
+
+class CommandTimeoutError(subprocess.TimeoutExpired):
+    """ Raised when a command is stopped for running past its timeout
+    """
+
+    def __init__(self, cmd, timeout, elapsed):
+        super().__init__(cmd, timeout)
+        self.elapsed = elapsed
+
+    def __str__(self):
+        return ("The command %r was stopped after running for %.1f seconds, "
+                "exceeding its timeout of %s seconds." %
+                (' '.join(self.cmd), self.elapsed, self.timeout))
+
+
+def _exit_code(status):
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def _stream(pipe, echo, log, lock):
+    """ Copy each line of pipe to echo, and to log if there is one, as soon
+    as it is read
+    """
+    for line in pipe:
+        with lock:
+            if log is not None:
+                log.write(line)
+                log.flush()
+            echo.write(line)
+            echo.flush()
+    pipe.close()
+
+
+def _stop_group(proc, waiter):
+    """ Send SIGTERM to the command's process group, then SIGKILL if the
+    command has not exited within the grace period
+    """
+    for sig, grace in ((signal.SIGTERM, _TERMINATE_GRACE),
+                       (signal.SIGKILL, None)):
+        try:
+            os.killpg(proc.pid, sig)
+        except ProcessLookupError:
+            pass
+        waiter.join(grace)
+        if not waiter.is_alive():
+            return
+
+
+def _wait(waiter, timeout, stop):
+    """ Wait for the command to be reaped, for at most timeout seconds, or
+    until the event stop is set
+    """
+    if stop is None:
+        waiter.join(timeout)
+        return
+    deadline = None if timeout is None else time.monotonic() + timeout
+    while waiter.is_alive() and not stop.is_set():
+        wait = _STOP_POLL
+        if deadline is not None:
+            wait = min(wait, deadline - time.monotonic())
+            if wait <= 0:
+                return
+        waiter.join(wait)
+
+
+@contextlib.contextmanager
+def _exit_on_sigterm():
+    """ Turn SIGTERM into SystemExit while a command runs, so that the
+    command is stopped rather than orphaned when this process is terminated
+
+    Signal handlers can only be set from the main thread, so elsewhere
+    this does nothing.
+    """
+    if threading.current_thread() is not threading.main_thread():
+        yield
+        return
+
+    def _exit(signum, frame):
+        sys.exit(128 + signum)
+
+    previous = signal.signal(signal.SIGTERM, _exit)
+    try:
+        yield
+    finally:
+        signal.signal(signal.SIGTERM, previous)
+
+
+def _print_command(cmd):
+    print("Running external command line application. This may print "
+          "messages to stdout and/or stderr.")
+    print("The command being run is below. This command cannot "
+          "be manually re-run as it will depend on temporary files that "
+          "no longer exist.")
+    print("\nCommand:", end=' ')
+    print(" ".join(cmd), end='\n\n')
+
+
+def _print_record(record):
+    print("\nFinished in %.1fs (%.1fs of CPU time), using at most %.1f MiB."
+          % (record.wall_time, record.cpu_time, record.max_rss / 2 ** 20))
+
+
+def run_command(cmd, output_fp=None, verbose=True, env=None, log_fp=None,
+                timeout=None, echo=True, stop=None):
+    """ Run cmd, streaming its output, and return a RunRecord of the run
+
+    The command's stderr, and its stdout unless that is written to
+    output_fp, are passed on line by line as they are written, to this
+    process's stderr and stdout, unless echo is False, and to the file log_fp
+    if one is given. The resources used are those the operating system
+    reports for the command when it is reaped, which are its own even when
+    other commands run at the same time. A subprocess.CalledProcessError is
+    raised if it fails.
+
+    The command runs in its own process group. If it is still running after
+    timeout seconds, or this process is interrupted or terminated, the whole
+    group is sent SIGTERM and then SIGKILL, so that no threads or child
+    processes of the command are left running, and a CommandTimeoutError or
+    the interrupt is raised. The group is stopped in the same way when the
+    threading.Event stop is set, and the command then fails.
+    """
+    if verbose:
+        _print_command(cmd)
+
+    lock = threading.Lock()
+    with contextlib.ExitStack() as stack:
+        log = None
+        if log_fp is not None:
+            log = stack.enter_context(open(log_fp, 'a'))
+        stdout = subprocess.PIPE
+        if output_fp is not None:
+            stdout = stack.enter_context(open(output_fp, 'w'))
+        stack.enter_context(_exit_on_sigterm())
+
+        start = time.monotonic()
+        proc = subprocess.Popen(cmd, stdout=stdout, stderr=subprocess.PIPE,
+                                env=env, universal_newlines=True,
+                                errors='replace', start_new_session=True)
+        stderr_echo, stdout_echo = sys.stderr, sys.stdout
+        if not echo:
+            stderr_echo = stdout_echo = stack.enter_context(
+                open(os.devnull, 'w'))
+        readers = [threading.Thread(target=_stream, daemon=True,
+                                    args=(proc.stderr, stderr_echo, log,
+                                          lock))]
+        if output_fp is None:
+            readers.append(threading.Thread(
+                target=_stream, daemon=True,
+                args=(proc.stdout, stdout_echo, log, lock)))
+        # the command is reaped in a thread, so that waiting for it can be
+        # bounded and interrupted
+        reaped = []
+        waiter = threading.Thread(
+            target=lambda: reaped.append(os.wait4(proc.pid, 0)), daemon=True)
+        try:
+            for thread in [*readers, waiter]:
+                thread.start()
+            _wait(waiter, timeout, stop)
+            timed_out = waiter.is_alive() and \
+                not (stop is not None and stop.is_set())
+            if waiter.is_alive():
+                _stop_group(proc, waiter)
+            for reader in readers:
+                reader.join()
+        except BaseException:
+            _stop_group(proc, waiter)
+            raise
+        finally:
+            # once the command has been reaped, Popen must not wait for it
+            if reaped:
+                proc.returncode = _exit_code(reaped[0][1])
+        wall_time = time.monotonic() - start
+
+    usage = reaped[0][2]
+    record = RunRecord(cmd=list(cmd), returncode=proc.returncode,
+                       wall_time=wall_time,
+                       cpu_time=usage.ru_utime + usage.ru_stime,
+                       max_rss=usage.ru_maxrss * _RSS_BYTES, log_fp=log_fp)
+    if verbose:
+        _print_record(record)
+    if timed_out:
+        raise CommandTimeoutError(cmd, timeout, wall_time)
+    if proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, cmd)
+    return record
+
+
+def run_concurrently(jobs, max_workers):
+    """ Call each of jobs with a threading.Event, in a pool of max_workers
+    threads, and return their results in order
+
+    Each job passes the event to run_command as stop. If a job fails, or
+    this process is interrupted or terminated, the event is set so that the
+    commands of the other jobs are stopped, and the error is raised.
+    """
+    stop = threading.Event()
+    with _exit_on_sigterm(), \
+            concurrent.futures.ThreadPoolExecutor(max_workers) as pool:
+        futures = [pool.submit(job, stop) for job in jobs]
+        try:
+            for future in concurrent.futures.as_completed(futures):
+                future.result()
+        except BaseException:
+            stop.set()
+            for future in futures:
+                future.cancel()
+            raise
+    return [future.result() for future in futures]
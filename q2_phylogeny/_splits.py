@@ -0,0 +1,423 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016-2023, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import math
+import random
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+
+def _tip_index(trees):
+    """ Map every tip name found in trees to a bit position
+    """
+    index = {}
+    for tree in trees:
+        for name in tree.tip_names():
+            if name not in index:
+                index[name] = len(index)
+    return index
+
+
+def _tip_masks(tree, tip_index):
+    """ One bit per tip over tip_index, at each tip's position in tree
+    """
+    masks = [0] * len(tree)
+    for i, name in zip(tree.tips().tolist(), tree.tip_names()):
+        masks[i] = 1 << tip_index[name]
+    return masks
+
+
+def _shared_mask(tip_index, names):
+    """ Bitset of the given tip names over tip_index
+    """
+    mask = 0
+    for name in names:
+        mask |= 1 << tip_index[name]
+    return mask
+
+
+def _tree_splits(tree, tip_index, shared=None):
+    """ Encode the clades of a tree as integer bitsets over tip_index
+
+    This mirrors ``skbio.TreeNode.subsets``: every non-root node that
+    subtends more than one distinct tip name contributes the set of those
+    names, here represented by an int with one bit set per tip.
+
+    If shared is a bitset, the clades are those of the tree restricted to
+    the shared tips, as ``skbio.TreeNode.shear`` would produce, but the tree
+    itself is not copied: each clade is masked down to the shared tips, and
+    clades left with fewer than two tips, or with all of them (which shear
+    would collapse into the root), are dropped.
+
+    Nodes are visited from the last in preorder to the first, which reaches
+    every child before its parent, and each node's tips are added to its
+    parent's.
+    """
+    parents = tree.parents.tolist()
+    internal = (tree.n_children > 0).tolist()
+    masks = _tip_masks(tree, tip_index)
+    splits = set()
+    for i in range(len(parents) - 1, 0, -1):
+        mask = masks[i]
+        if internal[i]:
+            split = mask if shared is None else mask & shared
+            if split & (split - 1) and split != shared:
+                splits.add(split)
+        masks[parents[i]] |= mask
+    return frozenset(splits)
+
+
+def _tree_split_lengths(tree, tip_index, shared=None):
+    """ Branch lengths of a tree keyed by the clade below each branch
+
+    Every non-root branch is included, terminal ones too. Branches that
+    subtend the same tips (chains of single-child nodes) share a clade and
+    their lengths are summed, as ``skbio.TreeNode.prune`` would. Missing
+    lengths count as zero. The clades are returned as a list of bitsets and
+    a float64 array of the matching lengths.
+
+    shared restricts the tree to a subset of its tips as in _tree_splits.
+    Branches whose clades become identical after masking are summed, again
+    matching the merged branches ``skbio.TreeNode.shear`` leaves behind.
+    """
+    parents = tree.parents.tolist()
+    branch_lengths = tree.branch_lengths().tolist()
+    masks = _tip_masks(tree, tip_index)
+    lengths = {}
+    for i in range(len(parents) - 1, 0, -1):
+        mask = masks[i]
+        masks[parents[i]] |= mask
+        if shared is not None:
+            mask &= shared
+            if not mask or mask == shared:
+                continue
+        lengths[mask] = lengths.get(mask, 0.0) + branch_lengths[i]
+    return list(lengths), np.fromiter(lengths.values(), dtype=float,
+                                      count=len(lengths))
+
+
+def _index_split_lengths(split_lengths):
+    """ Replace the clades of each tree by sorted ids shared by all trees
+
+    Returns one (ids, lengths) pair of aligned arrays per tree, where equal
+    ids denote the same clade in every tree.
+    """
+    split_ids = {}
+    indexed = []
+    for splits, lengths in split_lengths:
+        ids = np.fromiter((split_ids.setdefault(s, len(split_ids))
+                           for s in splits), dtype=np.int64, count=len(splits))
+        order = np.argsort(ids)
+        indexed.append((ids[order], lengths[order]))
+    return indexed
+
+
+def _index_against(split_ids, split_lengths):
+    """ Sorted ids for one tree's clades, relative to a fixed id table
+
+    Clades missing from split_ids get fresh ids past the end of the table,
+    which is left unchanged, so many trees can be indexed against the same
+    reference without the table growing.
+    """
+    splits, lengths = split_lengths
+    next_id = len(split_ids)
+    ids = np.empty(len(splits), dtype=np.int64)
+    for k, split in enumerate(splits):
+        split_id = split_ids.get(split)
+        if split_id is None:
+            split_id = next_id
+            next_id += 1
+        ids[k] = split_id
+    order = np.argsort(ids)
+    return ids[order], lengths[order]
+
+
+def _aligned_differences(a, b):
+    """ Length differences over the union of two trees' clades
+
+    Clades found in only one tree contribute their own length.
+    """
+    ids_a, lengths_a = a
+    ids_b, lengths_b = b
+    _, idx_a, idx_b = np.intersect1d(ids_a, ids_b, assume_unique=True,
+                                     return_indices=True)
+    only_a = np.ones(len(ids_a), dtype=bool)
+    only_a[idx_a] = False
+    only_b = np.ones(len(ids_b), dtype=bool)
+    only_b[idx_b] = False
+    return np.concatenate([lengths_a[only_a], lengths_b[only_b],
+                           lengths_a[idx_a] - lengths_b[idx_b]])
+
+
+def _rf_distance(a, b):
+    return len(a) + len(b) - 2 * len(a.intersection(b))
+
+
+def _weighted_rf_distance(a, b):
+    return np.abs(_aligned_differences(a, b)).sum()
+
+
+def _kf_distance(a, b):
+    differences = _aligned_differences(a, b)
+    return np.sqrt((differences * differences).sum())
+
+
+def _pairwise_rows(items, distance, start, stop):
+    """ Lower-triangle distances for rows [start, stop), concatenated
+    """
+    out = np.empty(stop * (stop - 1) // 2 - start * (start - 1) // 2)
+    k = 0
+    for i in range(start, stop):
+        a = items[i]
+        for j in range(i):
+            out[k] = distance(a, items[j])
+            k += 1
+    return out
+
+
+def _row_blocks(n, n_blocks):
+    """ Split rows 0..n into contiguous blocks of similar pairwise work
+
+    Row i of the lower triangle holds i comparisons, so blocks are cut at
+    equal fractions of the n * (n - 1) / 2 total rather than of n.
+    """
+    total = n * (n - 1) // 2
+    bounds = [0]
+    for b in range(1, n_blocks):
+        target = total * b / n_blocks
+        row = int((1 + (1 + 8 * target) ** 0.5) / 2)
+        if bounds[-1] < row < n:
+            bounds.append(row)
+    bounds.append(n)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+_worker_items = None
+_worker_distance = None
+
+
+def _init_worker(items, distance):
+    global _worker_items, _worker_distance
+    _worker_items = items
+    _worker_distance = distance
+
+
+def _pairwise_rows_worker(start, stop):
+    return _pairwise_rows(_worker_items, _worker_distance, start, stop)
+
+
+def _buffer(shape, dtype, on_disk=False):
+    """ A zero-filled array, optionally backed by an anonymous temporary file
+
+    On-disk buffers are memory mapped, so only the pages in use are held in
+    memory. The file is unlinked immediately and disappears with the array.
+    """
+    if not on_disk:
+        return np.zeros(shape, dtype=dtype)
+    with tempfile.TemporaryFile() as fh:
+        return np.memmap(fh, dtype=dtype, mode='w+', shape=shape)
+
+
+def _condensed_offsets(n):
+    """ Position of the first entry of each row in a condensed lower triangle
+    """
+    rows = np.arange(n, dtype=np.int64)
+    return rows * (rows - 1) // 2
+
+
+def _square_from_condensed(condensed, n, out):
+    """ Fill the square matrix out from a condensed lower triangle, by rows
+    """
+    offsets = _condensed_offsets(n)
+    for i in range(n):
+        out[i, :i] = condensed[offsets[i]:offsets[i] + i]
+        out[i, i + 1:] = condensed[offsets[i + 1:] + i]
+    return out
+
+
+# Number of pairs computed per row block, bounding the memory used for a
+# block on its way to the condensed buffer.
+_BLOCK_PAIRS = 2 ** 22
+
+
+def _pairwise_matrix(items, distance, n_threads=1, dtype=float,
+                     on_disk=False):
+    """ Symmetric matrix of distance(a, b) over all pairs of items
+
+    Distances are computed in blocks of rows of the lower triangle and
+    stored in a condensed buffer of the given dtype, from which the square
+    float64 matrix is then filled. With on_disk both are memory mapped
+    temporary files, so neither needs to fit in memory.
+
+    With more than one thread, the blocks are computed in a pool of worker
+    processes, each of which receives the items once when it starts.
+    """
+    n = len(items)
+    n_pairs = n * (n - 1) // 2
+    condensed = _buffer(n_pairs, dtype, on_disk)
+    offsets = _condensed_offsets(n + 1)
+
+    # several blocks per worker keeps the pool busy if rows are uneven
+    n_blocks = max(4 * n_threads, math.ceil(n_pairs / _BLOCK_PAIRS))
+    blocks = _row_blocks(n, n_blocks)
+    if n_threads > 1 and n > 2:
+        with ProcessPoolExecutor(max_workers=n_threads,
+                                 initializer=_init_worker,
+                                 initargs=(items, distance)) as executor:
+            futures = {executor.submit(_pairwise_rows_worker, start, stop):
+                       (start, stop) for start, stop in blocks}
+            for future in as_completed(futures):
+                start, stop = futures.pop(future)
+                condensed[offsets[start]:offsets[stop]] = future.result()
+    else:
+        for start, stop in blocks:
+            condensed[offsets[start]:offsets[stop]] = _pairwise_rows(
+                items, distance, start, stop)
+
+    return _square_from_condensed(condensed, n,
+                                  _buffer((n, n), float, on_disk))
+
+
+# Seed for the random tip values used by _hash_rf_matrix. Fixed so that
+# repeated runs hash identically.
+_HASH_SEED = 1981
+
+
+def _tree_split_hashes(tree, tip_values, tip_index=None, restricted=False):
+    """ Hash every clade of a tree by summing random per-tip values
+
+    Each entry of tip_values is a 128-bit integer, the concatenation of two
+    independent 64-bit universal hashes as used by HashRF. A clade's key is
+    the sum of its tips' values modulo 2**128, so the keys of the whole tree
+    come from one pass over the nodes without building tip sets. If
+    tip_index is provided each key is paired with the clade's bitset, so
+    that clades whose hashes collide remain distinct.
+
+    If restricted is True, tips missing from tip_values are ignored,
+    restricting the tree to the remaining tips without copying it (see
+    _tree_splits).
+    """
+    low_bits = (1 << 128) - 1
+    n_tips = len(tip_values) if restricted else None
+    parents = tree.parents.tolist()
+    internal = (tree.n_children > 0).tolist()
+    values = [0] * len(parents)
+    counts = [0] * len(parents)
+    masks = [0] * len(parents)
+    for i, name in zip(tree.tips().tolist(), tree.tip_names()):
+        values[i] = tip_values.get(name, 0) if restricted else \
+            tip_values[name]
+        counts[i] = int(name in tip_values)
+        if tip_index is not None:
+            masks[i] = counts[i] << tip_index[name]
+
+    keys = set()
+    for i in range(len(parents) - 1, 0, -1):
+        value = values[i]
+        count = counts[i]
+        if internal[i]:
+            value &= low_bits
+            if count > 1 and count != n_tips:
+                keys.add(value if tip_index is None else (value, masks[i]))
+        parent = parents[i]
+        values[parent] += value
+        counts[parent] += count
+        if tip_index is not None:
+            masks[parent] |= masks[i]
+    return keys
+
+
+def _tree_hash_keys(trees, tip_index, exact=False, shared_tips=None):
+    """ The clade hashes of every tree, as one frozenset per tree
+
+    When exact is True the tip set of every clade is kept alongside its hash
+    and clades with colliding hashes but different tip sets are counted
+    separately. If shared_tips is provided, trees are compared over only
+    those tips.
+    """
+    rng = random.Random(_HASH_SEED)
+    tip_values = {name: rng.getrandbits(128) for name in tip_index}
+    if shared_tips is not None:
+        tip_values = {name: tip_values[name] for name in shared_tips}
+
+    return [frozenset(_tree_split_hashes(tree, tip_values,
+                                         tip_index if exact else None,
+                                         restricted=shared_tips is not None))
+            for tree in trees]
+
+
+def _hash_rf_matrix(key_sets, on_disk=False):
+    """ Pairwise Robinson-Foulds distances through a global split table
+
+    Following HashRF (Sul & Williams 2008), every clade of every tree is
+    hashed into a single table recording which trees contain it. Clades
+    present in the same set of trees are grouped, and each group adds its
+    multiplicity to the shared-clade counts of all pairs in that set, so the
+    work is proportional to the table size rather than to all pairs of
+    trees times their clades. Distances follow from the shared counts as
+    ``|A| + |B| - 2|A & B|``.
+
+    key_sets holds the clade hashes of each tree, from _tree_hash_keys.
+    on_disk memory maps the shared counts and the result, as in
+    _pairwise_matrix.
+    """
+    table = {}
+    sizes = np.empty(len(key_sets), dtype=np.int64)
+    for i, keys in enumerate(key_sets):
+        for key in keys:
+            table.setdefault(key, []).append(i)
+        sizes[i] = len(keys)
+
+    patterns = {}
+    for members in table.values():
+        members = tuple(members)
+        patterns[members] = patterns.get(members, 0) + 1
+
+    n = len(key_sets)
+    shared = _buffer((n, n), np.min_scalar_type(sizes.max(initial=0)),
+                     on_disk)
+    for members, count in patterns.items():
+        idx = np.asarray(members)
+        shared[np.ix_(idx, idx)] += count
+
+    dm = _buffer((n, n), float, on_disk)
+    for i in range(n):
+        dm[i] = sizes[i] + sizes - 2 * shared[i].astype(np.int64)
+    return dm
+
+
+def _unique_topologies(keys):
+    """ Group trees whose keys are equal, in a single pass
+
+    keys holds one hashable, order-independent description of each tree:
+    the frozenset of its clade bitsets or clade hashes, or of its
+    (clade, length) pairs for the length-aware metrics. Two trees with the
+    same key are indistinguishable to the metric, whatever their child
+    order or Newick layout. Returns the position of the first tree of each
+    group and, for every tree, the number of its group.
+    """
+    groups = {}
+    first = []
+    inverse = np.empty(len(keys), dtype=np.int64)
+    for i, key in enumerate(keys):
+        group = groups.get(key)
+        if group is None:
+            group = groups[key] = len(first)
+            first.append(i)
+        inverse[i] = group
+    return first, inverse
+
+
+def _expand_matrix(dm, inverse, out):
+    """ Fill out[i, j] with dm[inverse[i], inverse[j]], by rows
+    """
+    for i, group in enumerate(inverse):
+        out[i] = dm[group][inverse]
+    return out
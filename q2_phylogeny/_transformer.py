@@ -0,0 +1,98 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016-2023, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import skbio
+from q2_types.tree import NewickFormat
+
+from q2_phylogeny._compact import CompactTree, CompactTreeCollection
+from q2_phylogeny._format import (CompactTreeDirectoryFormat,
+                                  MultiNewickFormat,
+                                  TreeCollectionDirectoryFormat)
+from q2_phylogeny.plugin_setup import plugin
+
+
+@plugin.register_transformer
+def _1(ff: NewickFormat) -> CompactTree:
+    with ff.open() as fh:
+        return CompactTree.from_newick(fh.read())
+
+
+@plugin.register_transformer
+def _2(data: CompactTree) -> NewickFormat:
+    ff = NewickFormat()
+    with ff.open() as fh:
+        data.write(fh)
+    return ff
+
+
+@plugin.register_transformer
+def _3(ff: CompactTreeDirectoryFormat) -> CompactTree:
+    return CompactTree.load(str(ff))
+
+
+@plugin.register_transformer
+def _4(data: CompactTree) -> CompactTreeDirectoryFormat:
+    ff = CompactTreeDirectoryFormat()
+    data.save(str(ff))
+    return ff
+
+
+@plugin.register_transformer
+def _5(ff: CompactTreeDirectoryFormat) -> skbio.TreeNode:
+    return _3(ff).to_treenode()
+
+
+@plugin.register_transformer
+def _6(data: skbio.TreeNode) -> CompactTreeDirectoryFormat:
+    return _4(CompactTree.from_treenode(data))
+
+
+@plugin.register_transformer
+def _7(ff: NewickFormat) -> CompactTreeDirectoryFormat:
+    return _4(_1(ff))
+
+
+@plugin.register_transformer
+def _8(ff: CompactTreeDirectoryFormat) -> NewickFormat:
+    return _2(_3(ff))
+
+
+@plugin.register_transformer
+def _9(ff: TreeCollectionDirectoryFormat) -> CompactTreeCollection:
+    return CompactTreeCollection.load(str(ff))
+
+
+@plugin.register_transformer
+def _10(data: CompactTreeCollection) -> TreeCollectionDirectoryFormat:
+    ff = TreeCollectionDirectoryFormat()
+    data.save(str(ff))
+    return ff
+
+
+@plugin.register_transformer
+def _11(ff: MultiNewickFormat) -> CompactTreeCollection:
+    with ff.open() as fh:
+        return CompactTreeCollection.from_newick(fh)
+
+
+@plugin.register_transformer
+def _12(data: CompactTreeCollection) -> MultiNewickFormat:
+    ff = MultiNewickFormat()
+    with ff.open() as fh:
+        data.write(fh)
+    return ff
+
+
+@plugin.register_transformer
+def _13(ff: MultiNewickFormat) -> TreeCollectionDirectoryFormat:
+    return _10(_11(ff))
+
+
+@plugin.register_transformer
+def _14(ff: TreeCollectionDirectoryFormat) -> MultiNewickFormat:
+    return _12(_9(ff))
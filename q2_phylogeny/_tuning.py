@@ -0,0 +1,184 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016-2023, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import json
+import os
+import socket
+import subprocess
+import tempfile
+
+import numpy as np
+from qiime2.plugin import get_available_cores
+
+from q2_phylogeny._runner import run_command, CommandTimeoutError
+
+# the thread counts pilot runs are timed with, up to the number allowed
+_PILOT_THREADS = (1, 2, 4, 8)
+# columns of the alignment a pilot run is given, and the seconds it may run
+_PILOT_COLUMNS = 1000
+_PILOT_TIMEOUT = 60
+# the throughput per thread, relative to that of one thread, that a thread
+# count must keep to be chosen
+_MIN_EFFICIENCY = 0.5
+_CACHE_FILE = 'threads.json'
+
+
+def _cache_fp():
+    cache_home = os.environ.get('XDG_CACHE_HOME') or \
+        os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_home, 'q2-phylogeny', _CACHE_FILE)
+
+
+def _load_cache():
+    try:
+        with open(_cache_fp()) as fh:
+            cache = json.load(fh)
+    except (OSError, ValueError):
+        return {}
+    return cache if isinstance(cache, dict) else {}
+
+
+def _save_choice(key, n_threads):
+    """ Add a choice to the cache, which is replaced rather than rewritten
+    so that it is never read half written
+    """
+    cache = _load_cache()
+    cache[key] = n_threads
+    fp = _cache_fp()
+    try:
+        os.makedirs(os.path.dirname(fp), exist_ok=True)
+        with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(fp),
+                                         delete=False) as fh:
+            json.dump(cache, fh, indent=2, sort_keys=True)
+        os.replace(fh.name, fp)
+    except OSError:
+        # the choice is only remembered when the cache can be written
+        pass
+
+
+def _cache_key(tool, n_sequences, n_columns, max_threads):
+    return '%s %s %dx%d max %d' % (socket.gethostname(), tool, n_sequences,
+                                   n_columns, max_threads)
+
+
+def _read_alignment(alignment_fp):
+    """ The ids and sequences of an aligned FASTA file
+    """
+    ids, sequences, parts = [], [], None
+    with open(alignment_fp) as fh:
+        for line in fh:
+            line = line.strip()
+            if line.startswith('>'):
+                if parts is not None:
+                    sequences.append(''.join(parts))
+                ids.append(line[1:])
+                parts = []
+            elif line:
+                parts.append(line)
+    if parts is not None:
+        sequences.append(''.join(parts))
+    return ids, sequences
+
+
+def _write_subsample(ids, sequences, output_fp, n_columns=_PILOT_COLUMNS,
+                     seed=0):
+    """ Write the alignment with a random subset of its columns, kept in
+    their order
+    """
+    length = len(sequences[0]) if sequences else 0
+    columns = np.arange(length)
+    if length > n_columns:
+        rng = np.random.default_rng(seed)
+        columns = np.sort(rng.choice(length, n_columns, replace=False))
+    with open(output_fp, 'w') as fh:
+        for id_, sequence in zip(ids, sequences):
+            chars = np.frombuffer(sequence.encode('ascii'), dtype=np.uint8)
+            fh.write('>%s\n%s\n' % (id_, chars[columns].tobytes().decode()))
+
+
+def _pilot_thread_counts(max_threads):
+    counts = {n for n in _PILOT_THREADS if n < max_threads}
+    counts.add(min(max_threads, _PILOT_THREADS[-1]))
+    return sorted(counts)
+
+
+def _best_thread_count(times):
+    """ The thread count to use, given the wall time of a pilot run with
+    each count that finished
+
+    This is the fastest count whose throughput per thread is at least
+    _MIN_EFFICIENCY of that of one thread, so that threads which mostly
+    wait on each other are left free.
+    """
+    if not times:
+        return None
+    if 1 not in times:
+        return min(times, key=lambda n: (times[n], n))
+    efficient = [n for n, time in times.items()
+                 if times[1] / (time * n) >= _MIN_EFFICIENCY]
+    return min(efficient, key=lambda n: (times[n], n))
+
+
+def _tuned_threads(tool, alignment_fp, max_threads, pilot):
+    """ The number of threads, up to max_threads, that tool runs best with
+    on this alignment on this host
+
+    pilot(alignment_fp, n_threads, temp_dir) gives the command, output file
+    and environment of a pilot run. Each run is given a subsample of the
+    alignment's columns and at most _PILOT_TIMEOUT seconds. The choice is
+    cached in $XDG_CACHE_HOME, keyed by the host, the tool, the dimensions
+    of the alignment and max_threads, so that the pilot runs are made once.
+    If no pilot run finishes because they all fail, rather than time out,
+    max_threads is returned as it was given, and nothing is cached.
+    """
+    requested = max_threads
+    if max_threads == 0:
+        max_threads = get_available_cores()
+    counts = _pilot_thread_counts(max_threads)
+    if len(counts) == 1:
+        return counts[0]
+
+    ids, sequences = _read_alignment(alignment_fp)
+    key = _cache_key(tool, len(ids), len(sequences[0]) if sequences else 0,
+                     max_threads)
+    cached = _load_cache().get(key)
+    if isinstance(cached, int) and 0 < cached <= max_threads:
+        return cached
+
+    times, n_failed = {}, 0
+    with tempfile.TemporaryDirectory() as temp_dir:
+        subsample_fp = os.path.join(temp_dir, 'pilot.fasta')
+        _write_subsample(ids, sequences, subsample_fp)
+        for n_threads in counts:
+            run_dir = os.path.join(temp_dir, str(n_threads))
+            os.mkdir(run_dir)
+            try:
+                cmd, output_fp, env = pilot(subsample_fp, n_threads, run_dir)
+                record = run_command(cmd, output_fp, verbose=False, env=env,
+                                     timeout=_PILOT_TIMEOUT, echo=False)
+            except CommandTimeoutError:
+                continue
+            except (subprocess.CalledProcessError, OSError):
+                n_failed += 1
+                continue
+            times[n_threads] = record.wall_time
+
+    n_threads = _best_thread_count(times)
+    if n_threads is None and n_failed:
+        print("The pilot runs of %s failed, so it is run with the number of "
+              "threads requested." % tool)
+        return requested
+    if n_threads is None:
+        # no pilot run finished, so the alignment is large enough for every
+        # thread to be kept busy
+        n_threads = counts[-1]
+    _save_choice(key, n_threads)
+    print("Running %s with %d threads, chosen by timing pilot runs with %s "
+          "threads." % (tool, n_threads,
+                        ', '.join(str(n) for n in counts)))
+    return n_threads
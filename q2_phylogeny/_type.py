@@ -0,0 +1,15 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016-2023, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+from qiime2.plugin import SemanticType
+from q2_types.tree import Phylogeny
+
+TreeCollection = SemanticType('TreeCollection')
+
+# a tree stored as memory-mappable arrays rather than Newick text
+Compact = SemanticType('Compact', variant_of=Phylogeny.field['type'])
@@ -6,27 +6,278 @@
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
 
+import numpy as np
+import pandas as pd
+import qiime2
 import skbio
+from qiime2.plugin import get_available_cores
+from skbio.tree import NoLengthError
 
+from q2_phylogeny._compact import (CompactTree, CompactTreeCollection,
+                                   _as_compact)
 
-def midpoint_root(tree: skbio.TreeNode) -> skbio.TreeNode:
-    return tree.root_at_midpoint()
+from q2_phylogeny._splits import (
+    _tip_index, _shared_mask, _tree_splits, _tree_split_lengths,
+    _index_split_lengths, _index_against, _pairwise_matrix, _tree_hash_keys,
+    _hash_rf_matrix, _unique_topologies, _expand_matrix, _buffer,
+    _rf_distance, _weighted_rf_distance, _kf_distance)
 
+_LENGTH_METRICS = {'weighted-rf': _weighted_rf_distance,
+                   'kf': _kf_distance}
 
-def robinson_foulds(trees: skbio.TreeNode, labels: str = None,
-                    missing_tips: str = 'error') -> skbio.DistanceMatrix:
-    if labels is None:
-        labels = ['tree_%d' % d for d in range(1, len(trees) + 1)]
-    elif len(trees) != len(labels):
-        raise ValueError("The number of trees and labels must match.")
+# Collections of at least this many trees have their distances computed in
+# memory mapped temporary files rather than in memory.
+_ON_DISK_MIN_TREES = 5000
+
+
+def _max_distance_tips(tree, lengths, parents, children):
+    """ The largest tip-to-tip distance in a tree and the tips it lies between
+
+    Distances and ties are resolved exactly as in
+    ``skbio.TreeNode.get_max_distance``: each node keeps its two deepest tips
+    from different children, chosen with ``np.argsort``, and the first node
+    in postorder with the largest sum wins.
+    """
+    if np.any(tree.n_children == 1):
+        return _max_distance_tips_unary(lengths, parents, children)
+
+    post = np.empty(len(tree), dtype=np.int64)
+    post[tree.postorder] = np.arange(len(tree))
+    post = post.tolist()
+    deepest = [None] * len(lengths)
+    longest = 0.0
+    longest_node = None
+    for i in range(len(lengths) - 1, -1, -1):
+        if not children[i]:
+            deepest[i] = (0.0, i, 0.0, i)
+            continue
+        dists = []
+        tips = []
+        for child in children[i]:
+            a_dist, a_tip, b_dist, b_tip = deepest[child]
+            if a_dist >= b_dist:
+                dists.append(a_dist)
+                tips.append(a_tip)
+            else:
+                dists.append(b_dist)
+                tips.append(b_tip)
+        if len(dists) == 2 and dists[0] != dists[1]:
+            a, b = (0, 1) if dists[0] < dists[1] else (1, 0)
+        else:
+            a, b = np.argsort(dists)[-2:]
+        a_dist = dists[a] + lengths[children[i][a]]
+        b_dist = dists[b] + lengths[children[i][b]]
+        deepest[i] = (a_dist, tips[a], b_dist, tips[b])
+
+        dist = a_dist + b_dist
+        if dist > longest or (dist == longest and longest_node is not None
+                              and post[i] < post[longest_node]):
+            longest = dist
+            longest_node = i
+    if longest_node is None:
+        return longest, None, None
+    _, a_tip, _, b_tip = deepest[longest_node]
+    return longest, a_tip, b_tip
+
+
+def _max_distance_tips_unary(lengths, parents, children):
+    """ As _max_distance_tips, for trees with single child nodes
+
+    skbio finds these tips with the full tip-to-tip distance matrix, taking
+    the first farthest pair in row major order over the tips in postorder.
+    The same pair is found here from the deepest tip below each child of each
+    node, without computing the matrix.
+    """
+    n = len(lengths)
+    # postorder rank of every tip, which is also its preorder rank
+    tip_rank = {}
+    for i in range(n):
+        if not children[i]:
+            tip_rank[i] = len(tip_rank)
+
+    # depth of the deepest tip below each node, and the first such tip
+    deepest = [0.0] * n
+    first_tip = list(range(n))
+    longest = 0.0
+    for i in range(n - 1, -1, -1):
+        if not children[i]:
+            continue
+        dists = [deepest[c] + lengths[c] for c in children[i]]
+        top = max(dists)
+        deepest[i] = top
+        first_tip[i] = min((first_tip[c] for c, d in zip(children[i], dists)
+                            if d == top), key=tip_rank.__getitem__)
+        if len(dists) > 1:
+            longest = max(longest, top + sorted(dists)[-2])
+    if longest == 0.0:
+        return longest, None, None
+
+    # the first tip that is at either end of a longest path ...
+    tip1 = None
+    for i in range(n):
+        if len(children[i]) < 2:
+            continue
+        dists = [deepest[c] + lengths[c] for c in children[i]]
+        ranked = sorted(dists)
+        for c, d in zip(children[i], dists):
+            other = ranked[-2] if d == ranked[-1] else ranked[-1]
+            if d + other == longest and (
+                    tip1 is None
+                    or tip_rank[first_tip[c]] < tip_rank[tip1]):
+                tip1 = first_tip[c]
+
+    # ... and the first tip at the other end of a longest path from it
+    tip2 = None
+    climbed = 0.0
+    node = tip1
+    while parents[node] >= 0:
+        climbed += lengths[node]
+        parent = parents[node]
+        for c in children[parent]:
+            if c != node and climbed + (deepest[c] + lengths[c]) == longest \
+                    and (tip2 is None
+                         or tip_rank[first_tip[c]] < tip_rank[tip2]):
+                tip2 = first_tip[c]
+        node = parent
+    return longest, tip1, tip2
+
+
+def _unrooted_tree(names, lengths, parents, children, start):
+    """ A tree rerooted at start, as ``TreeNode.unrooted_copy``
+
+    Each node's neighbours become its children, in the order of its children
+    followed by its parent. Where a parent becomes a child, it takes the name
+    and length of the edge it was reached through.
+    """
+    new_names = []
+    new_lengths = []
+    new_parents = []
+    stack = [(start, -1, -1)]
+    while stack:
+        node, came_from, position = stack.pop()
+        if came_from < 0:
+            new_names.append('root')
+            new_lengths.append(None)
+        elif parents[came_from] == node:
+            new_names.append(names[came_from])
+            new_lengths.append(lengths[came_from])
+        else:
+            new_names.append(names[node])
+            new_lengths.append(lengths[node])
+        new_parents.append(position)
+        neighbours = children[node]
+        if parents[node] >= 0:
+            neighbours = neighbours + [parents[node]]
+        stack.extend((v, node, len(new_parents) - 1)
+                     for v in reversed(neighbours) if v != came_from)
+    return CompactTree.from_arrays(new_names, new_lengths, new_parents)
+
+
+def _midpoint_rooted(tree):
+    """ A CompactTree rooted at the midpoint of the two tips farthest apart
+
+    This gives the same tree as ``skbio.TreeNode.root_at_midpoint``, but
+    finds the farthest tips in one postorder pass rather than from all
+    tip-to-tip distances. None is returned if all tips are at distance zero.
+    """
+    names = tree.node_names()
+    lengths = tree.length_list()
+    parents = tree.parents.tolist()
+    children = tree.children_lists()
+    max_dist, tip1, tip2 = _max_distance_tips(
+        tree, tree.branch_lengths().tolist(), parents, children)
+    if max_dist == 0.0:
+        # only pathological cases with no lengths
+        return None
+    half_max_dist = max_dist / 2.0
+
+    ancestors = set()
+    node = tip1
+    while node >= 0:
+        ancestors.add(node)
+        node = parents[node]
+    lca = tip2
+    while lca not in ancestors:
+        lca = parents[lca]
+
+    to_lca = 0.0
+    node = tip1
+    while node != lca:
+        if lengths[node] is None:
+            raise NoLengthError("No length on node %s found." %
+                                (names[node] or "unnamed"))
+        to_lca += lengths[node]
+        node = parents[node]
+    climb_node = tip1 if to_lca > half_max_dist else tip2
+
+    dist_climbed = 0.0
+    while dist_climbed + lengths[climb_node] < half_max_dist:
+        dist_climbed += lengths[climb_node]
+        climb_node = parents[climb_node]
+
+    if dist_climbed + lengths[climb_node] == half_max_dist:
+        # the midpoint is on climb_node's parent
+        return _unrooted_tree(names, lengths, parents, children,
+                              parents[climb_node])
+
+    # otherwise a new root splits the branch from climb_node to its parent
+    return _insert_root(names, lengths, parents, children, climb_node,
+                        half_max_dist - dist_climbed)
+
+
+def _insert_root(names, lengths, parents, children, node, distance):
+    """ A tree rerooted at a new node distance above node on its branch
+
+    The new root is added after the parent's other children, as
+    ``TreeNode.root_at_midpoint`` adds it.
+    """
+    parent = parents[node]
+    new_root = len(parents)
+    old_length = lengths[node]
+    names = names + [None]
+    lengths = lengths + [None]
+    parents = parents + [parent]
+    lengths[node] = distance
+    lengths[new_root] = old_length - lengths[node]
+    parents[node] = new_root
+    children = children + [[node]]
+    children[parent] = [c for c in children[parent] if c != node] + \
+        [new_root]
+    return _unrooted_tree(names, lengths, parents, children, new_root)
+
+
+def _reroot(tree, rooted):
+    """ Apply rooted to a CompactTree or a skbio.TreeNode
+
+    rooted takes a CompactTree and returns the rerooted CompactTree, or None
+    to leave the tree as it is. A TreeNode is converted to and from a
+    CompactTree around it.
+    """
+    if isinstance(tree, skbio.TreeNode):
+        result = rooted(CompactTree.from_treenode(tree))
+        if result is None:
+            return tree.copy()
+        return result.to_treenode(tree.__class__)
+    result = rooted(tree)
+    return tree if result is None else result
+
+
+def midpoint_root(tree: CompactTree) -> CompactTree:
+    """ Root tree at the midpoint of the two tips farthest apart
+
+    A skbio.TreeNode is also accepted, in which case one is returned.
+    """
+    return _reroot(tree, _midpoint_rooted)
 
-    tips = [{t.name for t in tree.tips()} for tree in trees]
+
+def _shared_tips(trees, missing_tips):
+    """ Tip names to compare trees over, per the missing_tips strategy
+    """
+    tips = [set(tree.tip_names()) for tree in trees]
     shared_tips = set.intersection(*tips)
     if not shared_tips:
         raise ValueError("No tip names are shared between these trees.")
-    if missing_tips == 'intersect-all':
-        trees = [t.shear(shared_tips) for t in trees]
-    elif missing_tips == 'error':
+    if missing_tips == 'error':
         all_tips = set.union(*tips)
         if shared_tips != all_tips:
             SKIP = 10
@@ -37,10 +288,136 @@ def robinson_foulds(trees: skbio.TreeNode, labels: str = None,
 
             raise ValueError("Not all tips are shared between trees: "
                              + missing_repr)
-    else:
+    elif missing_tips != 'intersect-all':
         raise ValueError("Unknown argument for missing_tips=%r"
                          % missing_tips)
+    return shared_tips
+
+
+def _check_metric(metric, method='splits'):
+    if method not in ('splits', 'hash'):
+        raise ValueError("Unknown argument for method=%r" % method)
+    if metric != 'rf' and metric not in _LENGTH_METRICS:
+        raise ValueError("Unknown argument for metric=%r" % metric)
+    if metric != 'rf' and method == 'hash':
+        raise ValueError("The %r metric requires method='splits'." % metric)
+
+
+def robinson_foulds(trees: CompactTree = None, labels: str = None,
+                    missing_tips: str = 'error',
+                    n_threads: int = 1, method: str = 'splits',
+                    exact: bool = False,
+                    metric: str = 'rf',
+                    tree_collection: CompactTreeCollection = None
+                    ) -> skbio.DistanceMatrix:
+    if (trees is None) == (tree_collection is None):
+        raise ValueError("Either trees or a tree collection must be "
+                         "provided, but not both.")
+    if tree_collection is not None:
+        trees = tree_collection
+    if labels is None:
+        labels = ['tree_%d' % d for d in range(1, len(trees) + 1)]
+    elif len(trees) != len(labels):
+        raise ValueError("The number of trees and labels must match.")
+
+    trees = [_as_compact(tree) for tree in trees]
+    shared_tips = _shared_tips(trees, missing_tips)
+    _check_metric(metric, method)
+
+    if n_threads == 0:
+        n_threads = get_available_cores()
+
+    on_disk = len(trees) >= _ON_DISK_MIN_TREES
+    if on_disk and len(set(labels)) != len(labels):
+        raise ValueError("Labels must be unique.")
+
+    # with missing_tips='intersect-all' every clade is masked down to the
+    # shared tips, which gives the clades of the sheared trees without
+    # copying them
+    tip_index = _tip_index(trees)
+    shared = None
+    if missing_tips == 'intersect-all':
+        shared = _shared_mask(tip_index, shared_tips)
+
+    if metric in _LENGTH_METRICS:
+        split_lengths = [_tree_split_lengths(t, tip_index, shared)
+                         for t in trees]
+        keys = [frozenset(zip(splits, lengths.tolist()))
+                for splits, lengths in split_lengths]
+    elif method == 'splits':
+        splits = [_tree_splits(t, tip_index, shared) for t in trees]
+        keys = splits
+    else:
+        keys = _tree_hash_keys(
+            trees, tip_index, exact=exact,
+            shared_tips=shared_tips if shared is not None else None)
+
+    # identical trees are only compared once, and their rows and columns
+    # are copied back into the full matrix afterwards
+    first, inverse = _unique_topologies(keys)
+    on_disk_unique = len(first) >= _ON_DISK_MIN_TREES
+    if metric in _LENGTH_METRICS:
+        dm = _pairwise_matrix(
+            _index_split_lengths([split_lengths[i] for i in first]),
+            _LENGTH_METRICS[metric], n_threads, on_disk=on_disk_unique)
+    elif method == 'splits':
+        splits = [splits[i] for i in first]
+        # RF distances are whole numbers no larger than the two trees' clade
+        # counts combined, so they are stored in the smallest dtype that fits
+        dtype = np.min_scalar_type(2 * max(len(s) for s in splits))
+        dm = _pairwise_matrix(splits, _rf_distance, n_threads, dtype=dtype,
+                              on_disk=on_disk_unique)
+    else:
+        dm = _hash_rf_matrix([keys[i] for i in first],
+                             on_disk=on_disk_unique)
+
+    if len(first) < len(trees):
+        dm = _expand_matrix(dm, inverse,
+                            _buffer((len(trees),) * 2, float, on_disk))
+
+    # the memory mapped matrix is already known to be symmetric and hollow,
+    # and validating it would read it all into memory
+    return skbio.DistanceMatrix(dm, ids=labels, validate=not on_disk)
+
+
+def robinson_foulds_reference(trees: CompactTree,
+                              reference: CompactTree,
+                              labels: str = None,
+                              missing_tips: str = 'error',
+                              metric: str = 'rf') -> qiime2.Metadata:
+    if labels is None:
+        labels = ['tree_%d' % d for d in range(1, len(trees) + 1)]
+    elif len(trees) != len(labels):
+        raise ValueError("The number of trees and labels must match.")
+
+    trees = [_as_compact(tree) for tree in trees]
+    reference = _as_compact(reference)
+    shared_tips = _shared_tips([reference, *trees], missing_tips)
+    _check_metric(metric)
+
+    tip_index = _tip_index([reference, *trees])
+    shared = None
+    if missing_tips == 'intersect-all':
+        shared = _shared_mask(tip_index, shared_tips)
+
+    # the reference is indexed once, then each tree is compared to it in turn
+    if metric in _LENGTH_METRICS:
+        distance = _LENGTH_METRICS[metric]
+        splits, lengths = _tree_split_lengths(reference, tip_index, shared)
+        split_ids = {split: i for i, split in enumerate(splits)}
+        reference_splits = (np.arange(len(splits)), lengths)
+    else:
+        reference_splits = _tree_splits(reference, tip_index, shared)
+
+    distances = np.empty(len(trees))
+    for i, tree in enumerate(trees):
+        if metric in _LENGTH_METRICS:
+            tree_splits = _index_against(
+                split_ids, _tree_split_lengths(tree, tip_index, shared))
+            distances[i] = distance(reference_splits, tree_splits)
+        else:
+            tree_splits = _tree_splits(tree, tip_index, shared)
+            distances[i] = _rf_distance(reference_splits, tree_splits)
 
-    return skbio.DistanceMatrix.from_iterable(
-        trees, metric=skbio.TreeNode.compare_rfd,
-        keys=labels, validate=False)
+    return qiime2.Metadata(pd.DataFrame(
+        {'distance': distances}, index=pd.Index(labels, name='id')))
@@ -0,0 +1,70 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016-2023, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import contextlib
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+from random import randint
+
+_HASH_CHUNK = 2 ** 20
+
+
+def _run_key(alignment, params):
+    """ The SHA-256 of the alignment's content and of the parameters of a
+    run, in hex
+    """
+    digest = hashlib.sha256()
+    with open(str(alignment), 'rb') as fh:
+        for chunk in iter(lambda: fh.read(_HASH_CHUNK), b''):
+            digest.update(chunk)
+    digest.update(json.dumps(params, sort_keys=True).encode('utf-8'))
+    return digest.hexdigest()
+
+
+@contextlib.contextmanager
+def _work_dir(checkpoint_dir, alignment, **params):
+    """ The directory a run works in
+
+    Without a checkpoint_dir this is a temporary directory. Otherwise it is
+    the directory in checkpoint_dir named by the hash of the alignment and
+    params, so that a run of the same alignment with the same parameters
+    finds the files of an earlier run that failed or was stopped. It is
+    kept if the run fails, and removed once the run has succeeded.
+    """
+    if checkpoint_dir is None:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            yield temp_dir
+        return
+
+    run_dir = os.path.join(str(checkpoint_dir), _run_key(alignment, params))
+    if os.path.isdir(run_dir):
+        print("Resuming from the files of an earlier run in %s." % run_dir)
+    os.makedirs(run_dir, exist_ok=True)
+    yield run_dir
+    shutil.rmtree(run_dir, ignore_errors=True)
+
+
+def _run_seed(work_dir, name, seed):
+    """ seed, or if it is None, the random seed chosen by an earlier run in
+    work_dir, or a new one that later runs will find
+    """
+    if seed is not None:
+        return seed
+    seed_fp = os.path.join(work_dir, '%s.txt' % name)
+    try:
+        with open(seed_fp) as fh:
+            return int(fh.read())
+    except (OSError, ValueError):
+        seed = randint(1000, 10000)
+    with open(seed_fp, 'w') as fh:
+        fh.write('%d\n' % seed)
+    return seed
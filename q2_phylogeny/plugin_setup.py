@@ -6,20 +6,28 @@
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
 
+import importlib
+
 from qiime2.plugin import (Plugin, Citations, Int, Range, Str, Choices, Bool,
-                           Float, List, TypeMatch, Metadata, Threads)
+                           Float, List, TypeMatch, Metadata, Threads,
+                           Collection)
 from q2_types.tree import Phylogeny, Unrooted, Rooted
 from q2_types.feature_data import FeatureData, AlignedSequence, Sequence
 from q2_types.feature_table import (FeatureTable, Frequency,
                                     RelativeFrequency, PresenceAbsence,
                                     Composition)
 from q2_types.distance_matrix import DistanceMatrix
+from q2_types.metadata import ImmutableMetadata
 
 import q2_phylogeny
 import q2_phylogeny._examples as ex
+from q2_phylogeny._format import (NpyFormat, CompactTreeDirectoryFormat,
+                                  MultiNewickFormat,
+                                  TreeCollectionDirectoryFormat)
+from q2_phylogeny._type import TreeCollection, Compact
 
 _RAXML_MODEL_OPT = ['GTRGAMMA', 'GTRGAMMAI', 'GTRCAT', 'GTRCATI']
-_RAXML_VERSION_OPT = ['Standard', 'SSE3', 'AVX2']
+_RAXML_VERSION_OPT = ['Standard', 'SSE3', 'AVX2', 'auto']
 _IQTREE_DNA_MODELS = ['JC', 'JC+I', 'JC+G', 'JC+I+G', 'JC+R2', 'JC+R3',
                       'JC+R4', 'JC+R5', 'JC+R6', 'JC+R7', 'JC+R8', 'JC+R9',
                       'JC+R10', 'F81', 'F81+I', 'F81+G', 'F81+I+G', 'F81+R2',
@@ -78,6 +86,38 @@ _IQTREE_DNA_MODELS = ['JC', 'JC+I', 'JC+G', 'JC+I+G', 'JC+R2', 'JC+R3',
                       'GTR+R5', 'GTR+R6', 'GTR+R7', 'GTR+R8', 'GTR+R9',
                       'GTR+R10', 'MFP', 'TEST']
 
+_TIMEOUT_DESCRIPTION = ('Stop the tree search, and fail, if it is still '
+                        'running after this many seconds. The program and '
+                        'all of its threads and child processes are '
+                        'stopped. If not supplied, the search is not '
+                        'limited.')
+
+_TUNE_THREADS_DESCRIPTION = ('Choose the number of threads, up to the number '
+                             'given (or all available cores with `auto`), '
+                             'by timing short pilot runs with 1, 2, 4 and 8 '
+                             'threads on a subsample of the alignment\'s '
+                             'columns. The fastest number of threads that '
+                             'keeps at least half the throughput per thread '
+                             'of a single thread is used. The choice is '
+                             'cached under $XDG_CACHE_HOME for alignments of '
+                             'the same dimensions on the same host, so the '
+                             'pilot runs are made once.')
+
+_CHECKPOINT_DIR_DESCRIPTION = ('A directory to work in that is kept when a '
+                               'run fails or is stopped, so that running '
+                               'the action again resumes from the last '
+                               'checkpoint rather than starting over. Each '
+                               'run works in a subdirectory named by a hash '
+                               'of the alignment and of the parameters that '
+                               'decide its result, which is removed once '
+                               'the run succeeds. The same commands are run '
+                               'as without a checkpoint directory; a run '
+                               'that cannot be restarted part way, such as '
+                               'RAxML with several searches in one process, '
+                               'is repeated from the start with the same '
+                               'seed. If not supplied, a temporary '
+                               'directory is used and nothing is kept.')
+
 citations = Citations.load('citations.bib', package='q2_phylogeny')
 plugin = Plugin(
     name='phylogeny',
@@ -89,6 +129,14 @@ plugin = Plugin(
     short_description='Plugin for generating and manipulating phylogenies.'
 )
 
+plugin.register_formats(NpyFormat, CompactTreeDirectoryFormat,
+                        MultiNewickFormat, TreeCollectionDirectoryFormat)
+plugin.register_semantic_types(TreeCollection, Compact)
+plugin.register_semantic_type_to_format(
+    TreeCollection, artifact_format=TreeCollectionDirectoryFormat)
+plugin.register_semantic_type_to_format(
+    Phylogeny[Compact], artifact_format=CompactTreeDirectoryFormat)
+
 plugin.methods.register_function(
     function=q2_phylogeny.midpoint_root,
     inputs={'tree': Phylogeny[Unrooted]},
@@ -101,10 +149,48 @@ plugin.methods.register_function(
     description=("Midpoint root an unrooted phylogenetic tree.")
 )
 
+plugin.methods.register_function(
+    function=q2_phylogeny.min_variance_root,
+    inputs={'tree': Phylogeny[Unrooted]},
+    parameters={},
+    outputs=[('rooted_tree', Phylogeny[Rooted])],
+    input_descriptions={'tree': 'The phylogenetic tree to be rooted.'},
+    parameter_descriptions={},
+    output_descriptions={'rooted_tree': 'The rooted phylogenetic tree.'},
+    name='Minimum variance root an unrooted phylogenetic tree.',
+    description=("Root an unrooted phylogenetic tree at the point that "
+                 "minimizes the variance of root-to-tip distances. Every "
+                 "branch is considered in a single pass, so this scales "
+                 "linearly with the number of tips."),
+    citations=[citations['mai2017minvar']]
+)
+
+plugin.methods.register_function(
+    function=q2_phylogeny.mad_root,
+    inputs={'tree': Phylogeny[Unrooted]},
+    parameters={},
+    outputs=[('rooted_tree', Phylogeny[Rooted])],
+    input_descriptions={'tree': 'The phylogenetic tree to be rooted.'},
+    parameter_descriptions={},
+    output_descriptions={'rooted_tree': 'The rooted phylogenetic tree.'},
+    name='Minimal ancestor deviation root an unrooted phylogenetic tree.',
+    description=("Root an unrooted phylogenetic tree at the point that "
+                 "minimizes the ancestor deviation of pairs of tips, that is "
+                 "how far the ancestor where two tips meet is from the "
+                 "midpoint of the path between them, relative to its "
+                 "length. The root position is optimized on every branch. "
+                 "Every pair of tips is visited once, so the time taken "
+                 "grows with the square of the number of tips; "
+                 "min-variance-root scales linearly."),
+    citations=[citations['tria2017mad']]
+)
+
 plugin.methods.register_function(
     function=q2_phylogeny.fasttree,
     inputs={'alignment': FeatureData[AlignedSequence]},
-    parameters={'n_threads': Threads},
+    parameters={'n_threads': Threads,
+                'timeout': Int % Range(1, None),
+                'tune_threads': Bool},
     outputs=[('tree', Phylogeny[Unrooted])],
     input_descriptions={
         'alignment': ('Aligned sequences to be used for phylogenetic '
@@ -117,7 +203,9 @@ plugin.methods.register_function(
                      'single-threading. See '
                      'http://www.microbesonline.org/fasttree/#OpenMP for '
                      'details. (Use `auto` to automatically use all available '
-                     'cores)'
+                     'cores)',
+        'timeout': _TIMEOUT_DESCRIPTION,
+        'tune_threads': _TUNE_THREADS_DESCRIPTION
     },
     output_descriptions={'tree': 'The resulting phylogenetic tree.'},
     name='Construct a phylogenetic tree with FastTree.',
@@ -134,7 +222,11 @@ plugin.methods.register_function(
             'n_searches': Int % Range(1, None),
             'n_threads': Threads,
             'substitution_model': Str % Choices(_RAXML_MODEL_OPT),
-            'raxml_version': Str % Choices(_RAXML_VERSION_OPT)},
+            'raxml_version': Str % Choices(_RAXML_VERSION_OPT),
+            'timeout': Int % Range(1, None),
+            'checkpoint_dir': Str,
+            'tune_threads': Bool,
+            'n_search_workers': Int % Range(1, None)},
     outputs=[('tree', Phylogeny[Unrooted])],
     input_descriptions={
         'alignment': ('Aligned sequences to be used for phylogenetic '
@@ -144,6 +236,15 @@ plugin.methods.register_function(
         'n_searches': ('The number of independent maximum likelihood '
                        'searches to perform. The single best scoring '
                        'tree is returned.'),
+        'n_search_workers': ('The number of searches to run at once. With '
+                             'more than one, each search is run as its own '
+                             'RAxML process, using `n_threads` threads and '
+                             'the seed plus the number of the search, and '
+                             'the tree with the highest likelihood is '
+                             'returned. This is often faster than more '
+                             'threads for alignments with few columns. '
+                             'With one, a single RAxML process runs the '
+                             'searches one after another.'),
         'n_threads': ('The number of threads to use for multithreaded '
                       'processing. Using more than one thread '
                       'will enable the PTHREADS version of RAxML.'),
@@ -151,11 +252,15 @@ plugin.methods.register_function(
                           'use. The SSE3 versions will run approximately 40% '
                           'faster than the standard version. The AVX2 '
                           'version will run 10-30% faster than the '
-                          'SSE3 version.'),
+                          'SSE3 version. `auto` uses the fastest version '
+                          'that is installed and that this CPU supports.'),
         'substitution_model': ('Model of Nucleotide Substitution.'),
         'seed': ('Random number seed for the parsimony starting tree. '
                  'This allows you to reproduce tree results. '
-                 'If not supplied then one will be randomly chosen.')},
+                 'If not supplied then one will be randomly chosen.'),
+        'timeout': _TIMEOUT_DESCRIPTION,
+        'checkpoint_dir': _CHECKPOINT_DIR_DESCRIPTION,
+        'tune_threads': _TUNE_THREADS_DESCRIPTION},
     output_descriptions={'tree': 'The resulting phylogenetic tree.'},
     name='Construct a phylogenetic tree with RAxML.',
     description=('Construct a phylogenetic tree with RAxML. See: '
@@ -173,7 +278,11 @@ plugin.methods.register_function(
             'bootstrap_replicates': Int % Range(10, None),
             'n_threads': Threads,
             'substitution_model': Str % Choices(_RAXML_MODEL_OPT),
-            'raxml_version': Str % Choices(_RAXML_VERSION_OPT)},
+            'raxml_version': Str % Choices(_RAXML_VERSION_OPT),
+            'timeout': Int % Range(1, None),
+            'checkpoint_dir': Str,
+            'tune_threads': Bool,
+            'n_bootstrap_shards': Int % Range(1, None)},
     outputs=[('tree', Phylogeny[Unrooted])],
     input_descriptions={
         'alignment': ('Aligned sequences to be used for phylogenetic '
@@ -187,7 +296,8 @@ plugin.methods.register_function(
                           'use. The SSE3 versions will run approximately 40% '
                           'faster than the standard version. The AVX2 '
                           'version will run 10-30% faster than the '
-                          'SSE3 version.'),
+                          'SSE3 version. `auto` uses the fastest version '
+                          'that is installed and that this CPU supports.'),
         'substitution_model': ('Model of Nucleotide Substitution'),
         'seed': ('Random number seed for the parsimony starting tree. '
                  'This allows you to reproduce tree results. '
@@ -197,7 +307,20 @@ plugin.methods.register_function(
                                  'rapid bootstrap results. If not supplied '
                                  'then one will be randomly chosen.'),
         'bootstrap_replicates': ('The number of bootstrap searches to '
-                                 'perform.')},
+                                 'perform.'),
+        'n_bootstrap_shards': ('The number of RAxML processes to split the '
+                               'bootstrap replicates between. With more '
+                               'than one, the shards, each using '
+                               '`n_threads` threads and the rapid bootstrap '
+                               'seed plus the number of the shard, run at '
+                               'the same time as a search for the best '
+                               'tree, and the support of all replicates is '
+                               'then drawn on that tree. With one, a single '
+                               'RAxML process runs the replicates and the '
+                               'search one after another.'),
+        'timeout': _TIMEOUT_DESCRIPTION,
+        'checkpoint_dir': _CHECKPOINT_DIR_DESCRIPTION,
+        'tune_threads': _TUNE_THREADS_DESCRIPTION},
     output_descriptions={'tree': 'The resulting phylogenetic tree.'},
     name='Construct a phylogenetic tree with bootstrap supports using RAxML.',
     description=('Construct a phylogenetic tree with RAxML with the addition '
@@ -228,7 +351,10 @@ plugin.methods.register_function(
             'abayes': Bool,
             'lbp': Int % Range(1000, None),
             'allnni': Bool,
-            'safe': Bool},
+            'safe': Bool,
+            'timeout': Int % Range(1, None),
+            'checkpoint_dir': Str,
+            'tune_threads': Bool},
     outputs=[('tree', Phylogeny[Unrooted])],
     input_descriptions={
         'alignment': ('Aligned sequences to be used for phylogenetic '
@@ -283,7 +409,10 @@ plugin.methods.register_function(
                 'Minimum of 1000 replicates is required. Can be used with '
                 'other \'single branch test methods\'. Values reported in '
                 'the order of: alrt, lbp, abayes.'),
-        'safe': ('Safe likelihood kernel to avoid numerical underflow.')},
+        'safe': ('Safe likelihood kernel to avoid numerical underflow.'),
+        'timeout': _TIMEOUT_DESCRIPTION,
+        'checkpoint_dir': _CHECKPOINT_DIR_DESCRIPTION,
+        'tune_threads': _TUNE_THREADS_DESCRIPTION},
     output_descriptions={'tree': 'The resulting phylogenetic tree.'},
     name='Construct a phylogenetic tree with IQ-TREE.',
     description=('Construct a phylogenetic tree using IQ-TREE '
@@ -317,7 +446,10 @@ plugin.methods.register_function(
             'lbp': Int % Range(1000, None),
             'bnni': Bool,
             'allnni': Bool,
-            'safe': Bool},
+            'safe': Bool,
+            'timeout': Int % Range(1, None),
+            'checkpoint_dir': Str,
+            'tune_threads': Bool},
     outputs=[('tree', Phylogeny[Unrooted])],
     input_descriptions={
         'alignment': ('Aligned sequences to be used for phylogenetic '
@@ -388,7 +520,10 @@ plugin.methods.register_function(
                 'Minimum of 1000 replicates is required. Can be used with '
                 'other \'single branch test methods\'. Values reported in '
                 'the order of: alrt, lbp, abayes, ufboot.'),
-        'safe': ('Safe likelihood kernel to avoid numerical underflow.')},
+        'safe': ('Safe likelihood kernel to avoid numerical underflow.'),
+        'timeout': _TIMEOUT_DESCRIPTION,
+        'checkpoint_dir': _CHECKPOINT_DIR_DESCRIPTION,
+        'tune_threads': _TUNE_THREADS_DESCRIPTION},
     output_descriptions={'tree': 'The resulting phylogenetic tree.'},
     name=('Construct a phylogenetic tree with IQ-TREE with bootstrap '
           'supports.'),
@@ -406,7 +541,7 @@ T1 = TypeMatch([Frequency, RelativeFrequency, PresenceAbsence])
 plugin.methods.register_function(
     function=q2_phylogeny.filter_table,
     inputs={'table': FeatureTable[T1],
-            'tree': Phylogeny[Rooted | Unrooted]},
+            'tree': Phylogeny[Rooted | Unrooted | Compact]},
     parameters={},
     outputs=[('filtered_table', FeatureTable[T1])],
     input_descriptions={
@@ -421,7 +556,7 @@ plugin.methods.register_function(
                  "are not tip identifiers in tree.")
 )
 
-T2 = TypeMatch([Rooted, Unrooted])
+T2 = TypeMatch([Rooted, Unrooted, Compact])
 
 T3 = (Frequency | RelativeFrequency | PresenceAbsence | Composition)
 
@@ -456,17 +591,85 @@ plugin.methods.register_function(
                  "set of provided identifiers.")
 )
 
+plugin.methods.register_function(
+    function=q2_phylogeny.filter_tree_batch,
+    inputs={'tree': Phylogeny[T2],
+            'tables': Collection[FeatureTable[T3]],
+            },
+    parameters={'metadata': Metadata,
+                'where': List[Str]
+                },
+    outputs=[('filtered_trees', Collection[Phylogeny[T2]])],
+    input_descriptions={
+        'tree': ('Tree that should be filtered'),
+        'tables': ('Feature tables, each of which contains the identifiers '
+                   'that should be retained in one filtered tree.'),
+    },
+    parameter_descriptions={
+        'metadata': ("Feature metadata to use with the 'where' statements. "
+                     "Metadata objects could also include "
+                     "FeatureData[Sequence] data types."),
+        'where': ('SQLite WHERE clauses, each specifying the feature '
+                  'metadata criteria that tips must meet to be retained in '
+                  'one filtered tree.'),
+    },
+    output_descriptions={
+        'filtered_trees': ('The resulting phylogenetic trees, keyed like the '
+                           'input tables, or as subset_1, subset_2, ... in '
+                           'the order of the where clauses.')},
+    name="Remove features from tree based on several subsets",
+    description=("Filter a tree to each of several sets of identifiers, "
+                 "given as feature tables or as metadata queries. The tree "
+                 "is indexed once for the whole batch.")
+)
+
+plugin.methods.register_function(
+    function=q2_phylogeny.filter_tree_collection,
+    inputs={'trees': TreeCollection,
+            'table': FeatureTable[T3],
+            },
+    parameters={'metadata': Metadata,
+                'where': Str
+                },
+    outputs=[('filtered_trees', TreeCollection)],
+    input_descriptions={
+        'trees': ('Trees that should each be filtered'),
+        'table': ('Feature table which contains the identifier that should be'
+                  ' retained in the trees'),
+    },
+    parameter_descriptions={
+        'metadata': ("Feature metadata to use with the 'where' statement or "
+                     "to select tips to be retained."),
+        'where': ('SQLite WHERE clause specifying the feature metadata '
+                  'criteria that tips must meet to be retained.'),
+    },
+    output_descriptions={'filtered_trees': 'The resulting trees, in the '
+                                           'order of the input trees.'},
+    name="Remove features from every tree of a collection",
+    description=("Remove tips from every tree of a tree collection, such as "
+                 "a set of bootstrap replicates, as `filter-tree` does for "
+                 "one tree. The trees are filtered one at a time.")
+)
+
 plugin.methods.register_function(
     function=q2_phylogeny.robinson_foulds,
-    inputs={'trees': List[Phylogeny[Rooted | Unrooted]]},
+    inputs={'trees': List[Phylogeny[Rooted | Unrooted | Compact]],
+            'tree_collection': TreeCollection},
     parameters={
         'labels': List[Str],
-        'missing_tips': Str % Choices('error', 'intersect-all')
+        'missing_tips': Str % Choices('error', 'intersect-all'),
+        'n_threads': Threads,
+        'method': Str % Choices('splits', 'hash'),
+        'exact': Bool,
+        'metric': Str % Choices('rf', 'weighted-rf', 'kf')
     },
     outputs=[('distance_matrix', DistanceMatrix)],
     input_descriptions={
         'trees': 'Phylogenetic trees to compare with Robinson-Foulds. Rooting'
-                 ' information and branch lengths are ignored by this metric.'
+                 ' information is ignored by these metrics, as are branch'
+                 ' lengths unless a length-aware metric is chosen.',
+        'tree_collection': 'A collection of trees, such as bootstrap'
+                           ' replicates, to compare instead of `trees`.'
     },
     parameter_descriptions={
         'labels': 'Labels to use for the tree names in the distance matrix.'
@@ -478,7 +681,30 @@ plugin.methods.register_function(
                         ' not identical between all input trees.'
                         ' "intersect-all" will remove tips that are not shared'
                         ' between all trees before computing distances beteen'
-                        ' trees.'
+                        ' trees.',
+        'n_threads': 'The number of processes used to compute pairwise'
+                     ' distances. Blocks of rows of the distance matrix are'
+                     ' divided between processes. (Use `auto` to'
+                     ' automatically use all available cores). Only used with'
+                     ' method "splits".',
+        'method': 'How pairwise distances are computed. "splits" compares'
+                  ' the clade sets of every pair of trees. "hash" hashes'
+                  ' every clade of every tree into one shared table and'
+                  ' derives all distances from it (HashRF), which is much'
+                  ' faster for large collections of trees.',
+        'exact': 'When using method "hash", keep the tip set of every clade'
+                 ' so that clades whose hashes collide are still told apart.'
+                 ' Without this, a collision (which is extremely unlikely)'
+                 ' would make the result approximate.',
+        'metric': 'The distance to compute. "rf" counts the clades found in'
+                  ' only one of the two trees. "weighted-rf" sums the'
+                  ' absolute differences in branch length over all branches'
+                  ' of both trees, and "kf" is the Kuhner-Felsenstein branch'
+                  ' score, the square root of the summed squared'
+                  ' differences. For the length-aware metrics, a branch'
+                  ' missing from one tree counts as length zero there, as'
+                  ' do branches without a length. These require method'
+                  ' "splits".'
     },
     output_descriptions={
         'distance_matrix': 'The distances between trees as a symmetric matrix.'
@@ -486,7 +712,50 @@ plugin.methods.register_function(
     name="Calculate Robinson-Foulds distance between phylogenetic trees.",
     description="Calculate the Robinson-Foulds symmetric difference metric"
                 " between two or more phylogenetic trees.",
-    citations=[citations['robinson1981comparison']]
+    citations=[citations['robinson1981comparison'],
+               citations['sul2008hashrf'],
+               citations['kuhner1994simulation']]
+)
+
+plugin.methods.register_function(
+    function=q2_phylogeny.robinson_foulds_reference,
+    inputs={'trees': List[Phylogeny[Rooted | Unrooted | Compact]],
+            'reference': Phylogeny[Rooted | Unrooted | Compact]},
+    parameters={
+        'labels': List[Str],
+        'missing_tips': Str % Choices('error', 'intersect-all'),
+        'metric': Str % Choices('rf', 'weighted-rf', 'kf')
+    },
+    outputs=[('distances', ImmutableMetadata)],
+    input_descriptions={
+        'trees': 'Phylogenetic trees to compare to the reference tree.',
+        'reference': 'The tree that every other tree is compared to.'
+    },
+    parameter_descriptions={
+        'labels': 'Labels to use for the tree names in the output.'
+                  ' If ommited, labels will be "tree_n" where "n" ranges from'
+                  ' 1..N. The number of labels must match the number of'
+                  ' trees.',
+        'missing_tips': 'How to handle tips that are not shared between trees.'
+                        ' "error" will raise an error if the set of tips is'
+                        ' not identical between the reference and all input'
+                        ' trees. "intersect-all" will remove tips that are'
+                        ' not shared between the reference and all trees'
+                        ' before computing distances.',
+        'metric': 'The distance to compute. See `robinson-foulds` for a'
+                  ' description of each metric.'
+    },
+    output_descriptions={
+        'distances': 'The distance from each tree to the reference tree.'
+    },
+    name="Calculate Robinson-Foulds distance from trees to a reference tree.",
+    description="Calculate the Robinson-Foulds symmetric difference metric"
+                " between each of a set of phylogenetic trees and a single"
+                " reference tree. Unlike `robinson-foulds`, which compares"
+                " all pairs of trees, only the distance from each tree to"
+                " the reference is computed.",
+    citations=[citations['robinson1981comparison'],
+               citations['kuhner1994simulation']]
 )
 
 plugin.pipelines.register_function(
@@ -713,7 +982,8 @@ plugin.pipelines.register_function(
                           'use. The SSE3 versions will run approximately 40% '
                           'faster than the standard version. The AVX2 '
                           'version will run 10-30% faster than the '
-                          'SSE3 version.'),
+                          'SSE3 version. `auto` uses the fastest version '
+                          'that is installed and that this CPU supports.'),
         'substitution_model': ('Model of Nucleotide Substitution.'),
     },
     output_descriptions={
@@ -736,3 +1006,5 @@ plugin.pipelines.register_function(
                  'methods.'
                  )
 )
+
+importlib.import_module('q2_phylogeny._transformer')
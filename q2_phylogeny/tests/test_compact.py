@@ -0,0 +1,243 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016-2023, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import io
+import tempfile
+import unittest
+
+import numpy as np
+import skbio
+from qiime2.plugin.testing import TestPluginBase
+from q2_types.tree import NewickFormat, Phylogeny
+
+from q2_phylogeny._compact import CompactTree, CompactTreeCollection
+from q2_phylogeny._format import (CompactTreeDirectoryFormat,
+                                  MultiNewickFormat,
+                                  TreeCollectionDirectoryFormat)
+from q2_phylogeny._type import Compact
+
+
+class CompactTreeTests(TestPluginBase):
+
+    package = 'q2_phylogeny.tests'
+
+    nwk = "((a:1.0,b:2.0)c:3.0,d:4.0,((e:1.0)f,a:2.0)g:0.5)root;\n"
+
+    def test_arrays(self):
+        tree = CompactTree.from_newick(self.nwk)
+
+        np.testing.assert_array_equal(tree.parents,
+                                      [-1, 0, 1, 1, 0, 0, 5, 6, 5])
+        np.testing.assert_array_equal(tree.n_children,
+                                      [3, 2, 0, 0, 0, 2, 1, 0, 0])
+        np.testing.assert_array_equal(tree.child_offsets,
+                                      [0, 3, 5, 5, 5, 5, 7, 8, 8, 8])
+        np.testing.assert_array_equal(tree.children,
+                                      [1, 4, 5, 2, 3, 6, 8, 7])
+        np.testing.assert_array_equal(tree.lengths,
+                                      [np.nan, 3, 1, 2, 4, 0.5, np.nan, 1, 2])
+        # each distinct name is stored once
+        self.assertEqual(sorted(tree.names), ['a', 'b', 'c', 'd', 'e', 'f',
+                                              'g', 'root'])
+        self.assertEqual(tree.name_ids[2], tree.name_ids[8])
+        self.assertEqual(tree.node_names(), ['root', 'c', 'a', 'b', 'd', 'g',
+                                             'f', 'e', 'a'])
+
+    def test_postorder(self):
+        tree = CompactTree.from_newick(self.nwk)
+        expected = [n.name for n in skbio.TreeNode.read(
+            io.StringIO(self.nwk)).postorder()]
+
+        names = tree.node_names()
+        self.assertEqual([names[i] for i in tree.postorder], expected)
+
+    def test_tips(self):
+        tree = CompactTree.from_newick(self.nwk)
+
+        np.testing.assert_array_equal(tree.tips(), [2, 3, 4, 7, 8])
+        self.assertEqual(tree.tip_names(), ['a', 'b', 'd', 'e', 'a'])
+
+    def test_treenode_roundtrip(self):
+        expected = skbio.TreeNode.read(io.StringIO(self.nwk))
+
+        tree = CompactTree.from_treenode(expected)
+        obs = tree.to_treenode()
+
+        self.assertIsInstance(obs, skbio.TreeNode)
+        self.assertEqual(str(tree), str(expected))
+        self.assertEqual(str(obs), str(expected))
+
+    def test_deep_tree(self):
+        # a caterpillar deeper than the recursion limit
+        n = 5000
+        tree = CompactTree.from_newick('(' * n + 'a' + ',b)' * n + ';')
+
+        self.assertEqual(len(tree.tips()), n + 1)
+        self.assertEqual(tree.postorder[0], n)
+        self.assertEqual(tree.postorder[-1], 0)
+        self.assertEqual(str(CompactTree.from_treenode(tree.to_treenode())),
+                         str(tree))
+
+    def test_not_preorder(self):
+        with self.assertRaisesRegex(ValueError, 'preorder'):
+            CompactTree([-1, 2, 0], [1.0] * 3, [-1] * 3, [])
+        with self.assertRaisesRegex(ValueError, 'preorder'):
+            CompactTree([0, -1], [1.0] * 2, [-1] * 2, [])
+
+    def test_transformers(self):
+        read = self.get_transformer(NewickFormat, CompactTree)
+        write = self.get_transformer(CompactTree, NewickFormat)
+        ff = NewickFormat()
+        with ff.open() as fh:
+            fh.write(self.nwk)
+
+        tree = read(ff)
+        self.assertIsInstance(tree, CompactTree)
+        with write(tree).open() as fh:
+            self.assertEqual(fh.read(), self.nwk)
+
+    def test_save_load(self):
+        tree = CompactTree.from_newick(
+            "(('a b':1.0,'c''d':2.0)'é':3.0,e:4.0);")
+
+        with tempfile.TemporaryDirectory() as directory:
+            tree.save(directory)
+            obs = CompactTree.load(directory)
+
+            self.assertIsInstance(obs.parents, np.memmap)
+            self.assertEqual(obs.names, tree.names)
+            for name in ('parents', 'lengths', 'name_ids', 'n_children',
+                         'child_offsets', 'children', 'last_descendants',
+                         'postorder'):
+                np.testing.assert_array_equal(getattr(obs, name),
+                                              getattr(tree, name))
+            self.assertEqual(str(obs), str(tree))
+            del obs
+
+    def test_save_load_single_node(self):
+        tree = CompactTree([-1], [np.nan], [-1], [])
+
+        with tempfile.TemporaryDirectory() as directory:
+            tree.save(directory)
+            obs = CompactTree.load(directory, mmap_mode=None)
+
+        self.assertEqual(obs.names, [])
+        self.assertEqual(str(obs), ';\n')
+
+    def test_directory_format_transformers(self):
+        to_dir = self.get_transformer(CompactTree, CompactTreeDirectoryFormat)
+        from_dir = self.get_transformer(CompactTreeDirectoryFormat,
+                                        CompactTree)
+        tree = CompactTree.from_newick(self.nwk)
+
+        ff = to_dir(tree)
+        ff.validate()
+        self.assertEqual(str(from_dir(ff)), self.nwk)
+
+    def test_directory_format_newick_transformers(self):
+        to_dir = self.get_transformer(NewickFormat, CompactTreeDirectoryFormat)
+        to_newick = self.get_transformer(CompactTreeDirectoryFormat,
+                                         NewickFormat)
+        ff = NewickFormat()
+        with ff.open() as fh:
+            fh.write(self.nwk)
+
+        with to_newick(to_dir(ff)).open() as fh:
+            self.assertEqual(fh.read(), self.nwk)
+
+    def test_directory_format_treenode_transformers(self):
+        to_dir = self.get_transformer(skbio.TreeNode,
+                                      CompactTreeDirectoryFormat)
+        to_treenode = self.get_transformer(CompactTreeDirectoryFormat,
+                                           skbio.TreeNode)
+        expected = skbio.TreeNode.read(io.StringIO(self.nwk))
+
+        obs = to_treenode(to_dir(expected))
+
+        self.assertIsInstance(obs, skbio.TreeNode)
+        self.assertEqual(str(obs), str(expected))
+
+    def test_compact_semantic_type_registration(self):
+        self.assertRegisteredSemanticType(Compact)
+
+    def test_compact_phylogeny_to_directory_format_registration(self):
+        self.assertSemanticTypeRegisteredToFormat(
+            Phylogeny[Compact], CompactTreeDirectoryFormat)
+
+
+class CompactTreeCollectionTests(TestPluginBase):
+
+    package = 'q2_phylogeny.tests'
+
+    nwk = ("((a:1.0,b:2.0)c:3.0,d:4.0);\n"
+           "(a:1.0,(b:2.0,d:3.0):4.0);\n"
+           "((d:1.0,'x;y':2.0):3.0,a:4.0)'r\n;':0.5;\n")
+
+    def test_from_newick(self):
+        trees = CompactTreeCollection.from_newick(self.nwk)
+
+        self.assertEqual(len(trees), 3)
+        self.assertEqual([str(tree) for tree in trees],
+                         self.nwk.splitlines(keepends=True)[:2] +
+                         ["((d:1.0,'x;y':2.0):3.0,a:4.0)'r\n;':0.5;\n"])
+        np.testing.assert_array_equal(trees.tree_offsets, [0, 5, 10, 15])
+        # the tip names of every tree are stored once
+        self.assertEqual(sorted(trees.names),
+                         ['a', 'b', 'c', 'd', 'r\n;', 'x;y'])
+        self.assertIs(trees[0].names, trees.names)
+        self.assertEqual(str(trees[-1]), str(trees[2]))
+        with self.assertRaises(IndexError):
+            trees[3]
+
+    def test_from_trees(self):
+        trees = [skbio.TreeNode.read([line])
+                 for line in self.nwk.splitlines()[:2]]
+
+        obs = CompactTreeCollection.from_trees(trees)
+
+        self.assertEqual([str(tree) for tree in obs],
+                         [str(tree) for tree in trees])
+        with self.assertRaisesRegex(ValueError, 'at least one'):
+            CompactTreeCollection.from_trees([])
+
+    def test_from_newick_missing_semicolon(self):
+        with self.assertRaisesRegex(skbio.io.NewickFormatError, 'unbalanced'):
+            CompactTreeCollection.from_newick("(a,b);\n(a,b)\n")
+
+    def test_save_load(self):
+        trees = CompactTreeCollection.from_newick(self.nwk)
+
+        with tempfile.TemporaryDirectory() as directory:
+            trees.save(directory)
+            obs = CompactTreeCollection.load(directory)
+
+            self.assertEqual(obs.names, trees.names)
+            self.assertEqual([str(tree) for tree in obs],
+                             [str(tree) for tree in trees])
+            del obs
+
+    def test_transformers(self):
+        to_dir = self.get_transformer(MultiNewickFormat,
+                                      TreeCollectionDirectoryFormat)
+        to_newick = self.get_transformer(TreeCollectionDirectoryFormat,
+                                         MultiNewickFormat)
+        read = self.get_transformer(TreeCollectionDirectoryFormat,
+                                    CompactTreeCollection)
+        ff = MultiNewickFormat()
+        with ff.open() as fh:
+            fh.write(self.nwk)
+
+        dir_ff = to_dir(ff)
+        dir_ff.validate()
+        self.assertEqual(len(read(dir_ff)), 3)
+        with to_newick(dir_ff).open() as fh:
+            self.assertEqual(fh.read(), self.nwk)
+
+
+if __name__ == "__main__":
+    unittest.main()
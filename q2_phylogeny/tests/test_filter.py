@@ -7,16 +7,22 @@
 # ----------------------------------------------------------------------------
 
 import unittest
+import unittest.mock
 import io
 
 import numpy as np
 import pandas as pd
 from biom.table import Table
+import h5py
 import skbio
 
 from qiime2 import Metadata
+from q2_types.feature_table import BIOMV210Format
 
-from q2_phylogeny import (filter_table, filter_tree)
+from q2_phylogeny import (filter_table, filter_tree, filter_tree_batch,
+                          filter_tree_collection)
+from q2_phylogeny._compact import CompactTreeCollection
+from q2_phylogeny._filter import _as_compact
 
 
 class FilterTableTests(unittest.TestCase):
@@ -51,6 +57,35 @@ class FilterTableTests(unittest.TestCase):
         expected = table.filter(['O1', 'O2'], axis='observation')
         self.assertEqual(actual, expected)
 
+    def test_tree_filter_table_from_file(self):
+        rooted_nwk = io.StringIO("(O1:4.5,(O3:4,(a:1,b:1):2):0.5);")
+        tree = skbio.TreeNode.read(rooted_nwk)
+        table = Table(np.array([[0, 1, 3], [1, 1, 2], [0, 0, 0], [4, 0, 1]]),
+                      ['O1', 'O2', 'O3', 'O4'],
+                      ['S1', 'S2', 'S3'],
+                      type='OTU table')
+        fmt = BIOMV210Format()
+        with h5py.File(str(fmt), 'w') as fh:
+            table.to_hdf5(fh, 'test')
+        actual = filter_table(fmt, tree)
+        expected = table.filter(['O1', 'O3'], axis='observation',
+                                inplace=False)
+        self.assertEqual(actual, expected)
+        self.assertEqual(actual.type, 'OTU table')
+
+    def test_tree_filter_table_from_file_none(self):
+        rooted_nwk = io.StringIO("(O1:4.5,(d:4,(a:1,b:1):2):0.5);")
+        tree = skbio.TreeNode.read(rooted_nwk)
+        table = Table(np.array([[0, 1, 3], [1, 1, 2]]),
+                      ['O2', 'O3'],
+                      ['S1', 'S2', 'S3'])
+        fmt = BIOMV210Format()
+        with h5py.File(str(fmt), 'w') as fh:
+            table.to_hdf5(fh, 'test')
+        actual = filter_table(fmt, tree)
+        self.assertEqual(actual.shape, (0, 3))
+        self.assertEqual(list(actual.ids()), ['S1', 'S2', 'S3'])
+
 
 class FilterTreeTests(unittest.TestCase):
     def setUp(self):
@@ -122,6 +157,108 @@ class FilterTreeTests(unittest.TestCase):
         test = filter_tree(self.tree, table=self.table)
         self.assertEqual(str(test), str(self.filtered_tree))
 
+    def test_filter_tree_collapses_like_prune(self):
+        tree = skbio.TreeNode.read(io.StringIO(
+            "(((A:1,B:2)C:3,(D:4,E)F:5)G:6,((H:7,I:8)J,K:9)L:1)root;"))
+        original = str(tree)
+        ids = ['A', 'D', 'H', 'I', 'K']
+        expected = tree.shear(ids)
+        expected.prune()
+
+        test = filter_tree(tree, metadata=Metadata(pd.DataFrame(
+            {'keep': ['1'] * len(ids)},
+            index=pd.Index(ids, name='feature-id'))))
+        self.assertEqual(str(test), str(expected))
+        self.assertEqual(str(tree), original)
+
+    def test_filter_tree_single_child_root(self):
+        tree = skbio.TreeNode.read(io.StringIO(
+            "(((A:1,B:2)C:3,D:4)E:5,F:6)root;"))
+        table = Table(data=np.array([[1], [1]]),
+                      observation_ids=['A', 'B'],
+                      sample_ids=['S1'])
+        expected = tree.shear(['A', 'B'])
+        expected.prune()
+
+        test = filter_tree(tree, table=table)
+        self.assertEqual(str(test), str(expected))
+        self.assertEqual(str(test), "(A:1.0,B:2.0)C:8.0;\n")
+
+    def test_filter_tree_collection(self):
+        nwk = ["(((A:1,B:2)C:3,D:4)E:5,F:6)root;",
+               "((A:1,D:2)X:3,(B:4,F:5)Y:6)root;"]
+        trees = CompactTreeCollection.from_newick('\n'.join(nwk))
+        table = Table(data=np.array([[1], [1], [1]]),
+                      observation_ids=['A', 'B', 'F'],
+                      sample_ids=['S1'])
+        expected = []
+        for text in nwk:
+            tree = skbio.TreeNode.read([text]).shear(['A', 'B', 'F'])
+            tree.prune()
+            expected.append(str(tree))
+
+        for test in (filter_tree(trees, table=table),
+                     filter_tree_collection(trees, table=table)):
+            self.assertIsInstance(test, CompactTreeCollection)
+            self.assertEqual([str(tree) for tree in test], expected)
+
+    def test_filter_tree_collection_error_filter_superset(self):
+        trees = CompactTreeCollection.from_newick("(A,B,Z);\n(A,B);\n")
+        table = Table(np.array([[1], [1]]), ['A', 'Z'], ['S1'])
+
+        with self.assertRaisesRegex(ValueError, 'must be a subset'):
+            filter_tree(trees, table=table)
+
+
+class FilterTreeBatchTests(unittest.TestCase):
+    def setUp(self):
+        self.tree = skbio.TreeNode.read(io.StringIO(
+            "(((A:1,B:2)C:3,D:4)E:5,(F:6,G:7)H:8)root;"))
+        self.metadata = Metadata(pd.DataFrame(
+            {'group': ['x', 'x', 'y', 'y', 'x']},
+            index=pd.Index(['A', 'B', 'D', 'F', 'G'], name='feature-id')))
+
+    def expected(self, ids):
+        expected = self.tree.shear(ids)
+        expected.prune()
+        return str(expected)
+
+    def test_filter_tree_batch_tables(self):
+        tables = {
+            'ab': Table(np.array([[1], [1]]), ['A', 'B'], ['S1']),
+            'adg': Table(np.array([[1], [2], [3]]), ['A', 'D', 'G'], ['S1']),
+        }
+        obs = filter_tree_batch(self.tree, tables=tables)
+        self.assertEqual(list(obs), ['ab', 'adg'])
+        self.assertEqual(str(obs['ab']), self.expected(['A', 'B']))
+        self.assertEqual(str(obs['adg']), self.expected(['A', 'D', 'G']))
+
+    def test_filter_tree_batch_where(self):
+        obs = filter_tree_batch(
+            self.tree, metadata=self.metadata,
+            where=["[group]='x'", "[group]='y'"])
+        self.assertEqual(list(obs), ['subset_1', 'subset_2'])
+        self.assertEqual(str(obs['subset_1']),
+                         self.expected(['A', 'B', 'G']))
+        self.assertEqual(str(obs['subset_2']), self.expected(['D', 'F']))
+
+    def test_filter_tree_batch_converts_tree_once(self):
+        tables = {str(i): Table(np.array([[1], [1]]), ['A', 'F'], ['S1'])
+                  for i in range(3)}
+        with unittest.mock.patch('q2_phylogeny._filter._as_compact',
+                                 wraps=_as_compact) as index:
+            filter_tree_batch(self.tree, tables=tables)
+        index.assert_called_once()
+
+    def test_filter_tree_batch_error_metadata_no_where(self):
+        with self.assertRaisesRegex(ValueError, "'where' must be provided"):
+            filter_tree_batch(self.tree, metadata=self.metadata)
+
+    def test_filter_tree_batch_error_filter_superset(self):
+        tables = {'a': Table(np.array([[1], [1]]), ['A', 'Z'], ['S1'])}
+        with self.assertRaisesRegex(ValueError, 'must be a subset'):
+            filter_tree_batch(self.tree, tables=tables)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,127 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016-2023, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import os
+import unittest
+
+import numpy as np
+from qiime2.plugin import ValidationError
+from qiime2.plugin.testing import TestPluginBase
+
+from q2_phylogeny._compact import CompactTree, CompactTreeCollection
+from q2_phylogeny._format import (NpyFormat, CompactTreeDirectoryFormat,
+                                  MultiNewickFormat,
+                                  TreeCollectionDirectoryFormat)
+
+
+class CompactTreeDirectoryFormatTests(TestPluginBase):
+
+    package = 'q2_phylogeny.tests'
+
+    def _saved(self, nwk="((a:1.0,b:2.0)c:3.0,d:4.0);"):
+        ff = CompactTreeDirectoryFormat()
+        CompactTree.from_newick(nwk).save(str(ff))
+        return ff
+
+    def _path(self, ff, name):
+        return os.path.join(str(ff), name + '.npy')
+
+    def test_valid(self):
+        ff = CompactTreeDirectoryFormat(str(self._saved()), mode='r')
+
+        ff.validate()
+
+    def test_npy_format_invalid(self):
+        path = self._path(self._saved(), 'parents')
+        with open(path, 'w') as fh:
+            fh.write('(a,b);\n')
+        ff = NpyFormat(path, mode='r')
+
+        with self.assertRaisesRegex(ValidationError, 'NumPy'):
+            ff.validate()
+
+    def test_wrong_shape(self):
+        ff = self._saved()
+        np.save(self._path(ff, 'lengths'), np.zeros(2))
+
+        with self.assertRaisesRegex(ValidationError, 'lengths.*shape'):
+            CompactTreeDirectoryFormat(str(ff), mode='r').validate()
+
+    def test_name_id_outside_table(self):
+        ff = self._saved()
+        np.save(self._path(ff, 'name_ids'), np.arange(5) + 1)
+
+        with self.assertRaisesRegex(ValidationError, 'name table'):
+            CompactTreeDirectoryFormat(str(ff), mode='r').validate()
+
+    def test_arrays_do_not_match_parents(self):
+        ff = self._saved()
+        np.save(self._path(ff, 'postorder'), np.arange(5))
+
+        CompactTreeDirectoryFormat(str(ff), mode='r').validate(level='min')
+        with self.assertRaisesRegex(ValidationError, 'postorder'):
+            CompactTreeDirectoryFormat(str(ff), mode='r').validate()
+
+
+class TreeCollectionFormatTests(TestPluginBase):
+
+    package = 'q2_phylogeny.tests'
+
+    def _saved(self, nwk="(a:1.0,b:2.0);\n((a,b),c);\n"):
+        ff = TreeCollectionDirectoryFormat()
+        CompactTreeCollection.from_newick(nwk).save(str(ff))
+        return ff
+
+    def _path(self, ff, name):
+        return os.path.join(str(ff), name + '.npy')
+
+    def _multi_newick(self, text):
+        ff = MultiNewickFormat()
+        with ff.open() as fh:
+            fh.write(text)
+        return MultiNewickFormat(str(ff), mode='r')
+
+    def test_directory_format_valid(self):
+        ff = TreeCollectionDirectoryFormat(str(self._saved()), mode='r')
+
+        ff.validate()
+
+    def test_directory_format_bad_offsets(self):
+        ff = self._saved()
+        np.save(self._path(ff, 'tree_offsets'), np.array([0, 3, 6]))
+
+        with self.assertRaisesRegex(ValidationError, 'offsets'):
+            TreeCollectionDirectoryFormat(str(ff), mode='r').validate()
+
+    def test_directory_format_not_preorder(self):
+        ff = self._saved()
+        np.save(self._path(ff, 'parents'), np.array([-1, 0, 0, -1, 2, 1, 1,
+                                                     0]))
+
+        TreeCollectionDirectoryFormat(str(ff), mode='r').validate(
+            level='min')
+        with self.assertRaisesRegex(ValidationError, 'preorder'):
+            TreeCollectionDirectoryFormat(str(ff), mode='r').validate()
+
+    def test_multi_newick_valid(self):
+        self._multi_newick("(a,b);\n((a,b),c);\n").validate()
+
+    def test_multi_newick_invalid_tree(self):
+        ff = self._multi_newick("(a,b);\n((a,b),c;\n")
+
+        ff.validate(level='min')
+        with self.assertRaisesRegex(ValidationError, 'Tree 2'):
+            ff.validate()
+
+    def test_multi_newick_empty(self):
+        with self.assertRaisesRegex(ValidationError, 'no trees'):
+            self._multi_newick("\n").validate()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -9,14 +9,17 @@
 from itertools import zip_longest
 import math
 import os
+import subprocess
 import tempfile
 import unittest
+import unittest.mock
 
 import skbio
 from qiime2.plugin.testing import TestPluginBase
 from qiime2.util import redirected_stdio
 from q2_types.feature_data import AlignedDNAFASTAFormat
 
+import q2_phylogeny._iqtree
 from q2_phylogeny import iqtree, iqtree_ultrafast_bootstrap
 from q2_phylogeny._raxml import run_command
 from q2_phylogeny._iqtree import (_build_iqtree_command,
@@ -469,5 +472,72 @@ class IqtreeRunCommandTests(TestPluginBase):
                               'GCA900007555']))
 
 
+class IqtreeCheckpointTests(TestPluginBase):
+
+    package = 'q2_phylogeny.tests'
+
+    def setUp(self):
+        super().setUp()
+        self.checkpoint_dir = os.path.join(self.temp_dir.name, 'checkpoints')
+        self.input_sequences = AlignedDNAFASTAFormat(
+            self.get_data_path('aligned-dna-sequences-3.fasta'), mode='r')
+        self.stop_run = False
+
+    def _run_command(self, cmd, timeout):
+        # writes a checkpoint, and the tree and report unless the run fails
+        run_prefix = cmd[cmd.index('-pre') + 1]
+        open(run_prefix + '.ckp.gz', 'w').close()
+        if self.stop_run:
+            raise subprocess.CalledProcessError(-9, cmd)
+        for suffix in ('.treefile', '.iqtree'):
+            with open(run_prefix + suffix, 'w') as fh:
+                fh.write('(a,(b,c));\n')
+
+    def _run(self, action, **kwargs):
+        with unittest.mock.patch.object(
+                q2_phylogeny._iqtree, 'run_command',
+                side_effect=self._run_command) as run, \
+                redirected_stdio(stdout=os.devnull):
+            action(self.input_sequences, checkpoint_dir=self.checkpoint_dir,
+                   **kwargs)
+        return [c.args[0] for c in run.call_args_list]
+
+    def test_resume(self):
+        self.stop_run = True
+        with self.assertRaises(subprocess.CalledProcessError):
+            self._run(iqtree, seed=1723, n_cores=2)
+        work_dir, = os.listdir(self.checkpoint_dir)
+
+        # a different number of threads still resumes the run
+        self.stop_run = False
+        cmd, = self._run(iqtree, seed=1723, n_cores=4)
+
+        run_prefix = cmd[cmd.index('-pre') + 1]
+        self.assertEqual(run_prefix, os.path.join(self.checkpoint_dir,
+                                                  work_dir, 'q2iqtree'))
+        self.assertNotIn('-redo', cmd)
+        self.assertEqual(os.listdir(self.checkpoint_dir), [])
+
+    def test_finished_run_reused(self):
+        # IQ-TREE finishes, but the job is stopped before the tree is kept
+        with unittest.mock.patch('shutil.move', side_effect=OSError):
+            with self.assertRaises(OSError):
+                self._run(iqtree_ultrafast_bootstrap, seed=1723)
+
+        cmds = self._run(iqtree_ultrafast_bootstrap, seed=1723)
+
+        self.assertEqual(cmds, [])
+        self.assertEqual(os.listdir(self.checkpoint_dir), [])
+
+    def test_other_parameters_start_over(self):
+        self.stop_run = True
+        with self.assertRaises(subprocess.CalledProcessError):
+            self._run(iqtree, seed=1723)
+        with self.assertRaises(subprocess.CalledProcessError):
+            self._run(iqtree, seed=1723, substitution_model='HKY')
+
+        self.assertEqual(len(os.listdir(self.checkpoint_dir)), 2)
+
+
 if __name__ == "__main__":
     unittest.main()
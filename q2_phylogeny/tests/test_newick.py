@@ -0,0 +1,116 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016-2023, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import io
+import unittest
+
+import numpy as np
+import skbio
+from skbio.io import NewickFormatError
+from qiime2.plugin.testing import TestPluginBase
+
+from q2_phylogeny._compact import CompactTree
+from q2_phylogeny._newick import _read_newick
+
+
+def _roundtrip(text):
+    return str(CompactTree.from_newick(text))
+
+
+class NewickTests(TestPluginBase):
+
+    package = 'q2_phylogeny.tests'
+
+    def test_read(self):
+        parents, lengths, name_ids, names = _read_newick(
+            "((a:1,b_c:2)d:3,'e_f':4.5,(g)[comment])root;")
+        np.testing.assert_array_equal(parents, [-1, 0, 1, 1, 0, 0, 5])
+        np.testing.assert_array_equal(
+            lengths, [np.nan, 3.0, 1.0, 2.0, 4.5, np.nan, np.nan])
+        self.assertEqual([names[i] if i >= 0 else None for i in name_ids],
+                         ['root', 'd', 'a', 'b c', 'e_f', None, 'g'])
+
+    def test_read_quoted_labels(self):
+        tree = CompactTree.from_newick("('a,b':1,'it''s':2,'c_d':3);")
+        self.assertEqual(tree.node_names(), [None, 'a,b', "it's", 'c_d'])
+
+    def test_read_escaped_quotes(self):
+        texts = ["(O''Brien:1,'it''s':2,a''_b'':3,c'_d''':4,'''x':5)r;",
+                 "('':1,'''':2)r;"]
+        for text in texts:
+            expected = skbio.TreeNode.read(io.StringIO(text))
+            tree = CompactTree.from_newick(text)
+            self.assertEqual(tree.node_names(),
+                             [node.name for node in expected.preorder()])
+
+    def test_roundtrip_escaped_quote(self):
+        # skbio writes a name with a quote, and no other operators, unquoted
+        # with the quote escaped
+        text = str(skbio.TreeNode.read(io.StringIO("(a,('O''Brien',b));")))
+        self.assertIn("O''Brien", text)
+
+        tree = CompactTree.from_newick(_roundtrip(text))
+
+        expected = skbio.TreeNode.read(io.StringIO(text))
+        self.assertIn("O'Brien", tree.tip_names())
+        self.assertEqual(tree.tip_names(),
+                         [tip.name for tip in expected.tips()])
+
+    def test_read_fasttree_quoted_labels(self):
+        # as written by FastTree -quote, with support values as unquoted
+        # internal node labels
+        tree = CompactTree.from_newick(
+            "('seq 1':0.1,'seq(2)':0.2,('seq:3':0.05,'seq,4':0.3)0.950:0.01"
+            ");\n")
+        self.assertEqual(tree.tip_names(),
+                         ['seq 1', 'seq(2)', 'seq:3', 'seq,4'])
+        self.assertEqual(tree.node_names()[3], '0.950')
+        np.testing.assert_array_equal(tree.lengths,
+                                      [np.nan, 0.1, 0.2, 0.01, 0.05, 0.3])
+
+    def test_read_whitespace_and_comments(self):
+        tree = CompactTree.from_newick(
+            b"(\n  a [it's] : 1 ,\n  'b c'[x]:2\n) [y] r ;")
+        self.assertEqual(tree.node_names(), ['r', 'a', 'b c'])
+        np.testing.assert_array_equal(tree.lengths, [np.nan, 1.0, 2.0])
+
+    def test_read_unescaped_whitespace(self):
+        with self.assertRaisesRegex(NewickFormatError, 'whitespace'):
+            _read_newick("(a b,c);")
+
+    def test_read_deep(self):
+        n = 100000
+        tree = CompactTree.from_newick('(' * n + 'a' + ',b)' * n + ';')
+        self.assertEqual(len(tree), 2 * n + 1)
+        np.testing.assert_array_equal(tree.parents[1:n + 1], np.arange(n))
+
+    def test_roundtrip_matches_skbio(self):
+        texts = ["((a:1,b_c:2)d:3,'e_f':4.5,(g)[comment])root;",
+                 "('a,b':1,'it''s':2,'x y':1e-05,(c:0)'[d]':3);\n",
+                 "(((a)b)c);",
+                 "a;"]
+        for fn in ['test.tre', 'test2.tre', 'test3.tre']:
+            with open(self.get_data_path(fn)) as fh:
+                texts.append(fh.read())
+        for text in texts:
+            expected = str(skbio.TreeNode.read(io.StringIO(text)))
+            self.assertEqual(_roundtrip(text), expected)
+
+    def test_unbalanced(self):
+        for text in ["((a,b);", "(a,b));", "(a,b)", "(a,'b);", "(a,b[c);",
+                     "a,b;"]:
+            with self.assertRaises(NewickFormatError):
+                _read_newick(text)
+
+    def test_bad_length(self):
+        with self.assertRaisesRegex(NewickFormatError, 'numeric'):
+            _read_newick("(a:x,b:1);")
+
+
+if __name__ == '__main__':
+    unittest.main()
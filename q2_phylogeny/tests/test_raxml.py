@@ -9,7 +9,10 @@
 import os
 import pkg_resources
 import shutil
+import signal
+import subprocess
 import unittest
+import unittest.mock
 import skbio
 import tempfile
 
@@ -17,9 +20,12 @@ from qiime2.plugin.testing import TestPluginBase
 from qiime2.util import redirected_stdio
 from q2_types.feature_data import AlignedDNAFASTAFormat
 
+import q2_phylogeny._raxml
 from q2_phylogeny import raxml, raxml_rapid_bootstrap
 from q2_phylogeny._raxml import (run_command, _build_rapid_bootstrap_command,
-                                 _set_raxml_version)
+                                 _set_raxml_version, _cpu_flags,
+                                 _supported_raxml_versions, _run_raxml,
+                                 _final_likelihood)
 
 
 class RaxmlTests(TestPluginBase):
@@ -224,6 +230,19 @@ class RaxmlTests(TestPluginBase):
         exp_series = set(['%.4f' % e for e in exp_tl])
         self.assertEqual(obs_series, exp_series)
 
+    def test_raxml_concurrent_searches(self):
+        input_fp = self.get_data_path('aligned-dna-sequences-3.fasta')
+        input_sequences = AlignedDNAFASTAFormat(input_fp, mode='r')
+        with redirected_stdio(stdout=os.devnull, stderr=os.devnull):
+            obs = raxml(input_sequences, seed=1723, n_searches=5,
+                        n_search_workers=3)
+        obs_tree = skbio.TreeNode.read(str(obs), convert_underscores=False)
+        obs_tips = set([tip.name for tip in obs_tree.tips()])
+
+        exp_tree = skbio.TreeNode.read(self.get_data_path('test3.tre'))
+        exp_tips = set([tip.name for tip in exp_tree.tips()])
+        self.assertEqual(obs_tips, exp_tips)
+
     def test_rapid_bootstrap_command(self):
         input_fp = self.get_data_path('aligned-dna-sequences-3.fasta')
         input_sequences = AlignedDNAFASTAFormat(input_fp, mode='r')
@@ -257,6 +276,24 @@ class RaxmlTests(TestPluginBase):
                               'GCA000473545', 'GCA000196255', 'GCA000686145',
                               'GCA001950115', 'GCA001971985', 'GCA900007555']))
 
+    def test_raxml_rapid_bootstrap_shards(self):
+        input_fp = self.get_data_path('aligned-dna-sequences-3.fasta')
+        input_sequences = AlignedDNAFASTAFormat(input_fp, mode='r')
+        with redirected_stdio(stdout=os.devnull, stderr=os.devnull):
+            obs = raxml_rapid_bootstrap(input_sequences, seed=1723,
+                                        rapid_bootstrap_seed=9384,
+                                        bootstrap_replicates=10,
+                                        n_bootstrap_shards=3)
+        obs_tree = skbio.TreeNode.read(str(obs))
+        tip_names = [t.name for t in obs_tree.tips()]
+        self.assertEqual(set(tip_names),
+                         set(['GCA001510755', 'GCA001045515', 'GCA000454205',
+                              'GCA000473545', 'GCA000196255', 'GCA000686145',
+                              'GCA001950115', 'GCA001971985', 'GCA900007555']))
+        # every internal node but the root has a support value
+        supports = [n.name for n in obs_tree.non_tips() if not n.is_root()]
+        self.assertTrue(all(0 <= float(s) <= 100 for s in supports))
+
     def test_raxml_rapid_bootstrap_n_threads(self):
         # Test that an output tree is made when invoking threads.
         input_fp = self.get_data_path('aligned-dna-sequences-3.fasta')
@@ -372,5 +409,452 @@ class RaxmlTests(TestPluginBase):
                               'GCA900007555']))
 
 
+class RaxmlAutoVersionTests(unittest.TestCase):
+
+    def setUp(self):
+        _cpu_flags.cache_clear()
+        _supported_raxml_versions.cache_clear()
+        patcher = unittest.mock.patch.object(
+            q2_phylogeny._raxml, '_raxml_illegal_versions', set())
+        self.illegal = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(_cpu_flags.cache_clear)
+        self.addCleanup(_supported_raxml_versions.cache_clear)
+
+    def _patched(self, flags, installed):
+        which = unittest.mock.patch(
+            'shutil.which',
+            side_effect=lambda binary: binary if binary in installed else None)
+        cpu_flags = unittest.mock.patch.object(
+            q2_phylogeny._raxml, '_cpu_flags', return_value=frozenset(flags))
+        return which, cpu_flags
+
+    def test_cpu_flags(self):
+        cpuinfo = ('processor\t: 0\nmodel name\t: CPU\n'
+                   'flags\t\t: fpu sse2 pni avx avx2\n\n'
+                   'processor\t: 1\nflags\t\t: fpu sse2 pni avx avx2\n')
+        with unittest.mock.patch('builtins.open',
+                                 unittest.mock.mock_open(read_data=cpuinfo)):
+            self.assertEqual(_cpu_flags(),
+                             {'fpu', 'sse2', 'pni', 'avx', 'avx2'})
+            # the flags are read once per process
+            _cpu_flags()
+            open.assert_called_once_with('/proc/cpuinfo')
+
+    def test_cpu_flags_unreadable(self):
+        with unittest.mock.patch('builtins.open', side_effect=OSError):
+            self.assertEqual(_cpu_flags(), frozenset())
+
+    def test_supported_versions(self):
+        which, cpu_flags = self._patched(
+            ['pni', 'avx2'], ['raxmlHPC', 'raxmlHPC-AVX2',
+                              'raxmlHPC-PTHREADS-SSE3', 'raxmlHPC-PTHREADS'])
+        with which, cpu_flags:
+            self.assertEqual(_supported_raxml_versions(False),
+                             ('AVX2', 'Standard'))
+            self.assertEqual(_supported_raxml_versions(True),
+                             ('SSE3', 'Standard'))
+
+    def test_supported_versions_cpu_flags(self):
+        installed = ['raxmlHPC', 'raxmlHPC-SSE3', 'raxmlHPC-AVX2']
+        which, cpu_flags = self._patched(['pni'], installed)
+        with which, cpu_flags:
+            self.assertEqual(_supported_raxml_versions(False),
+                             ('SSE3', 'Standard'))
+
+    def test_run_auto(self):
+        which, cpu_flags = self._patched(
+            ['pni', 'avx2'], ['raxmlHPC-PTHREADS-AVX2'])
+        with which, cpu_flags, unittest.mock.patch.object(
+                q2_phylogeny._raxml, 'run_command') as run:
+            _run_raxml(['-n', 'q2'], 'auto', 4, '/tmp', 'q2', None)
+
+        run.assert_called_once_with(
+            ['raxmlHPC-PTHREADS-AVX2', '-T 4', '-n', 'q2'], timeout=None,
+            stop=None)
+
+    def test_run_auto_illegal_instruction(self):
+        which, cpu_flags = self._patched(
+            ['pni', 'avx2'], ['raxmlHPC', 'raxmlHPC-SSE3', 'raxmlHPC-AVX2'])
+
+        def run_command(cmd, timeout, stop):
+            if cmd[0] == 'raxmlHPC-AVX2':
+                open(os.path.join(temp_dir, 'RAxML_info.q2'), 'w').close()
+                raise subprocess.CalledProcessError(-signal.SIGILL, cmd)
+
+        with tempfile.TemporaryDirectory() as temp_dir, which, cpu_flags, \
+                unittest.mock.patch.object(q2_phylogeny._raxml, 'run_command',
+                                           side_effect=run_command) as run, \
+                redirected_stdio(stdout=os.devnull):
+            _run_raxml(['-n', 'q2'], 'auto', 1, temp_dir, 'q2', None)
+            self.assertEqual(os.listdir(temp_dir), [])
+            # the failed version is not chosen again
+            _run_raxml(['-n', 'q2'], 'auto', 1, temp_dir, 'q2', None)
+
+        self.assertEqual([c.args[0][0] for c in run.call_args_list],
+                         ['raxmlHPC-AVX2', 'raxmlHPC-SSE3', 'raxmlHPC-SSE3'])
+        self.assertEqual(self.illegal, {'AVX2'})
+
+    def test_run_other_failure(self):
+        which, cpu_flags = self._patched(
+            ['pni', 'avx2'], ['raxmlHPC', 'raxmlHPC-AVX2'])
+        error = subprocess.CalledProcessError(1, ['raxmlHPC-AVX2'])
+        with which, cpu_flags, unittest.mock.patch.object(
+                q2_phylogeny._raxml, 'run_command', side_effect=error) as run:
+            with self.assertRaises(subprocess.CalledProcessError):
+                _run_raxml(['-n', 'q2'], 'auto', 1, '/tmp', 'q2', None)
+        run.assert_called_once()
+
+    def test_run_fixed_version(self):
+        with unittest.mock.patch.object(q2_phylogeny._raxml,
+                                        'run_command') as run:
+            _run_raxml(['-n', 'q2'], 'SSE3', 1, '/tmp', 'q2', 60)
+
+        run.assert_called_once_with(['raxmlHPC-SSE3', '-n', 'q2'],
+                                    timeout=60, stop=None)
+
+
+class RaxmlConcurrentSearchTests(unittest.TestCase):
+
+    def _run_command(self, cmd, timeout, stop):
+        # writes the files of a search whose likelihood is minus its seed
+        workdir = cmd[cmd.index('-w') + 1]
+        runname = cmd[cmd.index('-n') + 1]
+        seed = int(cmd[cmd.index('-p') + 1])
+        with open(os.path.join(workdir, 'RAxML_info.' + runname), 'w') as fh:
+            fh.write('Inference[0]: Time 0.1 GAMMA-based likelihood %d\n\n'
+                     'Final GAMMA-based Score of best tree -%d.5\n'
+                     % (-seed, seed))
+        with open(os.path.join(workdir, 'RAxML_bestTree.' + runname),
+                  'w') as fh:
+            fh.write('(a,(b,c)s%d);\n' % seed)
+
+    def test_final_likelihood(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.info') as fh:
+            fh.write('Final GAMMA-based Score of best tree -1234.5678\n')
+            fh.flush()
+            self.assertEqual(_final_likelihood(fh.name), -1234.5678)
+
+    def test_final_likelihood_missing(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.info') as fh:
+            fh.write('Inference[0]: Time 0.1\n')
+            fh.flush()
+            with self.assertRaisesRegex(ValueError, 'final likelihood'):
+                _final_likelihood(fh.name)
+
+    def test_concurrent_searches(self):
+        input_sequences = AlignedDNAFASTAFormat(
+            pkg_resources.resource_filename(
+                'q2_phylogeny.tests', 'data/aligned-dna-sequences-3.fasta'),
+            mode='r')
+        with unittest.mock.patch.object(
+                q2_phylogeny._raxml, 'run_command',
+                side_effect=self._run_command) as run, \
+                redirected_stdio(stdout=os.devnull):
+            obs = raxml(input_sequences, seed=20, n_searches=4,
+                        n_search_workers=2)
+
+        with open(str(obs)) as fh:
+            self.assertEqual(fh.read(), '(a,(b,c)s20);\n')
+        cmds = sorted((c.args[0] for c in run.call_args_list),
+                      key=lambda cmd: cmd[cmd.index('-p') + 1])
+        self.assertEqual([cmd[cmd.index('-p') + 1] for cmd in cmds],
+                         ['20', '21', '22', '23'])
+        self.assertEqual([cmd[cmd.index('-N') + 1] for cmd in cmds],
+                         ['1'] * 4)
+        self.assertEqual(len({cmd[cmd.index('-n') + 1] for cmd in cmds}), 4)
+
+    def test_concurrent_searches_share_cores(self):
+        input_sequences = AlignedDNAFASTAFormat(
+            pkg_resources.resource_filename(
+                'q2_phylogeny.tests', 'data/aligned-dna-sequences-3.fasta'),
+            mode='r')
+        for workers, threads in [(2, '-T 4'), (3, '-T 2'), (8, '-T 2')]:
+            with unittest.mock.patch.object(
+                    q2_phylogeny._raxml, 'run_command',
+                    side_effect=self._run_command) as run, \
+                    unittest.mock.patch.object(
+                        q2_phylogeny._raxml, 'get_available_cores',
+                        return_value=8), \
+                    redirected_stdio(stdout=os.devnull):
+                raxml(input_sequences, seed=20, n_searches=4, n_threads=0,
+                      n_search_workers=workers)
+
+            self.assertEqual([c.args[0][:2] for c in run.call_args_list],
+                             [['raxmlHPC-PTHREADS', threads]] * 4)
+
+
+class RaxmlShardedBootstrapTests(unittest.TestCase):
+
+    def _run_command(self, cmd, timeout, stop):
+        # writes what each kind of run writes, with a bootstrap tree per
+        # replicate named by its shard's seed, and the bootstrap trees as
+        # the supported tree
+        workdir = cmd[cmd.index('-w') + 1]
+        runname = cmd[cmd.index('-n') + 1]
+        if '-x' in cmd:
+            seed = cmd[cmd.index('-x') + 1]
+            n_reps = int(cmd[cmd.index('-N') + 1])
+            out_fp, text = 'RAxML_bootstrap', '(a,(b,c)x%s);\n' % seed
+            text *= n_reps
+        elif '-z' in cmd:
+            with open(cmd[cmd.index('-z') + 1]) as fh:
+                out_fp, text = 'RAxML_bipartitions', fh.read()
+        else:
+            out_fp, text = 'RAxML_bestTree', '(a,(b,c));\n'
+        with open(os.path.join(workdir, '%s.%s' % (out_fp, runname)),
+                  'w') as fh:
+            fh.write(text)
+
+    def test_sharded_bootstrap(self):
+        input_sequences = AlignedDNAFASTAFormat(
+            pkg_resources.resource_filename(
+                'q2_phylogeny.tests', 'data/aligned-dna-sequences-3.fasta'),
+            mode='r')
+        with unittest.mock.patch.object(
+                q2_phylogeny._raxml, 'run_command',
+                side_effect=self._run_command) as run:
+            obs = raxml_rapid_bootstrap(input_sequences, seed=10,
+                                        rapid_bootstrap_seed=50,
+                                        bootstrap_replicates=11,
+                                        n_bootstrap_shards=3)
+
+        with open(str(obs)) as fh:
+            trees = fh.read().splitlines()
+        self.assertEqual(trees, ['(a,(b,c)x50);'] * 4 +
+                         ['(a,(b,c)x51);'] * 4 + ['(a,(b,c)x52);'] * 3)
+        cmds = [c.args[0] for c in run.call_args_list]
+        self.assertEqual(len(cmds), 5)
+        # the support is drawn once every shard and the search are done
+        self.assertEqual(cmds[-1][cmds[-1].index('-f') + 1], 'b')
+        self.assertTrue(cmds[-1][cmds[-1].index('-t') + 1].endswith(
+            'RAxML_bestTree.q2bootstrap.search'))
+        self.assertEqual(sorted(cmd[cmd.index('-p') + 1]
+                                for cmd in cmds[:-1]),
+                         ['10', '10', '11', '12'])
+
+    def test_more_shards_than_replicates(self):
+        input_sequences = AlignedDNAFASTAFormat(
+            pkg_resources.resource_filename(
+                'q2_phylogeny.tests', 'data/aligned-dna-sequences-3.fasta'),
+            mode='r')
+        with unittest.mock.patch.object(
+                q2_phylogeny._raxml, 'run_command',
+                side_effect=self._run_command) as run:
+            raxml_rapid_bootstrap(input_sequences, bootstrap_replicates=2,
+                                  n_bootstrap_shards=8)
+
+        n_reps = [c.args[0][c.args[0].index('-N') + 1]
+                  for c in run.call_args_list if '-x' in c.args[0]]
+        self.assertEqual(n_reps, ['1', '1'])
+
+    def test_sharded_bootstrap_share_cores(self):
+        input_sequences = AlignedDNAFASTAFormat(
+            pkg_resources.resource_filename(
+                'q2_phylogeny.tests', 'data/aligned-dna-sequences-3.fasta'),
+            mode='r')
+        with unittest.mock.patch.object(
+                q2_phylogeny._raxml, 'run_command',
+                side_effect=self._run_command) as run, \
+                unittest.mock.patch.object(
+                    q2_phylogeny._raxml, 'get_available_cores',
+                    return_value=8):
+            raxml_rapid_bootstrap(input_sequences, bootstrap_replicates=6,
+                                  n_bootstrap_shards=3, n_threads=0)
+
+        cmds = [c.args[0] for c in run.call_args_list]
+        # the shards and the search share the cores, and the support is
+        # drawn with all of them
+        self.assertEqual([cmd[:2] for cmd in cmds[:-1]],
+                         [['raxmlHPC-PTHREADS', '-T 2']] * 4)
+        self.assertEqual(cmds[-1][:2], ['raxmlHPC-PTHREADS', '-T 8'])
+
+
+class RaxmlCheckpointTests(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.checkpoint_dir = os.path.join(self.temp_dir.name, 'checkpoints')
+        self.input_sequences = AlignedDNAFASTAFormat(
+            pkg_resources.resource_filename(
+                'q2_phylogeny.tests', 'data/aligned-dna-sequences-3.fasta'),
+            mode='r')
+        # the run names of the runs to stop, as a pre-empted job would be
+        self.stopped = set()
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def _run_command(self, cmd, timeout, stop):
+        workdir = cmd[cmd.index('-w') + 1]
+        runname = cmd[cmd.index('-n') + 1]
+
+        def write(prefix, text):
+            with open(os.path.join(workdir, '%s.%s' % (prefix, runname)),
+                      'w') as fh:
+                fh.write(text)
+
+        write('RAxML_info', 'Final GAMMA-based Score of best tree -1.0\n')
+        if '-j' in cmd:
+            for k in range(2):
+                write('RAxML_checkpoint', '(a,(b,c));\n')
+                os.rename(os.path.join(workdir,
+                                       'RAxML_checkpoint.%s' % runname),
+                          os.path.join(workdir, 'RAxML_checkpoint.%s.%d'
+                                       % (runname, k)))
+        if runname in self.stopped:
+            raise subprocess.CalledProcessError(-signal.SIGKILL, cmd)
+        if self._arg(cmd, '-f') == 'a':
+            write('RAxML_bipartitions', '(a,(b,c)100);\n')
+        elif '-x' in cmd:
+            write('RAxML_bootstrap',
+                  '(a,(b,c));\n' * int(cmd[cmd.index('-N') + 1]))
+        elif '-z' in cmd:
+            write('RAxML_bipartitions', '(a,(b,c)100);\n')
+        else:
+            write('RAxML_bestTree', '(a,(b,c));\n')
+
+    def _run(self, action, checkpoint=True, **kwargs):
+        checkpoint_dir = self.checkpoint_dir if checkpoint else None
+        with unittest.mock.patch.object(
+                q2_phylogeny._raxml, 'run_command',
+                side_effect=self._run_command) as run, \
+                redirected_stdio(stdout=os.devnull):
+            action(self.input_sequences, checkpoint_dir=checkpoint_dir,
+                   **kwargs)
+        return [c.args[0] for c in run.call_args_list]
+
+    def _arg(self, cmd, option):
+        return cmd[cmd.index(option) + 1] if option in cmd else None
+
+    def _without_work_dir(self, cmd):
+        # the work directory, and -j, which only has RAxML write its
+        # intermediate trees, are all that checkpointing adds
+        cmd = [arg for arg in cmd if arg != '-j']
+        del cmd[cmd.index('-w') + 1]
+        return cmd
+
+    def test_same_commands(self):
+        for action, kwargs in [
+                (raxml, {'seed': 7}),
+                (raxml, {'seed': 7, 'n_searches': 3}),
+                (raxml_rapid_bootstrap, {'seed': 7, 'rapid_bootstrap_seed': 8,
+                                         'bootstrap_replicates': 10})]:
+            expected = self._run(action, checkpoint=False, **kwargs)
+            obs = self._run(action, **kwargs)
+
+            self.assertEqual([self._without_work_dir(cmd) for cmd in obs],
+                             [self._without_work_dir(cmd)
+                              for cmd in expected])
+            self.assertEqual(len(obs), 1)
+
+    def test_resume_search(self):
+        self.stopped = {'q2'}
+        with self.assertRaises(subprocess.CalledProcessError):
+            self._run(raxml)
+        # the work directory is kept for the next run
+        self.assertEqual(len(os.listdir(self.checkpoint_dir)), 1)
+
+        self.stopped = set()
+        cmd, = self._run(raxml)
+
+        # the search starts from its last intermediate tree
+        self.assertEqual(self._arg(cmd, '-n'), 'q2.r1')
+        self.assertEqual(os.path.basename(self._arg(cmd, '-t')),
+                         'RAxML_checkpoint.q2.1')
+        self.assertIn('-j', cmd)
+        # and the work directory is removed once the run succeeds
+        self.assertEqual(os.listdir(self.checkpoint_dir), [])
+
+    def test_resume_several_searches(self):
+        self.stopped = {'q2'}
+        with self.assertRaises(subprocess.CalledProcessError):
+            self._run(raxml, seed=1, n_searches=2)
+
+        self.stopped = set()
+        cmd, = self._run(raxml, seed=1, n_searches=2)
+
+        # the searches run in one process, which is run again from the start
+        self.assertEqual(self._arg(cmd, '-n'), 'q2.r1')
+        self.assertEqual(self._arg(cmd, '-N'), '2')
+        self.assertEqual(self._arg(cmd, '-p'), '1')
+        self.assertNotIn('-t', cmd)
+        self.assertNotIn('-j', cmd)
+
+    def test_resume_concurrent_searches(self):
+        self.stopped = {'q2.1'}
+        with self.assertRaises(subprocess.CalledProcessError):
+            self._run(raxml, n_searches=2, n_search_workers=2)
+
+        self.stopped = set()
+        cmds = self._run(raxml, n_searches=2, n_search_workers=2)
+
+        # the search that finished is not run again, and the one that was
+        # stopped starts from its last intermediate tree
+        cmd, = cmds
+        self.assertEqual(self._arg(cmd, '-n'), 'q2.1.r1')
+        self.assertEqual(os.path.basename(self._arg(cmd, '-t')),
+                         'RAxML_checkpoint.q2.1.1')
+
+    def test_seed_kept(self):
+        self.stopped = {'q2'}
+        with self.assertRaises(subprocess.CalledProcessError):
+            self._run(raxml)
+        with open(os.path.join(self.checkpoint_dir,
+                               os.listdir(self.checkpoint_dir)[0],
+                               'seed.txt')) as fh:
+            seed = fh.read().strip()
+
+        self.stopped = set()
+        cmd, = self._run(raxml)
+
+        self.assertEqual(self._arg(cmd, '-p'), seed)
+        self.assertEqual(self._arg(cmd, '-n'), 'q2.r1')
+
+    def test_other_parameters_start_over(self):
+        self.stopped = {'q2'}
+        with self.assertRaises(subprocess.CalledProcessError):
+            self._run(raxml, seed=1)
+
+        self.stopped = set()
+        cmd, = self._run(raxml, seed=2)
+
+        self.assertEqual(self._arg(cmd, '-n'), 'q2')
+        self.assertNotIn('-t', cmd)
+        self.assertEqual(len(os.listdir(self.checkpoint_dir)), 1)
+
+    def test_resume_rapid_bootstrap(self):
+        self.stopped = {'q2bootstrap'}
+        with self.assertRaises(subprocess.CalledProcessError):
+            self._run(raxml_rapid_bootstrap, bootstrap_replicates=10)
+
+        self.stopped = set()
+        cmd, = self._run(raxml_rapid_bootstrap, bootstrap_replicates=10)
+
+        # the replicates and the search run in one process, which is run
+        # again from the start
+        self.assertEqual(self._arg(cmd, '-n'), 'q2bootstrap.r1')
+        self.assertEqual(self._arg(cmd, '-f'), 'a')
+        self.assertEqual(self._arg(cmd, '-N'), '10')
+        self.assertEqual(os.listdir(self.checkpoint_dir), [])
+
+    def test_resume_rapid_bootstrap_shards(self):
+        self.stopped = {'q2bootstrap.1'}
+        with self.assertRaises(subprocess.CalledProcessError):
+            self._run(raxml_rapid_bootstrap, seed=1, rapid_bootstrap_seed=2,
+                      bootstrap_replicates=10, n_bootstrap_shards=2)
+
+        self.stopped = set()
+        cmds = self._run(raxml_rapid_bootstrap, seed=1,
+                         rapid_bootstrap_seed=2, bootstrap_replicates=10,
+                         n_bootstrap_shards=2)
+
+        # only the stopped shard, then the support, are run
+        self.assertEqual([self._arg(cmd, '-n') for cmd in cmds],
+                         ['q2bootstrap.1.r1', 'q2bootstrap'])
+        self.assertEqual(self._arg(cmds[0], '-x'), '3')
+        self.assertNotIn('-t', cmds[0])
+
+
 if __name__ == "__main__":
     unittest.main()
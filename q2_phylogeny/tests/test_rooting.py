@@ -0,0 +1,184 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016-2023, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import io
+import unittest
+import unittest.mock
+
+import numpy as np
+import skbio
+from qiime2.plugin.testing import TestPluginBase
+
+from q2_phylogeny import mad_root, min_variance_root
+from q2_phylogeny._compact import CompactTree
+
+
+def _root_to_tip(tree):
+    return {tip.name: tip.accumulate_to_ancestor(tree)
+            for tip in tree.tips()}
+
+
+def _ancestor_deviation(tree, root_to_tip):
+    """ The sum of squared ancestor deviations of the pairs of tips, for a
+    root at the given distances from the tips
+    """
+    tips = list(tree.tips())
+    total = 0.0
+    for i, b in enumerate(tips):
+        for c in tips[i + 1:]:
+            distance = b.distance(c)
+            if distance > 0:
+                total += ((root_to_tip[b.name] - root_to_tip[c.name]) /
+                          distance) ** 2
+    return total
+
+
+def _brute_force_mad(tree):
+    """ The distances from the tips of the MAD root, found by computing the
+    deviation of every pair of tips for roots on every branch
+
+    On a branch the deviation is a quadratic in the root's position, so it
+    is fitted from three positions and its minimum on the branch taken.
+    """
+    best = None
+    for node in tree.preorder(include_self=False):
+        length = node.length or 0.0
+        below = {tip.name for tip in node.tips()} or {node.name}
+
+        def root_to_tip(t):
+            return {tip.name: (tip.distance(node) + t if tip.name in below
+                               else tip.distance(node.parent) + length - t)
+                    for tip in tree.tips()}
+
+        ends = [_ancestor_deviation(tree, root_to_tip(t))
+                for t in (0.0, length / 2, length)]
+        positions = [0.0, length]
+        curvature = ends[0] - 2 * ends[1] + ends[2]
+        if curvature > 0:
+            vertex = length / 4 * (ends[0] - ends[2]) / curvature + length / 2
+            positions.append(min(max(vertex, 0.0), length))
+        for t in positions:
+            distances = root_to_tip(t)
+            deviation = _ancestor_deviation(tree, distances)
+            if best is None or deviation < best[0]:
+                best = (deviation, distances)
+    return best
+
+
+class RootingTests(TestPluginBase):
+
+    package = 'q2_phylogeny.tests'
+
+    # a clock-like tree with its root removed: every tip is 2.5 from the
+    # point 0.5 along the branch from g to (c, (d, e))
+    clock_nwk = "((c:2,(d:1,e:1):1):1,(a:1.5,b:1.5):0.5,f:2)g;"
+
+    def test_clock_tree(self):
+        tree = skbio.TreeNode.read(io.StringIO(self.clock_nwk))
+        for root in mad_root, min_variance_root:
+            rooted = root(tree)
+            self.assertEqual(len(rooted.children), 2)
+            distances = _root_to_tip(rooted)
+            self.assertEqual(sorted(distances), list('abcdef'))
+            self.assertTrue(
+                np.allclose(list(distances.values()), distances['a']))
+
+    def test_min_variance(self):
+        tree = skbio.TreeNode.read(io.StringIO(
+            "((a:1,b:2)c:1,(d:1,e:5)f:3,g:1)h;"))
+        rooted = min_variance_root(tree)
+        observed = np.var(list(_root_to_tip(rooted).values()))
+        # the variance at every other node or branch end is no smaller
+        for node in tree.traverse(include_self=True):
+            if node.is_tip():
+                continue
+            distances = [tip.distance(node) for tip in tree.tips()]
+            self.assertLessEqual(observed, np.var(distances) + 1e-12)
+
+    def test_mad_brute_force(self):
+        nwks = ["((a:1,b:2)c:1,(d:1,e:5)f:3,g:1)h;",
+                "((a:1,b:2)c:1,(d:1,e:5)f:3,(g:1)h:1)i;",
+                "(a:0.1,b:0.2,(c:0.3,(d:0.1,e:4)f:0.2,g:0.6)h:1.5)i;",
+                "((a:1,b:1):0,(c:2,d:3):0,e:7);"]
+        rng = np.random.default_rng(0)
+        for n_tips in range(3, 10):
+            nodes = [skbio.TreeNode(name='t%d' % i,
+                                    length=rng.uniform(0.1, 3.0))
+                     for i in range(n_tips)]
+            while len(nodes) > 3:
+                picked = rng.choice(len(nodes), 2, replace=False)
+                joined = skbio.TreeNode(
+                    children=[nodes[i] for i in picked],
+                    length=rng.uniform(0.0, 2.0))
+                nodes = [node for i, node in enumerate(nodes)
+                         if i not in picked] + [joined]
+            nwks.append(str(skbio.TreeNode(children=nodes)))
+
+        for nwk in nwks:
+            tree = skbio.TreeNode.read(io.StringIO(nwk))
+            deviation, expected = _brute_force_mad(tree)
+            observed = _root_to_tip(mad_root(tree))
+            self.assertAlmostEqual(_ancestor_deviation(tree, observed),
+                                   deviation, msg=nwk)
+            self.assertEqual(sorted(observed), sorted(expected))
+            for name in expected:
+                self.assertAlmostEqual(observed[name], expected[name],
+                                       msg=nwk)
+
+    def test_mad_blocks(self):
+        # pairs of tips taken in blocks give the same root as all at once
+        tree = CompactTree.from_newick(
+            "((a:1,b:2)c:1,(d:1,e:5,(x:2,y:0.5)z:1)f:3,g:1)h;")
+        expected = str(mad_root(tree))
+        with unittest.mock.patch('q2_phylogeny._rooting._PAIR_BLOCK', 1):
+            self.assertEqual(str(mad_root(tree)), expected)
+
+    def test_tip_distances_kept(self):
+        nwk = "((a:1,b:2)c:1,(d:1,e:5)f:3,(g:1)h:1)i;"
+        tree = skbio.TreeNode.read(io.StringIO(nwk))
+        expected = tree.tip_tip_distances()
+        for root in mad_root, min_variance_root:
+            observed = root(tree).tip_tip_distances()
+            observed = observed.filter(expected.ids)
+            self.assertTrue(np.allclose(observed.data, expected.data))
+
+    def test_compact_tree(self):
+        tree = CompactTree.from_newick(self.clock_nwk)
+        for root in mad_root, min_variance_root:
+            expected = root(skbio.TreeNode.read(io.StringIO(self.clock_nwk)))
+            result = root(tree)
+            self.assertIsInstance(result, CompactTree)
+            self.assertEqual(str(result), str(expected))
+
+    def _assert_tips_kept(self, nwk):
+        for root in mad_root, min_variance_root:
+            tree = skbio.TreeNode.read(io.StringIO(nwk))
+            rooted = root(tree)
+            self.assertEqual(sorted(tip.name for tip in rooted.tips()),
+                             sorted(tip.name for tip in tree.tips()))
+            tree = CompactTree.from_newick(nwk)
+            self.assertEqual(sorted(root(tree).tip_names()),
+                             sorted(tree.tip_names()))
+
+    def test_multifurcating_no_lengths(self):
+        self._assert_tips_kept("(a,b,(c,d));")
+
+    def test_zero_lengths(self):
+        self._assert_tips_kept("(t0:0,t1:0,t2:0);")
+        self._assert_tips_kept("((a:0,b:0):0,c:0,(d:0,e:0):0);")
+
+    def test_no_lengths(self):
+        tree = skbio.TreeNode.read(io.StringIO("((a,b),(c,d));"))
+        for root in mad_root, min_variance_root:
+            rooted = root(tree)
+            self.assertEqual(sorted(t.name for t in rooted.tips()),
+                             ['a', 'b', 'c', 'd'])
+
+
+if __name__ == '__main__':
+    unittest.main()
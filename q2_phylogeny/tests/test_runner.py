@@ -0,0 +1,255 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016-2023, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import unittest.mock
+
+from qiime2.util import redirected_stdio
+
+from q2_phylogeny._runner import (run_command, RunRecord, CommandTimeoutError,
+                                  run_concurrently)
+
+
+def _python(code):
+    return [sys.executable, '-c', code]
+
+
+def _running(pid):
+    """ Whether pid is a live process, not counting unreaped zombies
+    """
+    try:
+        with open('/proc/%d/stat' % pid) as fh:
+            return fh.read().rsplit(')', 1)[1].split()[0] != 'Z'
+    except FileNotFoundError:
+        return False
+
+
+class RunCommandTests(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.log_fp = os.path.join(self.temp_dir.name, 'run.log')
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_record(self):
+        # allocate and touch 64 MiB, and spin for a while
+        cmd = _python("import time\n"
+                      "b = bytearray(64 * 2 ** 20)\n"
+                      "t = time.process_time()\n"
+                      "while time.process_time() - t < 0.2: pass\n")
+
+        record = run_command(cmd, verbose=False)
+
+        self.assertIsInstance(record, RunRecord)
+        self.assertEqual(record.cmd, cmd)
+        self.assertEqual(record.returncode, 0)
+        self.assertGreaterEqual(record.cpu_time, 0.2)
+        self.assertGreaterEqual(record.wall_time, record.cpu_time * 0.5)
+        self.assertGreater(record.max_rss, 64 * 2 ** 20)
+        self.assertIsNone(record.log_fp)
+
+    def test_log(self):
+        cmd = _python("import sys\n"
+                      "print('out 1', flush=True)\n"
+                      "print('err 1', file=sys.stderr, flush=True)\n"
+                      "print('out 2', flush=True)\n")
+
+        with redirected_stdio(stdout=os.devnull, stderr=os.devnull):
+            record = run_command(cmd, verbose=False, log_fp=self.log_fp)
+
+        self.assertEqual(record.log_fp, self.log_fp)
+        with open(self.log_fp) as fh:
+            self.assertEqual(fh.read(), 'out 1\nerr 1\nout 2\n')
+
+    def test_output_fp(self):
+        output_fp = os.path.join(self.temp_dir.name, 'out.txt')
+        cmd = _python("import sys\n"
+                      "print('(a,b);')\n"
+                      "print('progress', file=sys.stderr)\n")
+
+        with redirected_stdio(stderr=os.devnull):
+            run_command(cmd, output_fp, verbose=False, log_fp=self.log_fp)
+
+        with open(output_fp) as fh:
+            self.assertEqual(fh.read(), '(a,b);\n')
+        with open(self.log_fp) as fh:
+            self.assertEqual(fh.read(), 'progress\n')
+
+    def test_no_echo(self):
+        out_fp = os.path.join(self.temp_dir.name, 'stdout.txt')
+        cmd = _python("import sys\n"
+                      "print('out')\n"
+                      "print('err', file=sys.stderr)\n")
+
+        with redirected_stdio(stdout=out_fp, stderr=out_fp):
+            run_command(cmd, verbose=False, log_fp=self.log_fp, echo=False)
+
+        with open(out_fp) as fh:
+            self.assertEqual(fh.read(), '')
+        with open(self.log_fp) as fh:
+            self.assertEqual(sorted(fh.read().split()), ['err', 'out'])
+
+    def test_env(self):
+        output_fp = os.path.join(self.temp_dir.name, 'out.txt')
+        env = dict(os.environ, Q2_RUNNER_TEST='42')
+        cmd = _python("import os; print(os.environ['Q2_RUNNER_TEST'])")
+
+        run_command(cmd, output_fp, verbose=False, env=env)
+
+        with open(output_fp) as fh:
+            self.assertEqual(fh.read(), '42\n')
+
+    def test_failed_run(self):
+        cmd = _python("import sys; sys.exit(3)")
+
+        with self.assertRaises(subprocess.CalledProcessError) as e:
+            run_command(cmd, verbose=False)
+        self.assertEqual(e.exception.returncode, 3)
+
+    def test_killed_run(self):
+        cmd = _python("import os, signal; os.kill(os.getpid(), "
+                      "signal.SIGKILL)")
+
+        with self.assertRaises(subprocess.CalledProcessError) as e:
+            run_command(cmd, verbose=False)
+        self.assertEqual(e.exception.returncode, -9)
+
+    def test_verbose(self):
+        cmd = _python("pass")
+        out_fp = os.path.join(self.temp_dir.name, 'stdout.txt')
+
+        with redirected_stdio(stdout=out_fp):
+            run_command(cmd)
+
+        with open(out_fp) as fh:
+            out = fh.read()
+        self.assertIn('Command: %s' % ' '.join(cmd), out)
+        self.assertIn('of CPU time', out)
+
+
+@unittest.skipUnless(os.path.exists('/proc/self/stat'), 'requires /proc')
+class RunCommandTimeoutTests(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.pid_fp = os.path.join(self.temp_dir.name, 'pid')
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def _with_child(self, code=''):
+        # a command that starts a child of its own, as threaded tools may,
+        # records the child's pid and then runs forever
+        return _python(
+            "import subprocess, sys, time\n"
+            "child = subprocess.Popen([sys.executable, '-c', "
+            "'import time; time.sleep(600)'])\n"
+            "open(%r, 'w').write(str(child.pid))\n" % self.pid_fp +
+            code +
+            "time.sleep(600)\n")
+
+    def _child_pid(self):
+        with open(self.pid_fp) as fh:
+            return int(fh.read())
+
+    def _assert_stopped(self, pid):
+        deadline = time.monotonic() + 5
+        while _running(pid) and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self.assertFalse(_running(pid))
+
+    def test_timeout(self):
+        with self.assertRaises(CommandTimeoutError) as e:
+            run_command(self._with_child(), verbose=False, timeout=1)
+
+        self.assertGreaterEqual(e.exception.elapsed, 1)
+        self.assertIsInstance(e.exception, subprocess.TimeoutExpired)
+        self.assertRegex(str(e.exception),
+                         r'stopped after running for \d+\.\d seconds, '
+                         r'exceeding its timeout of 1 seconds')
+        self._assert_stopped(self._child_pid())
+
+    def test_timeout_sigterm_ignored(self):
+        cmd = self._with_child(
+            "import signal\n"
+            "signal.signal(signal.SIGTERM, signal.SIG_IGN)\n")
+
+        with unittest.mock.patch('q2_phylogeny._runner._TERMINATE_GRACE',
+                                 0.5):
+            with self.assertRaises(CommandTimeoutError):
+                run_command(cmd, verbose=False, timeout=1)
+        self._assert_stopped(self._child_pid())
+
+    def test_within_timeout(self):
+        record = run_command(_python("pass"), verbose=False, timeout=60)
+
+        self.assertEqual(record.returncode, 0)
+
+    def test_interrupt(self):
+        interrupt = threading.Timer(1, os.kill,
+                                    (os.getpid(), signal.SIGINT))
+        interrupt.start()
+        try:
+            with self.assertRaises(KeyboardInterrupt):
+                run_command(self._with_child(), verbose=False)
+        finally:
+            interrupt.cancel()
+        self._assert_stopped(self._child_pid())
+
+    def test_stop(self):
+        stop = threading.Event()
+        threading.Timer(1, stop.set).start()
+
+        with self.assertRaises(subprocess.CalledProcessError) as e:
+            run_command(self._with_child(), verbose=False, stop=stop)
+        self.assertEqual(e.exception.returncode, -signal.SIGTERM)
+        self._assert_stopped(self._child_pid())
+
+
+class RunConcurrentlyTests(unittest.TestCase):
+
+    def test_results_in_order(self):
+        def job(i, stop):
+            time.sleep(0.1 * (3 - i))
+            run_command(_python("pass"), verbose=False, stop=stop)
+            return i
+
+        self.assertEqual(
+            run_concurrently([lambda stop, i=i: job(i, stop)
+                              for i in range(4)], 2),
+            [0, 1, 2, 3])
+
+    def test_failure_stops_other_jobs(self):
+        started = time.monotonic()
+
+        def sleeper(stop):
+            run_command(_python("import time; time.sleep(600)"),
+                        verbose=False, stop=stop)
+
+        def failure(stop):
+            time.sleep(0.5)
+            run_command(_python("import sys; sys.exit(3)"), verbose=False,
+                        stop=stop)
+
+        with self.assertRaises(subprocess.CalledProcessError) as e:
+            run_concurrently([sleeper, failure, sleeper], 2)
+        self.assertEqual(e.exception.returncode, 3)
+        self.assertLess(time.monotonic() - started, 30)
+
+
+if __name__ == "__main__":
+    unittest.main()
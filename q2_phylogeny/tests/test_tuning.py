@@ -0,0 +1,171 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016-2023, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import json
+import os
+import subprocess
+import tempfile
+import unittest
+import unittest.mock
+
+from qiime2.util import redirected_stdio
+
+from q2_phylogeny._runner import RunRecord, CommandTimeoutError
+from q2_phylogeny._tuning import (_tuned_threads, _best_thread_count,
+                                  _pilot_thread_counts, _read_alignment,
+                                  _write_subsample, _cache_fp)
+
+
+class TuningTests(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.alignment_fp = os.path.join(self.temp_dir.name, 'aligned.fasta')
+        with open(self.alignment_fp, 'w') as fh:
+            fh.write('>a\nACGT\nAC-T\n>b\nACGTACGA\n>c\nTTGTACGT\n')
+        environ = unittest.mock.patch.dict(
+            os.environ, {'XDG_CACHE_HOME': self.temp_dir.name})
+        environ.start()
+        self.addCleanup(environ.stop)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def _pilot(self, alignment_fp, n_threads, temp_dir):
+        return ['pilot', str(n_threads)], None, None
+
+    def _tune(self, times, max_threads=4):
+        # times are the wall times of the pilot runs, by thread count, with
+        # None for a run that times out and an exception for one that fails
+        def run(cmd, *args, **kwargs):
+            n_threads = int(cmd[1])
+            if times[n_threads] is None:
+                raise CommandTimeoutError(cmd, 60, 60.0)
+            if isinstance(times[n_threads], Exception):
+                raise times[n_threads]
+            return RunRecord(cmd, 0, times[n_threads], 1.0, 0, None)
+
+        with unittest.mock.patch('q2_phylogeny._tuning.run_command',
+                                 side_effect=run) as run_command:
+            with redirected_stdio(stdout=os.devnull):
+                n_threads = _tuned_threads('Tool', self.alignment_fp,
+                                           max_threads, self._pilot)
+        return n_threads, run_command
+
+    def test_read_alignment(self):
+        ids, sequences = _read_alignment(self.alignment_fp)
+
+        self.assertEqual(ids, ['a', 'b', 'c'])
+        self.assertEqual(sequences, ['ACGTAC-T', 'ACGTACGA', 'TTGTACGT'])
+
+    def test_write_subsample(self):
+        ids, sequences = _read_alignment(self.alignment_fp)
+        output_fp = os.path.join(self.temp_dir.name, 'subsample.fasta')
+
+        _write_subsample(ids, sequences, output_fp, n_columns=3)
+
+        sub_ids, subsample = _read_alignment(output_fp)
+        self.assertEqual(sub_ids, ids)
+        self.assertEqual([len(sequence) for sequence in subsample], [3] * 3)
+        # whole columns are taken, in their order
+        columns = list(zip(*sequences))
+        positions = [columns.index(column) for column in zip(*subsample)]
+        self.assertEqual(positions, sorted(positions))
+
+    def test_pilot_thread_counts(self):
+        self.assertEqual(_pilot_thread_counts(1), [1])
+        self.assertEqual(_pilot_thread_counts(3), [1, 2, 3])
+        self.assertEqual(_pilot_thread_counts(4), [1, 2, 4])
+        self.assertEqual(_pilot_thread_counts(32), [1, 2, 4, 8])
+
+    def test_best_thread_count(self):
+        # four threads are fastest, but use their time poorly
+        self.assertEqual(_best_thread_count({1: 10.0, 2: 6.0, 4: 5.5}), 2)
+        self.assertEqual(_best_thread_count({1: 10.0, 2: 5.0, 4: 2.5}), 4)
+        self.assertEqual(_best_thread_count({1: 1.0, 2: 1.5, 4: 2.0}), 1)
+        self.assertEqual(_best_thread_count({2: 8.0, 4: 5.0}), 4)
+        self.assertIsNone(_best_thread_count({}))
+
+    def test_tuned_threads(self):
+        n_threads, run_command = self._tune({1: 10.0, 2: 6.0, 4: 5.5})
+
+        self.assertEqual(n_threads, 2)
+        self.assertEqual(run_command.call_count, 3)
+        _, kwargs = run_command.call_args
+        self.assertEqual(kwargs['timeout'], 60)
+        self.assertFalse(kwargs['echo'])
+
+    def test_tuned_threads_cached(self):
+        self._tune({1: 10.0, 2: 6.0, 4: 5.5})
+
+        n_threads, run_command = self._tune({1: 10.0, 2: 5.0, 4: 2.5})
+
+        self.assertEqual(n_threads, 2)
+        run_command.assert_not_called()
+        with open(_cache_fp()) as fh:
+            cache = json.load(fh)
+        self.assertEqual(list(cache.values()), [2])
+        self.assertIn('Tool 3x8 max 4', list(cache)[0])
+
+    def test_tuned_threads_cache_keyed_by_max_threads(self):
+        self._tune({1: 10.0, 2: 6.0, 4: 5.5})
+
+        n_threads, run_command = self._tune({1: 10.0, 2: 5.0}, max_threads=2)
+
+        self.assertEqual(n_threads, 2)
+        self.assertEqual(run_command.call_count, 2)
+
+    def test_tuned_threads_corrupt_cache(self):
+        os.makedirs(os.path.dirname(_cache_fp()))
+        with open(_cache_fp(), 'w') as fh:
+            fh.write('{')
+
+        n_threads, _ = self._tune({1: 10.0, 2: 5.0, 4: 2.5})
+
+        self.assertEqual(n_threads, 4)
+
+    def test_tuned_threads_timeouts(self):
+        n_threads, _ = self._tune({1: None, 2: 50.0, 4: 30.0})
+        self.assertEqual(n_threads, 4)
+
+        n_threads, _ = self._tune({1: None, 2: None, 3: None}, max_threads=3)
+        self.assertEqual(n_threads, 3)
+
+    def test_tuned_threads_failures(self):
+        failed = subprocess.CalledProcessError(1, ['pilot'])
+        n_threads, run_command = self._tune({1: failed, 2: 4.0, 4: 5.0})
+
+        self.assertEqual(n_threads, 2)
+        self.assertEqual(run_command.call_count, 3)
+
+    def test_tuned_threads_all_failed(self):
+        failed = subprocess.CalledProcessError(1, ['pilot'])
+        missing = FileNotFoundError('pilot')
+        times = {1: failed, 2: missing, 4: missing, 8: failed}
+        with unittest.mock.patch('q2_phylogeny._tuning.get_available_cores',
+                                 return_value=8):
+            n_threads, _ = self._tune(times, max_threads=0)
+        self.assertEqual(n_threads, 0)
+
+        n_threads, _ = self._tune(times, max_threads=4)
+        self.assertEqual(n_threads, 4)
+        # the fallback is not cached, so the pilots are run again
+        n_threads, run_command = self._tune(times, max_threads=4)
+        self.assertEqual(n_threads, 4)
+        self.assertEqual(run_command.call_count, 3)
+        self.assertFalse(os.path.exists(_cache_fp()))
+
+    def test_one_thread(self):
+        n_threads, run_command = self._tune({}, max_threads=1)
+
+        self.assertEqual(n_threads, 1)
+        run_command.assert_not_called()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -7,11 +7,22 @@
 # ----------------------------------------------------------------------------
 
 import unittest
+import unittest.mock
 import io
 
+import numpy as np
+import pandas as pd
 import skbio
+from skbio.tree import NoLengthError
+from qiime2.plugin.testing import TestPluginBase
+from q2_types.tree import NewickFormat
 
-from q2_phylogeny import midpoint_root, robinson_foulds
+from q2_phylogeny import (midpoint_root, robinson_foulds,
+                          robinson_foulds_reference)
+from q2_phylogeny._compact import CompactTree, CompactTreeCollection
+from q2_phylogeny._splits import (_tip_index, _tree_splits, _row_blocks,
+                                  _square_from_condensed, _unique_topologies,
+                                  _pairwise_matrix, _hash_rf_matrix)
 
 
 class MidpointRootTests(unittest.TestCase):
@@ -47,6 +58,75 @@ class MidpointRootTests(unittest.TestCase):
             self.assertEqual(actual.find(id_).distance(actual.root()),
                              expected.find(id_).distance(expected.root()))
 
+    def test_midpoint_root_matches_skbio(self):
+        for nwk in ["((a:1,b:1):1,(c:5,d:4):1);",
+                    # ties between the farthest tips
+                    "((a:2,b:2)e:1,(c:2,d:2)f:1,g:1)h;",
+                    # the midpoint falls on an existing node
+                    "((a:1,b:1)c:1,(d:1,e:3)f:1)g;",
+                    # single child nodes
+                    "(((a:1)b:2,c:4)d:1,((e:3)f:1,g:1)h:2)i;",
+                    "((((a:1,b:2)c:1)d:1,e:1)f:1)g;",
+                    "(a,b);"]:
+            tree = skbio.TreeNode.read(io.StringIO(nwk))
+            expected = tree.root_at_midpoint()
+            actual = midpoint_root(tree)
+            self.assertEqual(str(actual), str(expected))
+
+    def test_midpoint_root_no_tip_distances(self):
+        tree = skbio.TreeNode.read(io.StringIO(
+            "(((a:1)b:2,c:4)d:1,((e:3)f:1,g:1)h:2)i;"))
+        with unittest.mock.patch.object(
+                skbio.TreeNode, 'tip_tip_distances') as tip_tip_distances:
+            midpoint_root(tree)
+        tip_tip_distances.assert_not_called()
+
+    def test_midpoint_root_no_length(self):
+        for nwk, name in [("((b:1,c:6),(d:1,e:5));", 'unnamed'),
+                          ("((b:1,c:6)x,(d:1,e:5)y);", 'y')]:
+            tree = CompactTree.from_newick(nwk)
+            with self.assertRaisesRegex(NoLengthError,
+                                        'No length on node %s found' % name):
+                midpoint_root(tree)
+
+
+class MidpointRootNewickTests(TestPluginBase):
+
+    package = 'q2_phylogeny.tests'
+
+    def test_midpoint_root_newick(self):
+        read = self.get_transformer(NewickFormat, CompactTree)
+        write = self.get_transformer(CompactTree, NewickFormat)
+        for fn in ['test.tre', 'test2.tre', 'test3.tre', 'test4.tre',
+                   'test5.tre']:
+            tree = NewickFormat(self.get_data_path(fn), mode='r')
+            expected = skbio.TreeNode.read(str(tree)).root_at_midpoint()
+            actual = midpoint_root(read(tree))
+            self.assertIsInstance(actual, CompactTree)
+            with write(actual).open() as fh:
+                self.assertEqual(fh.read(), str(expected))
+
+    def test_midpoint_root_newick_escaped_quotes(self):
+        read = self.get_transformer(NewickFormat, CompactTree)
+        write = self.get_transformer(CompactTree, NewickFormat)
+        text = "((O''Brien:1,'it''s':2):1,(a_b:3,'c,d':4):2);\n"
+        tree = NewickFormat()
+        with tree.open() as fh:
+            fh.write(text)
+        expected = skbio.TreeNode.read(io.StringIO(text)).root_at_midpoint()
+
+        with write(midpoint_root(read(tree))).open() as fh:
+            self.assertEqual(fh.read(), str(expected))
+        self.assertIn("O'Brien", [tip.name for tip in expected.tips()])
+
+    def test_midpoint_root_newick_no_tree_nodes(self):
+        read = self.get_transformer(NewickFormat, CompactTree)
+        write = self.get_transformer(CompactTree, NewickFormat)
+        tree = NewickFormat(self.get_data_path('test.tre'), mode='r')
+        with unittest.mock.patch('skbio.TreeNode.__init__') as init:
+            write(midpoint_root(read(tree)))
+        init.assert_not_called()
+
 
 class TestRobinsonFoulds(unittest.TestCase):
     def test_expected(self):
@@ -87,6 +167,150 @@ class TestRobinsonFoulds(unittest.TestCase):
 
         self.assertEqual(result, expected)
 
+    def test_expected_multiple_threads(self):
+        test_data = [
+            ['(A,(B,(H,(D,(J,(((G,E),(F,I)),C))))));'],
+            ['(A,(B,(D,((J,H),(((G,E),(F,I)),C)))));'],
+            ['(A,(B,(D,(H,(J,(((G,E),(F,I)),C))))));'],
+            ['(A,(B,(E,(G,((F,I),((J,(H,D)),C))))));'],
+            ['(A,(B,(E,(G,((F,I),(((J,H),D),C))))));'],
+        ]
+        trees = [skbio.TreeNode.read(nwk) for nwk in test_data]
+        expected = robinson_foulds(trees)
+
+        result = robinson_foulds(trees, n_threads=2)
+
+        self.assertEqual(result, expected)
+
+    def test_expected_hash(self):
+        test_data = [
+            ['(A,(B,(H,(D,(J,(((G,E),(F,I)),C))))));'],
+            ['(A,(B,(D,((J,H),(((G,E),(F,I)),C)))));'],
+            ['(A,(B,(D,(H,(J,(((G,E),(F,I)),C))))));'],
+            ['(A,(B,(E,(G,((F,I),((J,(H,D)),C))))));'],
+            ['(A,(B,(E,(G,((F,I),(((J,H),D),C))))));'],
+        ]
+        trees = [skbio.TreeNode.read(nwk) for nwk in test_data]
+        expected = robinson_foulds(trees)
+
+        result = robinson_foulds(trees, method='hash')
+        self.assertEqual(result, expected)
+
+        result = robinson_foulds(trees, method='hash', exact=True)
+        self.assertEqual(result, expected)
+
+    def test_hash_intersect_all(self):
+        test_data = [
+            ['(A,(B,(H,(J,(((G,E),(F,I)),C)))));'],
+            ['(B,((J,H),(((G,E),(F,I)),C)));'],
+            ['(B,(D,(H,(J,(((G,E),(F,I)),C)))));'],
+        ]
+        trees = [skbio.TreeNode.read(nwk) for nwk in test_data]
+        expected = skbio.DistanceMatrix([[0, 2, 0], [2, 0, 2], [0, 2, 0]])
+
+        result = robinson_foulds(trees, labels=['0', '1', '2'],
+                                 missing_tips='intersect-all', method='hash')
+
+        self.assertEqual(result, expected)
+
+    def test_weighted_rf(self):
+        trees = [skbio.TreeNode.read(['((A:1,B:2):3,C:4);']),
+                 skbio.TreeNode.read(['((A:1,C:2):3,B:4);']),
+                 skbio.TreeNode.read(['((A:1,B:2):3,C:4);'])]
+        expected = skbio.DistanceMatrix([[0, 10, 0], [10, 0, 10],
+                                         [0, 10, 0]])
+
+        result = robinson_foulds(trees, labels=['0', '1', '2'],
+                                 metric='weighted-rf')
+
+        self.assertEqual(result, expected)
+
+    def test_kf(self):
+        trees = [skbio.TreeNode.read(['((A:1,B:2):3,C:4);']),
+                 skbio.TreeNode.read(['((A:1,C:2):3,B:4);'])]
+
+        result = robinson_foulds(trees, metric='kf')
+
+        self.assertAlmostEqual(result['tree_1', 'tree_2'], 26 ** 0.5)
+
+    def test_kf_intersect_all_sums_collapsed_branches(self):
+        # dropping D leaves C below a single-child node, whose branch is
+        # merged into C's as TreeNode.shear would
+        trees = [skbio.TreeNode.read(['((A:1,B:1):1,(C:1,D:1):1);']),
+                 skbio.TreeNode.read(['((A:1,B:1):1,C:2);'])]
+
+        result = robinson_foulds(trees, missing_tips='intersect-all',
+                                 metric='kf')
+
+        self.assertEqual(result['tree_1', 'tree_2'], 0)
+
+    def test_length_metric_requires_splits(self):
+        trees = [skbio.TreeNode.read(['((A,B),C);'])]
+
+        with self.assertRaisesRegex(ValueError, "kf.*splits"):
+            robinson_foulds(trees, method='hash', metric='kf')
+
+    def test_invalid_metric(self):
+        trees = [skbio.TreeNode.read(['((A,B),C);'])]
+
+        with self.assertRaisesRegex(ValueError, "not-a-metric"):
+            robinson_foulds(trees, metric="not-a-metric")
+
+    def test_invalid_method(self):
+        trees = [skbio.TreeNode.read(['((A,B),C);'])]
+
+        with self.assertRaisesRegex(ValueError, "not-a-method"):
+            robinson_foulds(trees, method="not-a-method")
+
+    def test_expected_on_disk(self):
+        test_data = [
+            ['(A,(B,(H,(D,(J,(((G,E),(F,I)),C))))));'],
+            ['(A,(B,(D,((J,H),(((G,E),(F,I)),C)))));'],
+            ['(A,(B,(D,(H,(J,(((G,E),(F,I)),C))))));'],
+            ['(A,(B,(E,(G,((F,I),((J,(H,D)),C))))));'],
+            ['(A,(B,(E,(G,((F,I),(((J,H),D),C))))));'],
+        ]
+        trees = [skbio.TreeNode.read(nwk) for nwk in test_data]
+
+        for kwargs in ({}, {'method': 'hash'}, {'metric': 'kf'}):
+            expected = robinson_foulds(trees, **kwargs)
+            with unittest.mock.patch('q2_phylogeny._util._ON_DISK_MIN_TREES',
+                                     2):
+                result = robinson_foulds(trees, **kwargs)
+            self.assertIsInstance(result.data, np.memmap)
+            self.assertEqual(result, expected)
+
+    def test_on_disk_duplicate_labels(self):
+        trees = [skbio.TreeNode.read(['((A,B),C);'])] * 2
+
+        with unittest.mock.patch('q2_phylogeny._util._ON_DISK_MIN_TREES', 2):
+            with self.assertRaisesRegex(ValueError, 'unique'):
+                robinson_foulds(trees, labels=['x', 'x'])
+
+    def test_duplicate_topologies_compared_once(self):
+        # the first and third trees differ only in the order of children
+        test_data = [
+            ['(A,(B,(H,(D,(J,(((G,E),(F,I)),C))))));'],
+            ['(A,(B,(D,((J,H),(((G,E),(F,I)),C)))));'],
+            ['((((((C,((I,F),(E,G))),J),D),H),B),A);'],
+        ]
+        trees = [skbio.TreeNode.read(nwk) for nwk in test_data]
+        expected = skbio.DistanceMatrix([[0, 4, 0], [4, 0, 4], [0, 4, 0]],
+                                        ids=['a', 'b', 'c'])
+
+        for method in ('splits', 'hash'):
+            with unittest.mock.patch('q2_phylogeny._util._pairwise_matrix',
+                                     wraps=_pairwise_matrix) as pairwise, \
+                    unittest.mock.patch('q2_phylogeny._util._hash_rf_matrix',
+                                        wraps=_hash_rf_matrix) as hash_rf:
+                result = robinson_foulds(trees, labels=['a', 'b', 'c'],
+                                         method=method)
+            self.assertEqual(result, expected)
+            self.assertEqual(pairwise.call_count + hash_rf.call_count, 1)
+            for mock in (pairwise, hash_rf):
+                for args, _ in mock.call_args_list:
+                    self.assertEqual(len(args[0]), 2)
+
     def test_single_tree_and_label(self):
         trees = [skbio.TreeNode.read(['(A:0.2, B:1.5, C, (E, F));'])]
         expected = skbio.DistanceMatrix([[0]], ids=['foo'])
@@ -149,6 +373,25 @@ class TestRobinsonFoulds(unittest.TestCase):
 
         self.assertEqual(result, expected)
 
+    def test_missing_intersect_all_does_not_copy_trees(self):
+        test_data = [
+            ['(A,(B,(H,(J,(((G,E),(F,I)),C)))));'],
+            ['(B,((J,H),(((G,E),(F,I)),C)));'],
+            ['(B,(D,(H,(J,(((G,E),(F,I)),C)))));'],
+        ]
+        trees = [skbio.TreeNode.read(nwk) for nwk in test_data]
+        expected = skbio.DistanceMatrix([[0, 2, 0], [2, 0, 2], [0, 2, 0]])
+
+        with unittest.mock.patch.object(skbio.TreeNode, 'shear') as shear, \
+                unittest.mock.patch.object(skbio.TreeNode, 'copy') as copy:
+            for method in ('splits', 'hash'):
+                result = robinson_foulds(trees, labels=['0', '1', '2'],
+                                         missing_tips='intersect-all',
+                                         method=method)
+                self.assertEqual(result, expected)
+        shear.assert_not_called()
+        copy.assert_not_called()
+
     def test_invalid_missing(self):
         test_data = [
             ['(A,(B,(H,(D,(J,(((G,E),(F,I,K,L)),C))))));'],
@@ -158,6 +401,138 @@ class TestRobinsonFoulds(unittest.TestCase):
         with self.assertRaisesRegex(ValueError, "not-an-option"):
             robinson_foulds(trees, missing_tips="not-an-option")
 
+    def test_tree_collection(self):
+        nwk = ("(A,(B,(C,D)));\n((A,B),(C,D));\n"
+               "(A,(C,(B,D)));\n((A,B),(C,D));\n")
+        trees = [skbio.TreeNode.read([line]) for line in nwk.splitlines()]
+        collection = CompactTreeCollection.from_newick(nwk)
+        expected = robinson_foulds(trees)
+
+        for method in ('splits', 'hash'):
+            obs = robinson_foulds(tree_collection=collection, method=method)
+            self.assertEqual(obs, expected)
+        self.assertEqual(robinson_foulds(collection), expected)
+
+    def test_trees_or_tree_collection(self):
+        collection = CompactTreeCollection.from_newick("(A,B);\n(A,B);\n")
+
+        with self.assertRaisesRegex(ValueError, "not both"):
+            robinson_foulds()
+        with self.assertRaisesRegex(ValueError, "not both"):
+            robinson_foulds(list(collection), tree_collection=collection)
+
+
+class TestRobinsonFouldsReference(unittest.TestCase):
+    def setUp(self):
+        self.test_data = [
+            ['(A,(B,(H,(D,(J,(((G,E),(F,I)),C))))));'],
+            ['(A,(B,(D,((J,H),(((G,E),(F,I)),C)))));'],
+            ['(A,(B,(D,(H,(J,(((G,E),(F,I)),C))))));'],
+            ['(A,(B,(E,(G,((F,I),((J,(H,D)),C))))));'],
+        ]
+        self.trees = [skbio.TreeNode.read(nwk) for nwk in self.test_data]
+
+    def test_matches_full_matrix(self):
+        expected = robinson_foulds(self.trees)
+
+        result = robinson_foulds_reference(self.trees, self.trees[0])
+
+        obs = result.to_dataframe()['distance']
+        self.assertEqual(list(obs.index), list(expected.ids))
+        self.assertEqual(list(obs), list(expected['tree_1']))
+
+    def test_labels(self):
+        result = robinson_foulds_reference(self.trees[:2], self.trees[1],
+                                           labels=['x', 'y'])
+
+        exp = pd.DataFrame({'distance': [4.0, 0.0]},
+                           index=pd.Index(['x', 'y'], name='id'))
+        pd.testing.assert_frame_equal(result.to_dataframe(), exp)
+
+    def test_kf(self):
+        trees = [skbio.TreeNode.read(['((A:1,B:2):3,C:4);']),
+                 skbio.TreeNode.read(['((A:1,C:2):3,B:4);'])]
+
+        result = robinson_foulds_reference(trees, trees[0], metric='kf')
+
+        obs = result.to_dataframe()['distance']
+        self.assertEqual(obs['tree_1'], 0)
+        self.assertAlmostEqual(obs['tree_2'], 26 ** 0.5)
+
+    def test_missing_tip_in_reference(self):
+        reference = skbio.TreeNode.read(
+            ['((B,(D,((J,H),(((G,E),(F,I)),C)))));'])
+
+        with self.assertRaisesRegex(ValueError, "tips.*shared.*'A'"):
+            robinson_foulds_reference(self.trees, reference)
+
+    def test_missing_intersect_all(self):
+        reference = skbio.TreeNode.read(['(B,((J,H),(((G,E),(F,I)),C)));'])
+        trees = [skbio.TreeNode.read(['(A,(B,(H,(J,(((G,E),(F,I)),C)))));']),
+                 skbio.TreeNode.read(['(B,(D,(H,(J,(((G,E),(F,I)),C)))));'])]
+
+        result = robinson_foulds_reference(trees, reference,
+                                           missing_tips='intersect-all')
+
+        self.assertEqual(list(result.to_dataframe()['distance']), [2, 2])
+
+
+class TestSplits(unittest.TestCase):
+    def test_tree_splits_match_subsets(self):
+        tree = skbio.TreeNode.read(['(((a,b)c,(d,e)f)h,(g))root;'])
+        compact = CompactTree.from_treenode(tree)
+        tip_index = _tip_index([compact])
+        names = {i: n for n, i in tip_index.items()}
+
+        obs = _tree_splits(compact, tip_index)
+        obs = {frozenset(names[i] for i in names if s >> i & 1)
+               for s in obs}
+
+        self.assertEqual(obs, tree.subsets())
+
+    def test_row_blocks_cover_all_rows(self):
+        blocks = _row_blocks(100, 8)
+
+        self.assertEqual(blocks[0][0], 0)
+        self.assertEqual(blocks[-1][1], 100)
+        for (_, stop), (start, _) in zip(blocks[:-1], blocks[1:]):
+            self.assertEqual(stop, start)
+        # later rows hold more comparisons, so the blocks get narrower
+        self.assertGreater(blocks[0][1] - blocks[0][0],
+                           blocks[-1][1] - blocks[-1][0])
+
+    def test_row_blocks_more_blocks_than_rows(self):
+        self.assertEqual(_row_blocks(3, 10), [(0, 1), (1, 2), (2, 3)])
+
+    def test_square_from_condensed(self):
+        # lower triangle, row by row
+        condensed = np.array([1, 2, 3, 4, 5, 6], dtype=np.uint8)
+        expected = np.array([[0, 1, 2, 4],
+                             [1, 0, 3, 5],
+                             [2, 3, 0, 6],
+                             [4, 5, 6, 0]], dtype=float)
+
+        obs = _square_from_condensed(condensed, 4, np.zeros((4, 4)))
+
+        np.testing.assert_array_equal(obs, expected)
+
+    def test_unique_topologies(self):
+        keys = [frozenset({3, 5}), frozenset({6}), frozenset({5, 3}),
+                frozenset(), frozenset({6})]
+
+        first, inverse = _unique_topologies(keys)
+
+        self.assertEqual(first, [0, 1, 3])
+        np.testing.assert_array_equal(inverse, [0, 1, 0, 2, 1])
+
+    def test_tip_index_shared(self):
+        trees = [CompactTree.from_newick('((a,b),c);'),
+                 CompactTree.from_newick('((c,d),a);')]
+
+        obs = _tip_index(trees)
+
+        self.assertEqual(obs, {'a': 0, 'b': 1, 'c': 2, 'd': 3})
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,91 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016-2023, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import os
+import tempfile
+import unittest
+
+from qiime2.util import redirected_stdio
+
+from q2_phylogeny._workdir import _work_dir, _run_key, _run_seed
+
+
+class WorkDirTests(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.checkpoint_dir = os.path.join(self.temp_dir.name, 'checkpoints')
+        self.alignment_fp = os.path.join(self.temp_dir.name, 'aligned.fasta')
+        self._write_alignment('>a\nACGT\n>b\nACGA\n')
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def _write_alignment(self, text):
+        with open(self.alignment_fp, 'w') as fh:
+            fh.write(text)
+
+    def test_run_key(self):
+        key = _run_key(self.alignment_fp, {'seed': 1, 'model': 'GTRGAMMA'})
+
+        self.assertEqual(len(key), 64)
+        self.assertEqual(
+            key, _run_key(self.alignment_fp, {'model': 'GTRGAMMA', 'seed': 1}))
+        self.assertNotEqual(
+            key, _run_key(self.alignment_fp, {'seed': 2, 'model': 'GTRGAMMA'}))
+        self._write_alignment('>a\nACGT\n>b\nACGT\n')
+        self.assertNotEqual(
+            key, _run_key(self.alignment_fp, {'seed': 1, 'model': 'GTRGAMMA'}))
+
+    def test_temporary(self):
+        with _work_dir(None, self.alignment_fp, seed=1) as work_dir:
+            self.assertTrue(os.path.isdir(work_dir))
+        self.assertFalse(os.path.exists(work_dir))
+
+    def test_kept_on_failure(self):
+        with self.assertRaises(RuntimeError):
+            with _work_dir(self.checkpoint_dir, self.alignment_fp,
+                           seed=1) as work_dir:
+                open(os.path.join(work_dir, 'checkpoint'), 'w').close()
+                raise RuntimeError()
+
+        with redirected_stdio(stdout=os.devnull):
+            with _work_dir(self.checkpoint_dir, self.alignment_fp,
+                           seed=1) as resumed:
+                self.assertEqual(resumed, work_dir)
+                self.assertEqual(os.listdir(resumed), ['checkpoint'])
+                self.assertEqual(os.path.dirname(resumed),
+                                 self.checkpoint_dir)
+        # the directory is removed once the run succeeds
+        self.assertFalse(os.path.exists(work_dir))
+
+    def test_parameters_name_directory(self):
+        with self.assertRaises(RuntimeError):
+            with _work_dir(self.checkpoint_dir, self.alignment_fp,
+                           seed=1) as work_dir:
+                raise RuntimeError()
+
+        with _work_dir(self.checkpoint_dir, self.alignment_fp,
+                       seed=2) as other:
+            self.assertNotEqual(other, work_dir)
+            self.assertEqual(os.listdir(other), [])
+
+    def test_run_seed(self):
+        with tempfile.TemporaryDirectory() as work_dir:
+            self.assertEqual(_run_seed(work_dir, 'seed', 42), 42)
+            self.assertEqual(os.listdir(work_dir), [])
+
+            seed = _run_seed(work_dir, 'seed', None)
+            self.assertTrue(1000 <= seed <= 10000)
+            # a resumed run uses the seed that was chosen for it
+            for _ in range(5):
+                self.assertEqual(_run_seed(work_dir, 'seed', None), seed)
+
+
+if __name__ == "__main__":
+    unittest.main()